@@ -0,0 +1,465 @@
+import asyncio
+import contextvars
+import inspect
+from concurrent.futures import CancelledError
+from .common  import read_frame_async, send_frame_async, unix_path
+from .cache   import make_cache
+from .message import CANCEL_METHOD, CREDIT_METHOD, HELLO_METHOD, INVALIDATE_METHOD, METRICS_METHOD, PING_METHOD, \
+                     STREAM_END_METHOD, Message
+from .encoder import JSONCodec
+from .client  import CONTROL_METHODS, Client, metrics_from_response
+from .interceptor import run_after
+
+from .connection.client import *
+
+# Batch collecting the requests of the running task, set by async with client.batch()
+current_batches = contextvars.ContextVar('current_batches', default=None)
+
+class AsyncResponseStream(object):
+    """
+    Async iterator over the Message chunks streamed by the server in response to a
+    request, created with AsyncClient.stream(). See ResponseStream.
+
+    :param client: The AsyncClient receiving the stream
+    :param request_id: The id of the request (int)
+    :param credit_batch: Number of consumed chunks acknowledged with one credit message (int)
+    """
+
+    def __init__(self, client, request_id, credit_batch=8):
+        """
+        Initialize an AsyncResponseStream object.
+
+        :param client: The AsyncClient receiving the stream
+        :param request_id: The id of the request
+        :param credit_batch: Number of consumed chunks acknowledged with one credit message
+        """
+        self.client = client
+        self.request_id = request_id
+        self.credit_batch = credit_batch
+        self.chunks = asyncio.Queue()
+        self.consumed = 0
+        self.done = False
+
+    def put(self, message):
+        """
+        Queue a chunk received by the reader task.
+
+        :param message: The received Message, or an exception if the connection was lost
+        """
+        self.chunks.put_nowait(message)
+
+    async def grant_credit(self):
+        """
+        Let the server send as many chunks as were consumed since the last credit.
+        """
+        if self.consumed:
+            consumed, self.consumed = self.consumed, 0
+            await self.client.send_message(Message(method=CREDIT_METHOD, args=[consumed],
+                                                   request_id=self.request_id))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+
+        if self.chunks.empty():
+            # never wait for chunks the server has no credit to send
+            await self.grant_credit()
+        message = await self.chunks.get()
+
+        if isinstance(message, Exception):
+            self.done = True
+            raise message
+        if message.method == STREAM_END_METHOD:
+            self.done = True
+            raise StopAsyncIteration
+        if message.method == 'error':
+            self.done = True
+            return message
+
+        self.consumed += 1
+        if self.consumed >= self.credit_batch:
+            await self.grant_credit()
+        return message
+
+
+class AsyncClient(Client):
+    """
+    Represents a client that connects to the server and sends/receives messages
+    from an asyncio event loop.
+
+    Functions decorated with register_request return awaitables, so many requests,
+    also to different servers, can be awaited together with asyncio.gather. Requests
+    are always pipelined: they are tagged with an id and a reader task resolves
+    the matching awaitable when the response arrives, in whatever order.
+
+    :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket (str)
+    :param port: Port number of the server (int)
+    :param encoder: Encoder instance for encoding/decoding messages
+    :param connection_type: PlainConnection or SSLConnection used to connect
+    :param max_frame_size: Maximum size of a single message frame (int)
+    :param timeout: Seconds to wait for the response to a request, None to wait forever (float)
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize an AsyncClient object, the arguments are the same as for Client.
+        """
+        super().__init__(*args, **kwargs)
+        self.send_lock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+
+    async def connect(self, connected_socket=None):
+        """
+        Connect to the server at the specified address and port.
+
+        :param connected_socket: Socket already connected to the server, e.g. returned by
+                                 Server.socketpair, used instead of connecting to the address
+        """
+        path = unix_path(self.host)
+        if connected_socket is not None:
+            print('Connecting over a connected socket')
+        elif path is not None:
+            print(f'Connecting to {self.host}')
+        else:
+            print(f'Connecting to {self.host} port {self.port}')
+
+        context = self.connection_type.context
+        server_hostname = self.connection_type.cert_hostname if context else None
+        try:
+            if connected_socket is not None:
+                self.reader, self.writer = await asyncio.open_connection(
+                                            sock=connected_socket, ssl=context, server_hostname=server_hostname
+                                        )
+            elif path is not None:
+                self.reader, self.writer = await asyncio.open_unix_connection(
+                                            path, ssl=context, server_hostname=server_hostname
+                                        )
+            else:
+                self.reader, self.writer = await asyncio.open_connection(
+                                            self.host, self.port, ssl=context, server_hostname=server_hostname
+                                        )
+        except Exception as e:
+            print(f"Failed to connect: {e}")
+            raise
+        if context:
+            self.connection_type.connected(self.writer.get_extra_info('ssl_object'))
+
+        if self.encoder.accepted_codecs[0] != JSONCodec.name:
+            await self.negotiate_codec()
+
+        self.reader_task = asyncio.create_task(self.read_responses())
+
+    async def negotiate_codec(self):
+        """
+        Agree on a codec with the server, see Client.negotiate_codec.
+        """
+        self.encoder = self.encoder.with_codec(JSONCodec.name)
+        await self.send_message(Message(method=HELLO_METHOD, args=self.encoder.accepted_codecs))
+        response_message = await self.receive_response()
+
+        if response_message is not None and response_message.method == HELLO_METHOD:
+            self.encoder = self.encoder.with_codec(response_message.args[0])
+        print(f"Using codec {self.encoder.codec.name}")
+
+    def register_request(self, stream=False, cache=None):
+        """
+        Register a request function
+
+        :param stream: If True, the request is answered by a generator handler and the
+                       coroutine returns an AsyncResponseStream of its chunks, e.g.
+                       async for chunk in await rows(). The response handlers are not
+                       invoked for the chunks
+        :param cache: Cache the responses of the request, see Client.register_request
+        :return: Decorator function returning a coroutine that sends the message
+        """
+        def decorator(func):
+            response_cache = make_cache(cache)
+            if response_cache is not None:
+                self.caches[func.__name__] = response_cache
+            else:
+                self.caches.pop(func.__name__, None)
+
+            async def wrapper(*args,**kwargs):
+                can_run = func(*args,**kwargs)
+                if inspect.isawaitable(can_run):
+                    can_run = await can_run
+                if can_run:
+                    if stream:
+                        return await self.stream(Message(method=func.__name__,args=args,options=kwargs))
+                    if self.current_batch is not None:
+                        self.current_batch.add(Message(method=func.__name__,args=args,options=kwargs))
+                        return can_run
+                    if response_cache is not None:
+                        await self.request_cached(response_cache, Message(method=func.__name__,args=args,options=kwargs))
+                        return can_run
+                    response_message = await self.submit(Message(method=func.__name__,args=args,options=kwargs))
+                    self.handle_response(response_message)
+                else:
+                    raise Exception("Will not send malformed request")
+                return can_run
+            return wrapper
+        return decorator
+
+    async def ping(self, timeout=None):
+        """
+        Check that the connection is alive with a round trip to the server, see Client.ping.
+
+        :param timeout: Seconds to wait for the answer, None to wait forever
+        :return: True if the server answered
+        """
+        if not self.writer:
+            return False
+        try:
+            response_message = await asyncio.wait_for(self.submit(Message(method=PING_METHOD)), timeout)
+        except Exception as e:
+            print(f"Ping failed: {e}")
+            return False
+        return response_message is not None
+
+    async def metrics(self):
+        """
+        Read the metrics of the server, see Server.metrics_snapshot.
+
+        :return: Dictionary of the metrics
+        """
+        return metrics_from_response(await self.submit(Message(method=METRICS_METHOD)))
+
+    async def request_cached(self, response_cache, message):
+        """
+        Answer a request from the cache of its method, or send it and cache its
+        response. Invalidations are applied by the reader task as they arrive.
+
+        :param response_cache: The ResponseCache of the method
+        :param message: Message object to be sent
+        :return: The response Message
+        """
+        key = response_cache.key(message)
+        response_message = response_cache.get(key)
+        if response_message is None:
+            # a response invalidated while the request was in flight is not stored
+            generation = response_cache.generation
+            response_message = await self.submit(message)
+            if response_message.method != 'error':
+                response_cache.put(key, response_message, generation=generation)
+        self.handle_response(response_message)
+        return response_message
+
+    @property
+    def current_batch(self):
+        """
+        :return: The Batch collecting the requests of the calling task, None outside a batch
+        """
+        batch = current_batches.get()
+        return batch if batch is not None and batch.client is self else None
+
+    @current_batch.setter
+    def current_batch(self, batch):
+        current_batches.set(batch)
+
+    async def send_batch(self, messages):
+        """
+        Send many messages in a single frame and wait for their responses.
+
+        :param messages: The Message objects to send, in order
+        :return: List of the response Messages
+        """
+        response_message = await self.submit(Message.batch(messages))
+        self.handle_response(response_message)
+        return response_message.unbatch()
+
+    async def stream(self, message: Message, credit_batch=8) -> AsyncResponseStream:
+        """
+        Send a request answered by a generator handler, see Client.stream.
+
+        :param message: Message object to be sent, its request_id is assigned here
+        :param credit_batch: Number of consumed chunks acknowledged with one credit message
+        :return: AsyncResponseStream yielding the response Messages
+        """
+        message.request_id = next(self.request_ids)
+        response_stream = AsyncResponseStream(self, message.request_id, credit_batch)
+        self.streams[message.request_id] = response_stream
+        try:
+            await self.send_message(message)
+        except Exception:
+            self.streams.pop(message.request_id, None)
+            raise
+        return response_stream
+
+    async def fetch(self, message: Message, destinations) -> Message:
+        """
+        Send a request and receive the attachments of its response straight into
+        files, see Client.fetch.
+
+        :param message: Message object to be sent
+        :param destinations: For each attachment of the response, the path or binary file
+                             object to write, None to keep it in memory
+        :return: The response Message
+        """
+        response_message = await self.submit(message, destinations)
+        self.handle_response(response_message)
+        return response_message
+
+    async def submit(self, message: Message, destinations=None, timeout=None) -> Message:
+        """
+        Send a request and wait for the response with the same id. A request that
+        times out is cancelled, see cancel.
+
+        :param message: Message object to be sent, its request_id is assigned here
+        :param destinations: Optional files to receive the attachments of the response into
+        :param timeout: Seconds to wait for the response, None for the timeout of the client.
+                        A deadline already set on the message is kept
+        :return: The response Message
+        """
+        wait = self.request_timeout(message, timeout) if message.method not in CONTROL_METHODS else None
+        future = asyncio.get_running_loop().create_future()
+        message.request_id = next(self.request_ids)
+        self.pending_requests[message.request_id] = future
+        if destinations is not None:
+            self.destinations[message.request_id] = destinations
+        try:
+            await self.send_message(message)
+            try:
+                return await asyncio.wait_for(future, wait)
+            except TimeoutError:
+                await self.cancel(message.request_id)
+                raise TimeoutError(f"No response to {message.method} in {wait:.3f} seconds") from None
+        finally:
+            self.pending_requests.pop(message.request_id, None)
+            self.destinations.pop(message.request_id, None)
+
+    async def cancel(self, request_id):
+        """
+        Give up on a request, see Client.cancel.
+
+        :param request_id: The id of the request
+        :return: False if the request was already answered
+        """
+        future = self.pending_requests.pop(request_id, None)
+        response_stream = self.streams.pop(request_id, None)
+        if future is None and response_stream is None:
+            return False
+        self.cancelled[request_id] = response_stream is not None
+        self.destinations.pop(request_id, None)
+        call = self.calls.pop(request_id, None)
+
+        try:
+            await self.send_message(Message(method=CANCEL_METHOD, request_id=request_id))
+        except OSError:
+            # the connection is lost, the server drops the request anyway
+            pass
+        error = CancelledError(f"Request {request_id} cancelled")
+        if call is not None:
+            call.error = error
+            run_after(self.interceptors, call)
+        if future is not None and not future.done():
+            future.set_exception(error)
+        if response_stream is not None:
+            response_stream.put(error)
+        return True
+
+    async def read_responses(self):
+        """
+        Read responses from the server and resolve the pending requests by their id.
+        Runs as a task until the connection is closed.
+        """
+        error = ConnectionError("Connection closed")
+        try:
+            while True:
+                response_message = await self.receive_response()
+                if response_message is None:
+                    break
+
+                stream = self.cancelled.get(response_message.request_id)
+                if stream is not None:
+                    # answers a cancelled request, until the end of its stream
+                    if not stream or response_message.method in (STREAM_END_METHOD, 'error'):
+                        del self.cancelled[response_message.request_id]
+                    continue
+
+                response_stream = self.streams.get(response_message.request_id)
+                if response_stream is not None:
+                    if response_message.method in (STREAM_END_METHOD, 'error'):
+                        del self.streams[response_message.request_id]
+                    response_stream.put(response_message)
+                    continue
+
+                future = self.pending_requests.pop(response_message.request_id, None)
+                if future is None:
+                    print("No pending request for response id:", response_message.request_id)
+                    self.handle_response(response_message)
+                elif not future.done():
+                    future.set_result(response_message)
+        except Exception as e:
+            error = e
+        finally:
+            pending, self.pending_requests = self.pending_requests, {}
+            streams, self.streams = self.streams, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            for response_stream in streams.values():
+                response_stream.put(error)
+
+    async def send_message(self, message: Message):
+        """
+        Send a message to the connected server.
+
+        :param message: Message object to be sent
+        :raise ConnectionError: If the client is not connected
+        """
+        if not self.writer:
+            raise ConnectionError("Client is not connected")
+
+        encoded_data = self.encode_request(message)
+        try:
+            async with self.send_lock:
+                await send_frame_async(self.writer, encoded_data, self.max_frame_size, message.request_id,
+                                       message.attachments)
+                await self.writer.drain()
+        except Exception as e:
+            print(f"Failed to send message: {e}")
+            self.abandon_call(message.request_id, e)
+            raise
+
+    async def receive_response(self) -> Message:
+        """
+        Receive a response from the server.
+
+        :return: Message object created from the received data
+        """
+        if not self.reader:
+            print("Client is not connected.")
+            return None
+
+        while True:
+            frame = await read_frame_async(self.reader, self.max_frame_size, self.destinations)
+            if frame is None:
+                print("Connection closed by server.")
+                return None
+
+            response_message = self.decode_response(frame)
+            if response_message.method == INVALIDATE_METHOD and response_message.request_id is None:
+                # pushed by the server, not a response
+                self.handle_response(response_message)
+                continue
+            return response_message
+
+    async def close(self):
+        """
+        Close the client connection.
+        """
+        if self.writer:
+            print('Closing socket')
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+                if self.reader_task:
+                    await self.reader_task
+                    self.reader_task = None
+            except Exception as e:
+                print(f"Failed to close socket: {e}")
@@ -0,0 +1,534 @@
+import asyncio
+import inspect
+import socket
+import ssl
+import threading
+import time
+from .common  import FrameError, read_frame_async, remove_socket_file, send_frame_async, write_frame_async
+from .message import BATCH_METHOD, CANCEL_METHOD, CREDIT_METHOD, HELLO_METHOD, METRICS_METHOD, PING_METHOD, \
+                     STREAM_END_METHOD, Message
+from .server  import DRAIN_POLL_INTERVAL, Server, acquire_slot, error_message, expired_message, release_slot
+from .interceptor import Call, frame_size, run_after, run_before
+from .connection.server import *
+
+
+class AsyncServer(Server):
+    """
+    Represents a server that handles all its client connections on a single asyncio event loop.
+
+    Handlers are registered with register_method exactly like for Server and can be
+    either plain functions or coroutine functions returning the response Message, or
+    generators or async generators streaming the response as Message chunks.
+
+    :param host: Host address to bind the server, or unix:// followed by the path of a Unix domain socket (str)
+    :param port: Port number to listen on (int)
+    :param encoder: Encoder instance for encoding/decoding messages
+    :param connection_type: PlainConnection or SSLConnection used for the client connections
+    :param max_frame_size: Maximum size of a single message frame (int)
+    :param backlog: Size of the accept backlog of the listening socket (int)
+    :param max_connections: Maximum number of concurrent client connections (int)
+    :param max_in_flight: Maximum number of pipelined requests in flight per connection (int)
+    :param max_pending: Maximum number of pipelined requests running on all connections (int)
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize an AsyncServer object, the arguments are the same as for Server.
+        """
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.stopped = None
+
+    async def start_server(self, server_socket=None):
+        """
+        Start the server and serve client connections until stop_server is called.
+
+        :param server_socket: Already listening socket to accept connections from,
+                              created if not given
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.stop_main_thread:
+            # stopped before the event loop started
+            self.stopped.set()
+
+        created = server_socket is None
+        if server_socket is None:
+            server_socket = self.create_server_socket()
+
+        try:
+            self.server_socket = await asyncio.start_server(
+                                    self.handle_client, sock=server_socket,
+                                    ssl=self.connection_type.context, backlog=self.backlog
+                                )
+        except Exception as e:
+            print(f"Failed to start server: {e}")
+            raise
+
+        async with self.server_socket:
+            try:
+                await self.stopped.wait()
+            finally:
+                if created:
+                    remove_socket_file(self.host)
+            # stop accepting connections, then let the requests being answered finish
+            self.server_socket.close()
+            await self.drain()
+
+    async def drain(self, timeout=None):
+        """
+        Wait for the requests being answered, see Server.drain.
+
+        :param timeout: Maximum number of seconds to wait, drain_timeout if None
+        :return: True if no request is left
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.drain_timeout)
+        while not self.idle():
+            if time.monotonic() >= deadline:
+                print("Stopping with requests still being answered")
+                return False
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        return True
+
+    def call_handler(self, handler, message, payload=None, encoder=None):
+        """
+        Invoke a handler where it was registered to run. Handlers registered with
+        executor="process" return an awaitable instead of blocking the event loop.
+
+        :param handler: The registered handler function
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :param encoder: Encoder instance that decodes the payload
+        :return: The response Message, or an awaitable of it
+        """
+        if message.method in self.process_methods:
+            return asyncio.wrap_future(self.submit_to_process(handler, message, payload, encoder))
+        if message.expired():
+            return expired_message(message)
+        return handler(message)
+
+    async def dispatch_async(self, message, payload=None, encoder=None):
+        """
+        Invoke the handler registered for the method of the message, awaiting
+        it if it is a coroutine function.
+
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :param encoder: Encoder instance that decodes the payload
+        :return: The response Message
+        """
+        if message.method == BATCH_METHOD:
+            responses = []
+            for data in message.args:
+                if message.expired():
+                    responses.append(expired_message(message))
+                    continue
+                if not isinstance(data, dict):
+                    responses.append(error_message('Malformed batch request'))
+                    continue
+                response_message = await self.dispatch_async(Message.from_dict(data), None, encoder)
+                if inspect.isgenerator(response_message) or inspect.isasyncgen(response_message):
+                    await self.close_stream(response_message)
+                    response_message = error_message('Cannot stream in a batch')
+                responses.append(response_message)
+            return Message.batch(responses)
+
+        response_message = self.dispatch(message, payload, encoder)
+        if inspect.isawaitable(response_message):
+            response_message = await response_message
+        return response_message
+
+    def send_response(self, session, response_message, request_id):
+        """
+        Encode a response tagged with the id of its request and queue it on the
+        writer of the client. The caller is responsible for awaiting drain().
+
+        :param session: The Session of the client
+        :param response_message: The Message to send
+        :param request_id: The id of the request being answered (int or None)
+        """
+        # Encode the response before sending it
+        encoded_response = session.encoder.encode(response_message)
+        write_frame_async(session.connection, encoded_response, self.max_frame_size, request_id,
+                          response_message.attachments)
+        if self.capture is not None:
+            self.capture.response(session.number, request_id,
+                                  frame_size(encoded_response, response_message.attachments))
+
+    async def write_response(self, session, response_message, request_id):
+        """
+        Encode a response tagged with the id of its request, write it to the client
+        and wait until it is sent.
+
+        :param session: The Session of the client
+        :param response_message: The Message to send
+        :param request_id: The id of the request being answered (int or None)
+        :return: Size of the response frame
+        """
+        # Encode the response before sending it
+        encoded_response = session.encoder.encode(response_message)
+        await self.write_encoded(session, encoded_response, request_id, response_message.attachments)
+        return frame_size(encoded_response, response_message.attachments)
+
+    async def write_encoded(self, session, encoded_response, request_id, attachments=()):
+        """
+        Write an already encoded response tagged with the id of its request and wait
+        until it is sent. Responses are written one at a time, so the file attachments
+        of a response are not mixed with other responses.
+
+        :param session: The Session of the client
+        :param encoded_response: The encoded response (bytes)
+        :param request_id: The id of the request being answered (int or None)
+        :param attachments: The attachments of the response
+        """
+        async with session.send_lock:
+            await send_frame_async(session.connection, encoded_response, self.max_frame_size, request_id,
+                                   attachments)
+            await session.connection.drain()
+        if self.capture is not None:
+            self.capture.response(session.number, request_id, frame_size(encoded_response, attachments))
+
+    async def respond(self, session, message, payload=None):
+        """
+        Dispatch a message and send the response tagged with the id of the request,
+        running the interceptors around it.
+
+        :param session: The Session of the client
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        """
+        if not self.interceptors:
+            await self.answer(session, message, payload)
+            return
+
+        call = Call(message, session.address, frame_size(payload, message.attachments))
+        try:
+            response_message = run_before(self.interceptors, call)
+            if response_message is not None:
+                call.response = response_message
+                call.response_size = await self.write_response(session, response_message, message.request_id)
+            else:
+                call.response, call.response_size = await self.answer(session, message, payload)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            run_after(self.interceptors, call)
+
+    async def answer(self, session, message, payload=None):
+        """
+        Answer a message from the cache of its method, or dispatch it, and send the
+        response tagged with the id of the request. See Server.answer.
+
+        :param session: The Session of the client
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :return: Tuple of the response Message, None if it came from the cache or was
+                 streamed, and the size of the response frame
+        """
+        timer = self.start_timer(message, payload)
+        cache, key, cached = self.cached_response(session, message)
+        if cached is not None:
+            timer.handled(cache_hit=True)
+            try:
+                await self.write_encoded(session, cached[0], message.request_id, cached[1])
+            except BaseException:
+                timer.unsent()
+                raise
+            timer.sent(cached[0], cached[1])
+            return None, frame_size(cached[0], cached[1])
+
+        try:
+            response_message = await self.dispatch_async(message, payload, session.encoder)
+        except BaseException:
+            timer.failed()
+            raise
+        timer.handled()
+        streamed = inspect.isgenerator(response_message) or inspect.isasyncgen(response_message)
+        try:
+            if streamed:
+                await self.send_stream(session, response_message, message.request_id, message)
+            else:
+                if message.cancelled:
+                    # the client no longer waits for the response
+                    response_message = expired_message(message)
+                encoded_response = session.encoder.encode(response_message)
+                if cache is not None and response_message.method != 'error':
+                    cache.put_encoded(key, encoded_response, response_message.attachments)
+                await self.write_encoded(session, encoded_response, message.request_id,
+                                         response_message.attachments)
+        except BaseException:
+            # the request does not stay active in the metrics
+            timer.unsent()
+            raise
+        if streamed:
+            timer.sent()
+            return None, 0
+        timer.sent(encoded_response, response_message.attachments, response_message.method == 'error')
+        return response_message, frame_size(encoded_response, response_message.attachments)
+
+    async def close_stream(self, chunks):
+        """
+        Close a generator or async generator handler.
+
+        :param chunks: The generator returned by the handler
+        """
+        if inspect.isasyncgen(chunks):
+            await chunks.aclose()
+        else:
+            chunks.close()
+
+    async def send_stream(self, session, chunks, request_id, request=None):
+        """
+        Send the chunks yielded by a generator or async generator handler as they are
+        produced, then the end of stream message. See Server.send_stream.
+
+        :param session: The Session of the client
+        :param chunks: Generator or async generator yielding the response Messages
+        :param request_id: The id of the request being answered (int or None)
+        :param request: The request Message, to stop at its deadline
+        """
+        credit = None
+        if request_id is not None:
+            credit = asyncio.Semaphore(session.stream_window)
+            session.streams[request_id] = credit
+        end_message = Message(method=STREAM_END_METHOD)
+        try:
+            while True:
+                try:
+                    if inspect.isasyncgen(chunks):
+                        chunk = await chunks.__anext__()
+                    else:
+                        chunk = next(chunks)
+                except (StopIteration, StopAsyncIteration):
+                    break
+                if credit is not None:
+                    await credit.acquire()
+                if request is not None and request.expired():
+                    end_message = expired_message(request)
+                    break
+                await self.write_response(session, chunk, request_id)
+        finally:
+            await self.close_stream(chunks)
+            session.streams.pop(request_id, None)
+            if not session.closed:
+                await self.write_response(session, end_message, request_id)
+
+    async def handle_client(self, reader, writer):
+        """
+        Handle communication with a connected client.
+
+        Messages without a request id are answered in order, every pipelined request
+        is handled by its own task and answered as soon as it completes.
+
+        :param reader: asyncio.StreamReader of the client connection
+        :param writer: asyncio.StreamWriter of the client connection
+        """
+        client_address = writer.get_extra_info('peername')
+        session = self.create_session(writer, client_address)
+
+        if not acquire_slot(self.connection_slots):
+            print(f"Rejecting connection from {client_address}: too many connections")
+            if self.metrics is not None:
+                self.metrics.connection_rejected()
+            try:
+                self.send_response(session, error_message('Server busy'), None)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+            return
+
+        print(f"Connection from {client_address}")
+        connection = writer.get_extra_info('ssl_object') or writer.get_extra_info('socket')
+        self.connection_type.connected(connection)
+        self.sessions.add(session)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+        tasks = {}  # task -> id of the pipelined request it answers
+
+        def request_done(task):
+            session.in_flight.pop(tasks.pop(task, None), None)
+            release_slot(session.in_flight_slots)
+            release_slot(self.pending_slots)
+            if not task.cancelled() and task.exception():
+                print(f"Failed to handle request from {client_address}: {task.exception()}")
+
+        try:
+            while True:
+                try:
+                    frame = await read_frame_async(reader, self.max_frame_size)
+                except FrameError as e:
+                    print(f"Invalid frame from {client_address}: {e}")
+                    return
+                if frame is None:
+                    return
+                request_id, data, attachments = frame
+
+                # Only the method is decoded here, so requests can be routed or
+                # rejected without decoding their arguments
+                try:
+                    message = session.encoder.decode(data, request_id, lazy=True)
+                except FrameError as e:
+                    print(f"Invalid frame from {client_address}: {e}")
+                    return
+                if attachments:
+                    message.attachments = attachments
+                if self.capture is not None:
+                    self.capture.request(session.number, message.method, request_id, data, attachments)
+
+                if message.method == HELLO_METHOD:
+                    self.negotiate_codec(session, message)
+                    await writer.drain()
+                elif message.method == PING_METHOD:
+                    await self.write_response(session, Message(method=PING_METHOD), message.request_id)
+                elif message.method == METRICS_METHOD:
+                    await self.write_response(session, self.metrics_response(), message.request_id)
+                elif message.method == CREDIT_METHOD:
+                    session.grant_credit(message.request_id, message.args[0])
+                elif message.method == CANCEL_METHOD:
+                    session.cancel(message.request_id)
+                elif message.request_id is None:
+                    session.busy = True
+                    try:
+                        await self.respond(session, message, data)
+                    finally:
+                        session.busy = False
+                elif not acquire_slot(session.in_flight_slots):
+                    await self.write_response(session, error_message('Too many requests in flight'), message.request_id)
+                elif not acquire_slot(self.pending_slots):
+                    release_slot(session.in_flight_slots)
+                    await self.write_response(session, error_message('Server busy'), message.request_id)
+                else:
+                    session.in_flight[message.request_id] = message
+                    task = asyncio.create_task(self.respond(session, message, data))
+                    tasks[task] = message.request_id
+                    task.add_done_callback(request_done)
+
+        except ConnectionError as e:
+            print(f"Connection error from {client_address}: {e}")
+        finally:
+            # Clean up the connection
+            print(f"Closing connection to {client_address}")
+            session.closed = True
+            for task in list(tasks):
+                task.cancel()
+            self.sessions.discard(session)
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            release_slot(self.connection_slots)
+            self.connection_type.disconnected(connection)
+            writer.close()
+
+    def create_session(self, connection, address):
+        """
+        Create the state of a new client connection, see Server.create_session.
+        Its send_lock is an asyncio.Lock held while a response is written.
+
+        :param connection: The asyncio.StreamWriter of the client
+        :param address: The address of the client (tuple)
+        :return: Session instance
+        """
+        session = super().create_session(connection, address)
+        session.send_lock = asyncio.Lock()
+        return session
+
+    def socketpair(self):
+        """
+        Create a connected pair of sockets, handle one end like an accepted client
+        connection and return the other one, see Server.socketpair. The server must
+        be running.
+
+        :return: The client end of the pair (socket)
+        """
+        if self.loop is None:
+            raise RuntimeError("Server is not running")
+        server_end, client_end = socket.socketpair()
+        asyncio.run_coroutine_threadsafe(self.serve_connection_async(server_end), self.loop)
+        return client_end
+
+    async def serve_connection_async(self, client_connection):
+        """
+        Handle a connected socket like an accepted client connection.
+
+        :param client_connection: The connected socket of the client (socket)
+        """
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader, self.handle_client)
+        try:
+            await self.loop.connect_accepted_socket(lambda: protocol, client_connection,
+                                                    ssl=self.connection_type.context)
+        except (ssl.SSLError, ConnectionError) as e:
+            print(f"Failed to accept connection: {e}")
+            client_connection.close()
+
+    def push(self, message):
+        """
+        Send a message, without request id, to all the connected clients. Can be
+        called from any thread.
+
+        :param message: The Message to send
+        """
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.push_async(message), self.loop)
+
+    async def push_async(self, message):
+        """
+        Send a message, without request id, to all the connected clients at once. A
+        client that does not take it within push_timeout is dropped, see Server.push.
+
+        :param message: The Message to send
+        """
+        await asyncio.gather(*[self.push_to(session, message) for session in list(self.sessions)])
+
+    async def push_to(self, session, message):
+        """
+        Send a pushed message to a client, and drop the client if it does not take
+        it within push_timeout.
+
+        :param session: The Session of the client
+        :param message: The Message to send
+        """
+        try:
+            await asyncio.wait_for(self.write_response(session, message, None), self.push_timeout)
+        except TimeoutError:
+            print(f"Dropping {session.address}: the connection does not take pushed messages")
+            # the message may be partly written, the connection cannot be used anymore
+            session.connection.transport.abort()
+        except ConnectionError as e:
+            print(f"Failed to push to {session.address}: {e}")
+
+    def stop_server(self):
+        """
+        Stop the server, can be called from any thread, also once it stopped.
+        """
+        self.stop_main_thread = True
+        self.stop_capture()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def serve_worker(self, server_socket):
+        """
+        Serve connections in a worker process forked by run_workers.
+
+        :param server_socket: The listening socket of the worker
+        """
+        asyncio.run(self.start_server(server_socket))
+
+    def run(self, workers=None, reuse_port=False):
+        """
+        Run the event loop of the server in its own thread.
+
+        :param workers: If set, run that many worker processes with run_workers instead,
+                        each with its own event loop. This call then blocks until the
+                        workers are stopped
+        :param reuse_port: With workers, bind one socket per worker with SO_REUSEPORT
+        """
+        if workers:
+            self.run_workers(workers, reuse_port)
+            return
+
+        self.main_thread = threading.Thread(target=asyncio.run, args=(self.start_server(),))
+        self.main_thread.start()
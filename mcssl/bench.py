@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from .asyncserver    import AsyncServer
+from .client         import Client
+from .encoder        import CODECS, CompressingEncoder, Encoder
+from .message        import Message
+from .selectorserver import SelectorServer
+from .server         import Server
+
+from .connection import client as client_connection
+from .connection import server as server_connection
+
+SERVER_TYPES = {'thread': Server, 'selector': SelectorServer, 'async': AsyncServer}
+TRANSPORTS = ('plain', 'ssl')
+
+# Host name of the benchmark certificate
+CERT_HOSTNAME = 'localhost'
+
+
+def parse_list(text, item_type=str):
+    """
+    :param text: Comma separated values (str)
+    :param item_type: Type of the values
+    :return: List of the values
+    """
+    return [item_type(item) for item in text.split(',') if item]
+
+
+def create_certificate(cert_file, key_file, hostname=CERT_HOSTNAME):
+    """
+    Create a self signed certificate for the TLS benchmarks, like
+    utils/create_certificate.py does, with pyOpenSSL when it is installed or
+    else with the openssl command line tool.
+
+    :param cert_file: Path of the certificate file to write
+    :param key_file: Path of the private key file to write
+    :param hostname: Host name the certificate is valid for
+    """
+    try:
+        from OpenSSL import crypto
+    except ImportError:
+        crypto = None
+
+    if crypto is None:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650',
+                        '-keyout', key_file, '-out', cert_file, '-subj', f'/CN={hostname}',
+                        '-addext', f'subjectAltName=DNS:{hostname}'],
+                       check=True, capture_output=True)
+        return
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = hostname
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(10*31536000)  # 10 years in seconds
+    cert.set_issuer(cert.get_subject())
+    # clients check the host name against the subject alternative names only
+    cert.add_extensions([crypto.X509Extension(b'subjectAltName', False, f'DNS:{hostname}'.encode())])
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    with open(cert_file, 'wt') as file:
+        file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode('utf-8'))
+    with open(key_file, 'wt') as file:
+        file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key).decode('utf-8'))
+
+
+def split_encoder(spec):
+    """
+    :param spec: Encoder of a benchmark: a codec name, optionally followed by + and a
+                 compression algorithm of CompressingEncoder, e.g. 'binary+zlib'
+    :return: Tuple of the codec name and the compression algorithm (None if not compressed)
+    """
+    codec, _, algorithm = spec.partition('+')
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    if algorithm and algorithm not in CompressingEncoder.ALGORITHMS:
+        raise ValueError(f"Unknown compression algorithm: {algorithm}")
+    return codec, algorithm or None
+
+
+def client_encoder(spec):
+    """
+    :param spec: Encoder of a benchmark, see split_encoder
+    :return: Encoder of the clients, only accepting the codec of the benchmark
+    """
+    codec, algorithm = split_encoder(spec)
+    encoder = Encoder(codec, [codec])
+    if algorithm is not None:
+        encoder = CompressingEncoder(encoder, algorithm=algorithm)
+    return encoder
+
+
+def create_server(server_type, transport, compression=None, cert_file=None, key_file=None):
+    """
+    Create the server of a benchmark, it answers echo requests with their arguments.
+
+    :param server_type: Key of SERVER_TYPES
+    :param transport: 'plain' or 'ssl'
+    :param compression: Compression algorithm of the messages, None for no compression
+    :param cert_file: Certificate file of the ssl transport
+    :param key_file: Private key file of the ssl transport
+    :return: The server, not started
+    """
+    encoder = Encoder()
+    if compression is not None:
+        encoder = CompressingEncoder(encoder, algorithm=compression)
+    if transport == 'ssl':
+        connection_type = server_connection.SSLConnection(cert_file, key_file)
+    else:
+        connection_type = server_connection.PlainConnection()
+
+    server = SERVER_TYPES[server_type](host=CERT_HOSTNAME, port=0, encoder=encoder, connection_type=connection_type)
+
+    @server.register_method()
+    def echo(message):
+        return Message(method='echo', args=message.args)
+
+    return server
+
+
+def serve(server, listening_socket):
+    """
+    Serve connections on an already listening socket until the server is stopped.
+
+    :param server: The server created by create_server
+    :param listening_socket: The listening socket
+    """
+    server.port = listening_socket.getsockname()[1]
+    if isinstance(server, AsyncServer):
+        asyncio.run(server.start_server(listening_socket))
+    else:
+        server.start_server(listening_socket)
+
+
+class BenchServer(object):
+    """
+    Runs the server of a benchmark in this process or in a subprocess, on a
+    listening socket bound to a free port of the loopback interface.
+
+        with BenchServer('thread', 'ssl', cert_file=..., key_file=...) as port:
+            ...
+
+    :param server_type: Key of SERVER_TYPES
+    :param transport: 'plain' or 'ssl'
+    :param compression: Compression algorithm of the messages, None for no compression
+    :param cert_file: Certificate file of the ssl transport
+    :param key_file: Private key file of the ssl transport
+    :param subprocess: Run the server in a subprocess, so it does not share the GIL with the clients (bool)
+    """
+
+    def __init__(self, server_type, transport, compression=None, cert_file=None, key_file=None, subprocess=True):
+        self.server_type = server_type
+        self.transport = transport
+        self.compression = compression
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.subprocess = subprocess
+        self.process = None
+        self.server = None
+        self.thread = None
+        self.listening_socket = None
+
+    def __enter__(self):
+        """
+        Start the server.
+
+        :return: The port of the server
+        """
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(128)
+        port = listening_socket.getsockname()[1]
+
+        if self.subprocess:
+            # the subprocess inherits the listening socket, so it accepts connections
+            # as soon as it runs without the need to wait for it
+            package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            environment = dict(os.environ)
+            environment['PYTHONPATH'] = os.pathsep.join(filter(None, [package_parent, environment.get('PYTHONPATH')]))
+            command = [sys.executable, '-m', 'mcssl.bench', '--serve-fd', str(listening_socket.fileno()),
+                       '--servers', self.server_type, '--transports', self.transport]
+            if self.compression is not None:
+                command += ['--serve-compression', self.compression]
+            if self.transport == 'ssl':
+                command += ['--cert', self.cert_file, '--key', self.key_file]
+            self.process = subprocess.Popen(command, pass_fds=[listening_socket.fileno()], env=environment,
+                                            stdout=subprocess.DEVNULL)
+            listening_socket.close()
+        else:
+            self.listening_socket = listening_socket
+            self.server = create_server(self.server_type, self.transport, self.compression,
+                                        self.cert_file, self.key_file)
+            self.thread = threading.Thread(target=serve, args=(self.server, listening_socket), daemon=True)
+            self.thread.start()
+        return port
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop the server.
+        """
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            return
+        self.server.stop_server()
+        self.thread.join(5)
+        self.listening_socket.close()
+
+
+def percentile(ordered, fraction):
+    """
+    :param ordered: Sorted list of values
+    :param fraction: The percentile, between 0 and 1
+    :return: The nearest rank percentile of the values
+    """
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_benchmark(port, transport, encoder_spec, payload_size, connections, requests, warmup=50,
+                  cert_file=None):
+    """
+    Drive a server with concurrent Clients, each sending echo requests one after
+    the other, and measure the latency of every request.
+
+    :param port: Port of the server
+    :param transport: 'plain' or 'ssl'
+    :param encoder_spec: Encoder of the clients, see split_encoder
+    :param payload_size: Size of the string sent in every request and echoed back
+    :param connections: Number of concurrent Clients, each with its own connection and thread
+    :param requests: Total number of measured requests, split between the clients
+    :param warmup: Requests sent by every client before the measurement starts
+    :param cert_file: Certificate file of the ssl transport
+    :return: Dictionary of the results
+    """
+    # hexadecimal characters, so the payload is neither escaped nor very compressible
+    payload = random.Random(payload_size).randbytes((payload_size + 1) // 2).hex()[:payload_size]
+    if transport == 'ssl':
+        connection_type = client_connection.SSLConnection(cert_file, CERT_HOSTNAME)
+    else:
+        connection_type = client_connection.PlainConnection()
+
+    counts = [requests // connections + (1 if index < requests % connections else 0)
+              for index in range(connections)]
+    latencies = [[] for _ in range(connections)]
+    errors = []
+    start = threading.Barrier(connections + 1)
+
+    def drive(index):
+        client = Client(CERT_HOSTNAME, port, client_encoder(encoder_spec), connection_type)
+        client.response_handlers['echo'] = lambda message: None
+        try:
+            client.connect()
+            for _ in range(warmup):
+                client.request(Message(method='echo', args=[payload]))
+            start.wait()
+            times = latencies[index]
+            for _ in range(counts[index]):
+                started = time.perf_counter()
+                response_message = client.request(Message(method='echo', args=[payload]))
+                times.append(time.perf_counter() - started)
+                if response_message is None or response_message.method != 'echo':
+                    raise ConnectionError(f"Unexpected response: {response_message}")
+        except Exception as e:
+            errors.append(e)
+            start.abort()
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=drive, args=(index,), daemon=True) for index in range(connections)]
+    for thread in threads:
+        thread.start()
+    try:
+        start.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if errors:
+        raise errors[0]
+
+    ordered = sorted(latency for times in latencies for latency in times)
+    count = len(ordered)
+    return {
+        'requests': count,
+        'seconds': elapsed,
+        'requests_per_second': count / elapsed,
+        # payload bytes of the requests and of their responses
+        'mb_per_second': 2 * payload_size * count / elapsed / 1e6,
+        'latency_ms': {
+            'mean': sum(ordered) / count * 1000,
+            'p50': percentile(ordered, 0.5) * 1000,
+            'p99': percentile(ordered, 0.99) * 1000,
+            'p999': percentile(ordered, 0.999) * 1000,
+            'max': ordered[-1] * 1000
+        }
+    }
+
+
+def parse_arguments(argv=None):
+    """
+    :param argv: Command line arguments, sys.argv if None
+    :return: argparse.Namespace of the options
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m mcssl.bench',
+        description='Loopback benchmark of mcssl: drives a server with concurrent clients sending '
+                    'echo requests, sweeping the server type, transport, encoder, payload size and '
+                    'number of connections, and prints the results as JSON.')
+    parser.add_argument('--servers', default='thread',
+                        help=f"Comma separated server types among {', '.join(SERVER_TYPES)} (default: thread)")
+    parser.add_argument('--transports', default=','.join(TRANSPORTS),
+                        help='Comma separated transports among plain, ssl (default: plain,ssl)')
+    parser.add_argument('--encoders', default=','.join(CODECS),
+                        help='Comma separated codecs, optionally compressed, e.g. json,binary,binary+zlib '
+                             '(default: every registered codec)')
+    parser.add_argument('--payload-sizes', default='64,4096,65536',
+                        help='Comma separated sizes of the echoed payload, in bytes (default: 64,4096,65536)')
+    parser.add_argument('--connections', default='1,8',
+                        help='Comma separated numbers of concurrent clients (default: 1,8)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Measured requests per benchmark, split between the clients (default: 2000)')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='Requests sent by every client before measuring (default: 50)')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run the server in this process instead of a subprocess')
+    parser.add_argument('--cert', help='Certificate of the ssl transport, generated if not given')
+    parser.add_argument('--key', help='Private key of the ssl transport, generated if not given')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    # used by the benchmark to run its server in a subprocess
+    parser.add_argument('--serve-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve-compression', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    args.servers = parse_list(args.servers)
+    args.transports = parse_list(args.transports)
+    args.encoders = parse_list(args.encoders)
+    args.payload_sizes = parse_list(args.payload_sizes, int)
+    args.connections = parse_list(args.connections, int)
+    for server_type in args.servers:
+        if server_type not in SERVER_TYPES:
+            parser.error(f"unknown server type: {server_type}")
+    for transport in args.transports:
+        if transport not in TRANSPORTS:
+            parser.error(f"unknown transport: {transport}")
+    for spec in args.encoders:
+        try:
+            split_encoder(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    if (args.cert is None) != (args.key is None):
+        parser.error("--cert and --key must be given together")
+    return args
+
+
+def run_all(args, cert_file=None, key_file=None):
+    """
+    Run the benchmarks of every combination of the options.
+
+    :param args: The options, see parse_arguments
+    :param cert_file: Certificate file of the ssl transport
+    :param key_file: Private key file of the ssl transport
+    :return: List of the results
+    """
+    results = []
+    for server_type in args.servers:
+        for transport in args.transports:
+            compressions = []
+            for spec in args.encoders:
+                compression = split_encoder(spec)[1]
+                if compression not in compressions:
+                    compressions.append(compression)
+            # both ends of a connection must agree on compression, so each one gets its server
+            for compression in compressions:
+                with BenchServer(server_type, transport, compression, cert_file, key_file,
+                                 subprocess=not args.in_process) as port:
+                    for spec in args.encoders:
+                        if split_encoder(spec)[1] != compression:
+                            continue
+                        for payload_size in args.payload_sizes:
+                            for connections in args.connections:
+                                result = {
+                                    'server': server_type,
+                                    'transport': transport,
+                                    'encoder': spec,
+                                    'payload_size': payload_size,
+                                    'connections': connections
+                                }
+                                result.update(run_benchmark(port, transport, spec, payload_size, connections,
+                                                            args.requests, args.warmup, cert_file))
+                                print(f"{server_type} {transport} {spec} {payload_size} bytes x{connections}: "
+                                      f"{result['requests_per_second']:.0f} requests/s, "
+                                      f"{result['mb_per_second']:.2f} MB/s, "
+                                      f"p50 {result['latency_ms']['p50']:.3f} ms, "
+                                      f"p99 {result['latency_ms']['p99']:.3f} ms", file=sys.stderr)
+                                results.append(result)
+    return results
+
+
+def main(argv=None):
+    """
+    Entry point of python -m mcssl.bench.
+
+    :param argv: Command line arguments, sys.argv if None
+    """
+    args = parse_arguments(argv)
+
+    if args.serve_fd is not None:
+        server = create_server(args.servers[0], args.transports[0], args.serve_compression, args.cert, args.key)
+        serve(server, socket.socket(fileno=args.serve_fd))
+        return
+
+    # the clients and the server log with print, the results alone go to stdout
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(sys.stderr):
+        cert_file, key_file = args.cert, args.key
+        if 'ssl' in args.transports and cert_file is None:
+            cert_file = os.path.join(directory, 'certificate.crt')
+            key_file = os.path.join(directory, 'private_key.key')
+            create_certificate(cert_file, key_file)
+        results = run_all(args, cert_file, key_file)
+
+    document = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'options': {
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'server_process': 'in-process' if args.in_process else 'subprocess'
+        },
+        'results': results
+    }
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
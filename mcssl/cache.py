@@ -0,0 +1,193 @@
+import collections
+import json
+import threading
+import time
+from .common import FileAttachment
+
+
+class ResponseCache(object):
+    """
+    Caches the responses of a method whose response only depends on the args and
+    options of the request. Servers store the encoded responses, so a hit skips
+    both the handler and the encoding of the response, and clients the decoded
+    response Messages, so a hit skips the round trip. Cached responses keep the
+    timestamp of the response they were stored from.
+
+    Entries are evicted least recently used first when there are more than
+    max_entries of them or they take more than max_bytes, and expire ttl
+    seconds after they were stored.
+
+    :param max_entries: Maximum number of cached responses (int)
+    :param ttl: Seconds a response stays cached, None for no expiry (float)
+    :param max_bytes: Maximum total size of the cached responses, None for no limit (int)
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        """
+        Initialize a ResponseCache object.
+
+        :param max_entries: Maximum number of cached responses
+        :param ttl: Seconds a response stays cached, None for no expiry
+        :param max_bytes: Maximum total size of the cached responses, None for no limit
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # (canonical request, codec name) -> (expiry time, cached response, size)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # incremented by every invalidation, see put
+        self.generation = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def canonical(args, options):
+        """
+        Build the canonical form of the args and options of a request, the same
+        for equal requests whatever the order of their options.
+
+        :param args: List of positional arguments of the request
+        :param options: Dictionary of keyword arguments of the request
+        :return: Canonical representation (str)
+        """
+        return json.dumps([args, options], sort_keys=True, separators=(',', ':'), default=repr)
+
+    def key(self, message, codec=None):
+        """
+        Build the cache key of a request.
+
+        :param message: The request Message
+        :param codec: Name of the codec of encoded responses, since the cached bytes
+                      can only be sent on connections using the same codec
+        :return: The cache key (tuple)
+        """
+        return self.canonical(message.args, message.options), codec
+
+    def get(self, key):
+        """
+        Look up a cached response.
+
+        :param key: The cache key of the request
+        :return: The cached response, None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response, size=0, generation=None):
+        """
+        Store a response, evicting the least recently used ones if needed.
+
+        :param key: The cache key of the request
+        :param response: The response to cache
+        :param size: The size of the response, counted towards max_bytes
+        :param generation: The generation of the cache when the request was sent. If
+                           entries were invalidated since, the response may be stale
+                           and is not stored
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires, response, size)
+            self.size += size
+
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def put_encoded(self, key, encoded_response, attachments=()):
+        """
+        Store an encoded response and its attachments, see put.
+
+        :param key: The cache key of the request
+        :param encoded_response: The encoded response (bytes)
+        :param attachments: The attachments of the response
+        """
+        # file attachments are only references to files
+        size = len(encoded_response) + sum(len(attachment) for attachment in attachments
+                                           if not isinstance(attachment, FileAttachment))
+        self.put(key, (encoded_response, list(attachments)), size)
+
+    def _remove(self, key):
+        """
+        Remove an entry, the lock must be held.
+
+        :param key: The cache key of the entry
+        """
+        self.size -= self.entries.pop(key)[2]
+
+    def invalidate(self, args=None, options=None):
+        """
+        Remove the cached responses of a request, for all the codecs, or all the
+        cached responses if neither args nor options are given.
+
+        :param args: List of positional arguments of the request
+        :param options: Dictionary of keyword arguments of the request
+        :return: The number of removed responses
+        """
+        with self.lock:
+            self.generation += 1
+            if args is None and options is None:
+                keys = list(self.entries)
+            else:
+                canonical = self.canonical(list(args or []), options or {})
+                keys = [key for key in self.entries if key[0] == canonical]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def stats(self):
+        """
+        :return: Dictionary of the counters of the cache
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def __repr__(self):
+        return (f"ResponseCache(entries={len(self.entries)}, bytes={self.size}, hits={self.hits}, "
+                f"misses={self.misses}, evictions={self.evictions}, expirations={self.expirations})")
+
+
+def make_cache(cache):
+    """
+    Build the cache of a method from the cache option of register_method or
+    register_request.
+
+    :param cache: None or False for no cache, True for a ResponseCache with the defaults,
+                  a dictionary of ResponseCache arguments or a ResponseCache instance
+    :return: ResponseCache instance, or None
+    """
+    if cache is True:
+        return ResponseCache()
+    if isinstance(cache, dict):
+        return ResponseCache(**cache)
+    return cache or None
@@ -0,0 +1,182 @@
+import struct
+import threading
+import time
+
+# First bytes of a capture log, followed by the wall clock time the capture started
+CAPTURE_MAGIC = b'MCSSLCAP2\n'
+CAPTURE_HEADER = struct.Struct('!Q')
+
+# Record header: kind, connection, nanoseconds since the start of the capture, request id
+RECORD_HEADER = struct.Struct('!BIQQ')
+REQUEST_RECORD = 1
+RESPONSE_RECORD = 2
+# Set on the kind of the records of frames with a request id
+HAS_REQUEST_ID = 0x80
+
+# Request records are followed by the method, the payload and the attachments,
+# response records by the size of the frame. Sizes are 64 bits, as attachments
+# can be bigger than 4 GiB
+METHOD_HEADER = struct.Struct('!H')
+SIZE_HEADER = struct.Struct('!Q')
+COUNT_HEADER = struct.Struct('!I')
+
+
+class CaptureRecord(object):
+    """
+    A frame read from a capture log.
+
+    :param kind: REQUEST_RECORD or RESPONSE_RECORD
+    :param connection: Number of the connection of the frame on the server (int)
+    :param timestamp: Nanoseconds since the start of the capture (int)
+    :param request_id: Id of the frame, None if it has none (int)
+    :param method: Method of a request (str)
+    :param payload: Encoded message of a request (bytes)
+    :param attachments: Attachments of a request (list of bytes)
+    :param size: Size of a response frame, attachments included (int)
+    """
+
+    __slots__ = ('kind', 'connection', 'timestamp', 'request_id', 'method', 'payload', 'attachments', 'size')
+
+    def __init__(self, kind, connection, timestamp, request_id=None, method=None, payload=None,
+                 attachments=None, size=0):
+        self.kind = kind
+        self.connection = connection
+        self.timestamp = timestamp
+        self.request_id = request_id
+        self.method = method
+        self.payload = payload
+        self.attachments = attachments if attachments is not None else []
+        self.size = size
+
+
+class CaptureWriter(object):
+    """
+    Appends the frames received and sent by a server to a capture log, to replay
+    the traffic later with mcssl.replay.
+
+    Requests are written as they were received, with their method, so they can be
+    replayed without being decoded again, responses only with their id and size.
+    Records go through a large write buffer, so capturing a frame costs a copy into
+    the buffer under a lock, and the file is written in big chunks.
+
+    :param path: Path of the capture log, truncated when the capture starts
+    :param buffer_size: Size of the write buffer (int)
+    """
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        """
+        Initialize a CaptureWriter object and start the capture.
+
+        :param path: Path of the capture log
+        :param buffer_size: Size of the write buffer
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.started = time.monotonic_ns()
+        self.file.write(CAPTURE_MAGIC + CAPTURE_HEADER.pack(time.time_ns()))
+        self.records = 0
+
+    def record_header(self, kind, connection, request_id):
+        if request_id is not None:
+            kind |= HAS_REQUEST_ID
+        return RECORD_HEADER.pack(kind, connection, time.monotonic_ns() - self.started,
+                                  request_id if request_id is not None else 0)
+
+    def request(self, connection, method, request_id, payload, attachments=()):
+        """
+        Record a received request.
+
+        :param connection: Number of the connection on the server
+        :param method: Method of the request
+        :param request_id: Id of the request (int or None)
+        :param payload: The encoded message (bytes-like)
+        :param attachments: The attachments of the request
+        """
+        method = (method or '').encode()
+        with self.lock:
+            if self.file is None:
+                return
+            write = self.file.write
+            write(self.record_header(REQUEST_RECORD, connection, request_id))
+            write(METHOD_HEADER.pack(len(method)))
+            write(method)
+            write(SIZE_HEADER.pack(len(payload)))
+            write(payload)
+            write(COUNT_HEADER.pack(len(attachments)))
+            for attachment in attachments:
+                write(SIZE_HEADER.pack(len(attachment)))
+                write(attachment)
+            self.records += 1
+
+    def response(self, connection, request_id, size):
+        """
+        Record a sent response frame.
+
+        :param connection: Number of the connection on the server
+        :param request_id: Id of the request answered (int or None)
+        :param size: Size of the frame, attachments included
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(self.record_header(RESPONSE_RECORD, connection, request_id) + SIZE_HEADER.pack(size))
+            self.records += 1
+
+    def close(self):
+        """
+        Stop the capture and flush the log.
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path):
+    """
+    Read the records of a capture log, in the order they were written.
+
+    :param path: Path of the capture log
+    :return: Generator of CaptureRecord objects
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"Not a capture log: {path}")
+        file.read(CAPTURE_HEADER.size)
+
+        def read(size):
+            data = file.read(size)
+            if len(data) != size:
+                raise EOFError
+            return data
+
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # end of the log, or a record cut by a server that did not stop
+                return
+            kind, connection, timestamp, request_id = RECORD_HEADER.unpack(header)
+            if not kind & HAS_REQUEST_ID:
+                request_id = None
+            kind &= ~HAS_REQUEST_ID
+            try:
+                if kind == RESPONSE_RECORD:
+                    size, = SIZE_HEADER.unpack(read(SIZE_HEADER.size))
+                    yield CaptureRecord(kind, connection, timestamp, request_id, size=size)
+                    continue
+                if kind != REQUEST_RECORD:
+                    raise ValueError(f"Unknown capture record: {kind}")
+                length, = METHOD_HEADER.unpack(read(METHOD_HEADER.size))
+                method = read(length).decode()
+                length, = SIZE_HEADER.unpack(read(SIZE_HEADER.size))
+                payload = read(length)
+                count, = COUNT_HEADER.unpack(read(COUNT_HEADER.size))
+                attachments = []
+                for _ in range(count):
+                    length, = SIZE_HEADER.unpack(read(SIZE_HEADER.size))
+                    attachments.append(read(length))
+            except EOFError:
+                return
+            yield CaptureRecord(kind, connection, timestamp, request_id, method, payload, attachments,
+                                len(payload) + sum(len(attachment) for attachment in attachments))
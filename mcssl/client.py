@@ -1,53 +1,287 @@
+import collections
+import itertools
+import queue
+import select
 import socket
+import threading
+import time
+from concurrent.futures import CancelledError, Future
 from datetime import datetime, timezone
-from .common  import read_socket
-from .message import Message
-from .encoder import Encoder
+from .cache   import make_cache
+from .common  import FrameReader, MAX_FRAME_SIZE, check_max_frame_size, send_frame, set_nodelay, socket_address
+from .message import BATCH_METHOD, CANCEL_METHOD, CREDIT_METHOD, HELLO_METHOD, INVALIDATE_METHOD, METRICS_METHOD, \
+                     PING_METHOD, STREAM_END_METHOD, Message
+from .encoder import Encoder, JSONCodec
+from .interceptor import Call, frame_size, run_after, run_before
 
 from .connection.client import *
 
+# Methods of the messages that are not requests, sent without deadline
+CONTROL_METHODS = (HELLO_METHOD, CREDIT_METHOD, CANCEL_METHOD, PING_METHOD)
+
+
+def metrics_from_response(response_message):
+    """
+    Extract the metrics snapshot from the answer to a metrics request.
+
+    :param response_message: The response Message, None if the connection was closed
+    :return: Dictionary of the metrics
+    """
+    if response_message is None:
+        raise ConnectionError("Connection closed")
+    if response_message.method != METRICS_METHOD:
+        raise Exception(f"Cannot read metrics: {response_message.args[0] if response_message.args else response_message.method}")
+    return response_message.args[0]
+
+
+
+class Batch(object):
+    """
+    Collects the requests made inside a with block and sends them to the server
+    in a single frame when the block exits. Create it with Client.batch().
+
+    :param client: The Client (or AsyncClient) sending the batch
+    """
+
+    def __init__(self, client):
+        """
+        Initialize a Batch object.
+
+        :param client: The Client (or AsyncClient) sending the batch
+        """
+        self.client = client
+        self.messages = []
+        self.result = None
+
+    def add(self, message: Message):
+        """
+        Queue a message, it is sent when the batch is flushed.
+
+        :param message: Message object to be sent
+        """
+        self.messages.append(message)
+
+    def __enter__(self):
+        self.client.current_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.current_batch = None
+        if exc_type is None and self.messages:
+            self.result = self.client.send_batch(self.messages)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.client.current_batch = None
+        if exc_type is None and self.messages:
+            self.result = await self.client.send_batch(self.messages)
+
+
+class ResponseStream(object):
+    """
+    Iterator over the Message chunks streamed by the server in response to a request,
+    created with Client.stream(). Iteration stops at the end of the stream, or after
+    an error Message.
+
+    In pipeline mode the chunks are queued by the reader thread, and the server is
+    granted credit for more chunks as they are consumed, so it never sends more than
+    its stream window ahead of the consumer.
+
+    :param client: The Client receiving the stream
+    :param request_id: The id of the request, None if not pipelined (int)
+    :param credit_batch: Number of consumed chunks acknowledged with one credit message (int)
+    :param request: The request Message, to stop waiting at its deadline when not pipelined
+    """
+
+    def __init__(self, client, request_id=None, credit_batch=8, request=None):
+        """
+        Initialize a ResponseStream object.
+
+        :param client: The Client receiving the stream
+        :param request_id: The id of the request, None if not pipelined
+        :param credit_batch: Number of consumed chunks acknowledged with one credit message
+        :param request: The request Message. Without pipeline mode, waiting for a chunk
+                        past its deadline raises TimeoutError, and the rest of the
+                        stream is dropped when it arrives
+        """
+        self.client = client
+        self.request_id = request_id
+        self.credit_batch = credit_batch
+        self.request = request
+        self.chunks = queue.SimpleQueue()
+        self.consumed = 0
+        self.done = False
+
+    def put(self, message):
+        """
+        Queue a chunk received by the reader thread.
+
+        :param message: The received Message, or an exception if the connection was lost
+        """
+        self.chunks.put(message)
+
+    def grant_credit(self):
+        """
+        Let the server send as many chunks as were consumed since the last credit.
+        """
+        if self.consumed:
+            self.client.send_message(Message(method=CREDIT_METHOD, args=[self.consumed],
+                                             request_id=self.request_id))
+            self.consumed = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+
+        if self.request_id is None:
+            try:
+                message = self.client.receive_response(self.request.remaining() if self.request else None,
+                                                       stream=True)
+            except TimeoutError:
+                self.done = True
+                raise
+            if message is None:
+                message = ConnectionError("Connection closed")
+        else:
+            if self.chunks.empty():
+                # never wait for chunks the server has no credit to send
+                self.grant_credit()
+            message = self.chunks.get()
+
+        if isinstance(message, Exception):
+            self.done = True
+            raise message
+        if message.method == STREAM_END_METHOD:
+            self.done = True
+            raise StopIteration
+        if message.method == 'error':
+            self.done = True
+            return message
+
+        self.consumed += 1
+        if self.request_id is not None and self.consumed >= self.credit_batch:
+            self.grant_credit()
+        return message
+
+
 class Client(object):
     """
     Represents a client that connects to the server and sends/receives messages.
 
-    :param host: Host address of the server (str)
+    :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket (str)
     :param port: Port number of the server (int)
     :param encoder: Encoder instance for encoding/decoding messages
+    :param max_frame_size: Maximum size of a single message frame (int)
+    :param pipeline: Keep many requests in flight on the connection (bool)
+    :param timeout: Seconds to wait for the response to a request, None to wait forever (float)
     """
 
-    def __init__(self, host='localhost', port=10000, encoder=None, connection_type=PlainConnection()):
+    def __init__(self, host='localhost', port=10000, encoder=None, connection_type=PlainConnection(),
+                 max_frame_size=MAX_FRAME_SIZE, pipeline=False, timeout=None):
         """
         Initialize a Client object.
 
-        :param host: Host address of the server
+        :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket
         :param port: Port number of the server
         :param encoder: Encoder instance for encoding/decoding messages
+        :param max_frame_size: Maximum size of a single message frame, at most
+                               MAX_PAYLOAD_SIZE (2 GiB - 1), ValueError is raised above it
+        :param pipeline: If True, requests get an id and do not wait for their response:
+                         registered requests return a Future resolved by a reader thread
+                         when the response with the same id arrives
+        :param timeout: Seconds to wait for the response to a request. Requests get the
+                        matching deadline, so the server drops them once the client gave
+                        up, and waiting longer raises TimeoutError. Pipelined requests
+                        made with request are cancelled on timeout, the Futures returned
+                        by submit are resolved with the error the server sends at the
+                        deadline. None waits forever
         """
         self.host = host
         self.port = port
         self.client_socket = None
+        self.frame_reader = None
+        self.max_frame_size = check_max_frame_size(max_frame_size)
         self.response_handlers = {}
         self.encoder = encoder  # Encoder instance passed as an argument
         self.connection_type = connection_type
 
-    def connect(self):
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}  # request id -> Future
+        self.streams = {}  # request id -> ResponseStream
+        self.destinations = {}  # request id -> destinations of the attachments of the response
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+        self.local = threading.local()  # state of the calling thread, e.g. the batch it collects
+        self.caches = {}  # method -> ResponseCache of the requests registered with cache
+        self.interceptors = []  # Interceptors run around every request, in order
+        self.calls = {}  # request id -> Call of the intercepted requests waiting for their response
+        self.cancelled = {}  # request id -> True for streams, of the cancelled requests not answered yet
+        # True for streams, False for single responses, of the requests without id
+        # that timed out, in order: their late responses are dropped when they arrive
+        self.skipped_responses = collections.deque()
+
+    def connect(self, connected_socket=None):
         """
         Connect to the server at the specified address and port.
-        """
-        # Create a TCP/IP socket
-        self.client_socket = self.connection_type.wrap_socket(
-                            socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        )
-        server_address = (self.host, self.port)
 
-        print(f'Connecting to {server_address[0]} port {server_address[1]}')
+        :param connected_socket: Socket already connected to the server, e.g. returned by
+                                 Server.socketpair, used instead of connecting to the address
+        """
+        family, server_address = socket_address(self.host, self.port)
+        if connected_socket is not None:
+            print('Connecting over a connected socket')
+        elif family == socket.AF_UNIX:
+            print(f'Connecting to {self.host}')
+        else:
+            print(f'Connecting to {server_address[0]} port {server_address[1]}')
 
         try:
-            self.client_socket.connect(server_address)
+            if connected_socket is not None:
+                # the TLS handshake, if any, is done here
+                self.client_socket = self.connection_type.wrap_socket(connected_socket)
+            else:
+                # Create a TCP/IP or Unix domain socket
+                self.client_socket = self.connection_type.wrap_socket(
+                                    socket.socket(family, socket.SOCK_STREAM)
+                                )
+                self.client_socket.connect(server_address)
+            set_nodelay(self.client_socket)
+            self.connection_type.connected(self.client_socket)
+            self.frame_reader = FrameReader(self.client_socket, self.max_frame_size)
         except Exception as e:
             print(f"Failed to connect: {e}")
             raise
 
+        if self.encoder.accepted_codecs[0] != JSONCodec.name:
+            self.negotiate_codec()
+
+        if self.pipeline:
+            self.reader_thread = threading.Thread(target=self.read_responses, daemon=True)
+            self.reader_thread.start()
+
+    def negotiate_codec(self):
+        """
+        Agree on a codec with the server. The connection starts with JSON and the
+        client proposes the codecs accepted by its encoder, in order of preference.
+        Servers that do not know the handshake answer with an error and the
+        connection keeps using JSON.
+        """
+        self.encoder = self.encoder.with_codec(JSONCodec.name)
+        self.send_message(Message(method=HELLO_METHOD, args=self.encoder.accepted_codecs))
+        response_message = self.receive_response(self.timeout)
+
+        if response_message is not None and response_message.method == HELLO_METHOD:
+            self.encoder = self.encoder.with_codec(response_message.args[0])
+        print(f"Using codec {self.encoder.codec.name}")
+
     def register_response_handler(self):
         """
         Register a handler function for a specific response message type.
@@ -60,18 +294,58 @@ class Client(object):
         return decorator
 
 
-    def register_request(self):
+    def add_interceptor(self, interceptor):
+        """
+        Add an interceptor run around every request, after those already added.
+        See Interceptor.
+
+        :param interceptor: Interceptor instance
+        :return: The interceptor
+        """
+        if interceptor.server_only:
+            raise ValueError(f"{type(interceptor).__name__} can only be added to a server")
+        self.interceptors.append(interceptor)
+        return interceptor
+
+    def register_request(self, stream=False, cache=None):
         """
-        Register a request function 
+        Register a request function
 
-        :return: Decorator function that sends the message
+        :param stream: If True, the request is answered by a generator handler and the
+                       decorated function returns a ResponseStream of its chunks. The
+                       response handlers are not invoked for the chunks
+        :param cache: Cache the responses of a request that only depends on its args and
+                      options: True for a ResponseCache with the defaults, a dictionary of
+                      ResponseCache arguments, or a ResponseCache instance. A cached
+                      response is handled without sending the request. Entries are
+                      dropped when the server pushes an invalidation for them, see
+                      Server.invalidate. Error responses are not cached, and requests
+                      made in a batch always go to the server
+        :return: Decorator function that sends the message. In pipeline mode the
+                 decorated function returns the Future of the response
         """
         def decorator(func):
+            response_cache = make_cache(cache)
+            if response_cache is not None:
+                self.caches[func.__name__] = response_cache
+            else:
+                self.caches.pop(func.__name__, None)
+
             def wrapper(*args,**kwargs):
                 can_run = func(*args,**kwargs)
                 if can_run:
-                    self.send_message(Message(method=func.__name__,args=args,options=kwargs))
-                    response_message = self.receive_response()
+                    message = Message(method=func.__name__,args=args,options=kwargs)
+                    if stream:
+                        return self.stream(message)
+                    if self.current_batch is not None:
+                        self.current_batch.add(message)
+                        return can_run
+                    if response_cache is not None:
+                        return self.request_cached(response_cache, message, can_run)
+                    if self.pipeline:
+                        return self.submit(message)
+                    self.send_message(message)
+                    response_message = self.receive_response(self.timeout)
                     if response_message:
                         self.handle_response(response_message)
                 else:
@@ -80,45 +354,559 @@ class Client(object):
             return wrapper
         return decorator
 
+    def request(self, message: Message, timeout=None) -> Message:
+        """
+        Send a request and wait for its response, which is handled as usual.
+
+        :param message: Message object to be sent
+        :param timeout: Seconds to wait for the response, None for the timeout of the client.
+                        A deadline already set on the message is kept
+        :return: The response Message, None if the connection was closed
+        """
+        wait = self.request_timeout(message, timeout)
+        if self.pipeline:
+            future = self.submit(message)
+            try:
+                return future.result(wait)
+            except TimeoutError:
+                if not self.cancel(message.request_id):
+                    # answered in the meantime
+                    return future.result()
+                raise TimeoutError(f"No response to {message.method} in {wait:.3f} seconds") from None
+
+        self.send_message(message)
+        response_message = self.receive_response(wait)
+        if response_message:
+            self.handle_response(response_message)
+        return response_message
+
+    def request_timeout(self, message, timeout=None):
+        """
+        Give a request the deadline of a timeout, unless it already has one.
+
+        :param message: The request Message
+        :param timeout: Seconds to wait for the response, None for the timeout of the client
+        :return: Seconds to wait for the response, None to wait forever
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None and message.deadline is None:
+            message.deadline = time.monotonic_ns() + int(timeout * 10**9)
+        return message.remaining()
+
+    def cancel(self, request_id):
+        """
+        Give up on a pipelined request: its Future fails with CancelledError, or its
+        stream raises it, and the server is told to drop the request. The response the
+        server may still send is ignored.
+
+        :param request_id: The id of the request
+        :return: False if the request was already answered
+        """
+        with self.pending_lock:
+            future = self.pending_requests.pop(request_id, None)
+            response_stream = self.streams.pop(request_id, None)
+            if future is None and response_stream is None:
+                return False
+            self.cancelled[request_id] = response_stream is not None
+            self.destinations.pop(request_id, None)
+            call = self.calls.pop(request_id, None)
+
+        try:
+            self.send_message(Message(method=CANCEL_METHOD, request_id=request_id))
+        except OSError:
+            # the connection is lost, the server drops the request anyway
+            pass
+        error = CancelledError(f"Request {request_id} cancelled")
+        if call is not None:
+            call.error = error
+            run_after(self.interceptors, call)
+        if future is not None:
+            future.set_exception(error)
+        if response_stream is not None:
+            response_stream.put(error)
+        return True
+
+    def ping(self, timeout=None):
+        """
+        Check that the connection is alive with a round trip to the server.
+
+        :param timeout: Seconds to wait for the answer, None to wait forever
+        :return: True if the server answered. Servers that do not know the ping
+                 answer with an error, which also proves the connection works
+        """
+        if not self.client_socket:
+            return False
+        if self.reader_thread is not None and not self.reader_thread.is_alive():
+            # the reader thread stops when the connection is lost
+            return False
+
+        message = Message(method=PING_METHOD)
+        try:
+            if self.pipeline:
+                future = self.submit(message)
+                try:
+                    response_message = future.result(timeout)
+                finally:
+                    with self.pending_lock:
+                        self.pending_requests.pop(message.request_id, None)
+            else:
+                self.client_socket.settimeout(timeout)
+                try:
+                    self.send_message(message)
+                    response_message = self.receive_response()
+                finally:
+                    self.client_socket.settimeout(None)
+        except Exception as e:
+            print(f"Ping failed: {e}")
+            return False
+        return response_message is not None
+
+    def metrics(self):
+        """
+        Read the metrics of the server, see Server.metrics_snapshot.
+
+        :return: Dictionary of the metrics
+        """
+        return metrics_from_response(self.request(Message(method=METRICS_METHOD)))
+
+    def request_cached(self, response_cache, message, can_run=True):
+        """
+        Answer a request from the cache of its method, or send it and cache its response.
+
+        :param response_cache: The ResponseCache of the method
+        :param message: Message object to be sent
+        :param can_run: Value returned when not in pipeline mode
+        :return: In pipeline mode the Future of the response, else can_run
+        """
+        if not self.pipeline:
+            # invalidations pushed since the last request must apply before the lookup
+            self.poll_pushes()
+
+        key = response_cache.key(message)
+        cached = response_cache.get(key)
+        if cached is not None:
+            self.handle_response(cached)
+            if self.pipeline:
+                future = Future()
+                future.set_result(cached)
+                return future
+            return can_run
+
+        # a response invalidated while the request was in flight is not stored
+        generation = response_cache.generation
+        if self.pipeline:
+            def store(done):
+                if not done.exception() and done.result().method != 'error':
+                    response_cache.put(key, done.result(), generation=generation)
+            future = self.submit(message)
+            future.add_done_callback(store)
+            return future
+
+        self.send_message(message)
+        response_message = self.receive_response(self.timeout)
+        if response_message:
+            if response_message.method != 'error':
+                response_cache.put(key, response_message, generation=generation)
+            self.handle_response(response_message)
+        return can_run
+
+    def invalidate(self, method, *args, **options):
+        """
+        Remove cached responses of a method from the cache of the client.
+
+        :param method: Name of the request method
+        :param args: Positional arguments of the request whose response is removed
+        :param options: Keyword arguments of the request whose response is removed. Without
+                        args nor options all the responses of the method are removed
+        :return: The number of removed responses
+        """
+        response_cache = self.caches.get(method)
+        if response_cache is None:
+            return 0
+        if args or options:
+            return response_cache.invalidate(list(args), options)
+        return response_cache.invalidate()
+
+    def invalidate_pushed(self, message):
+        """
+        Apply an invalidation pushed by the server, see Server.invalidate.
+
+        :param message: The received invalidation Message, its args are the method and,
+                        when only the responses of one request changed, its args and options
+        """
+        if len(message.args) > 1:
+            method, args, options = message.args
+            return self.invalidate(method, *args, **options)
+        return self.invalidate(message.args[0])
+
+    def cache_stats(self):
+        """
+        :return: Dictionary of the hit/miss counters of the cache of every cached request
+        """
+        return {method: response_cache.stats() for method, response_cache in self.caches.items()}
+
+    def poll_pushes(self):
+        """
+        Handle the messages pushed by the server that are already received, without
+        blocking. Only needed without pipeline mode, where nothing reads the
+        connection between requests.
+        """
+        if not self.client_socket:
+            return
+        while self.readable(0):
+            frame = self.frame_reader.read_frame(self.destinations)
+            if frame is None:
+                return
+            self.handle_response(self.decode_response(frame))
+
+    @property
+    def current_batch(self):
+        """
+        :return: The Batch collecting the requests of the calling thread, None outside a batch
+        """
+        return getattr(self.local, 'batch', None)
+
+    @current_batch.setter
+    def current_batch(self, batch):
+        self.local.batch = batch
+
+    def batch(self):
+        """
+        Send the requests made inside a with block in a single frame, e.g.
+
+            with client.batch() as batch:
+                add(1, 2)
+                add(3, 4)
+
+        The server answers all of them in a single frame and the response handlers
+        are invoked in the order of the requests. After the block, batch.result is the
+        list of the response Messages, or in pipeline mode a Future resolved with it.
+        Only the requests made by the thread running the block are batched, other
+        threads sharing the client send theirs as usual. An AsyncClient batch is used
+        with async with, and only batches the requests of the task running the block.
+
+        :return: Batch context manager
+        """
+        return Batch(self)
+
+    def send_batch(self, messages):
+        """
+        Send many messages in a single frame and receive their responses.
+
+        :param messages: The Message objects to send, in order
+        :return: List of the response Messages, or in pipeline mode a Future resolved with it
+        """
+        batch_message = Message.batch(messages)
+        if self.pipeline:
+            future = Future()
+
+            def unbatch(done):
+                if done.exception():
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(done.result().unbatch())
+            self.submit(batch_message).add_done_callback(unbatch)
+            return future
+
+        self.send_message(batch_message)
+        response_message = self.receive_response(self.timeout)
+        if response_message is None:
+            return []
+        self.handle_response(response_message)
+        return response_message.unbatch()
+
+    def stream(self, message: Message, credit_batch=8) -> ResponseStream:
+        """
+        Send a request answered by a generator handler and iterate over the chunks
+        of the response as they arrive. Without pipeline mode the whole stream must be
+        consumed before sending another request.
+
+        :param message: Message object to be sent, its request_id is assigned here in pipeline mode
+        :param credit_batch: Number of consumed chunks acknowledged with one credit message
+        :return: ResponseStream yielding the response Messages
+        """
+        if not self.pipeline:
+            self.send_message(message)
+            return ResponseStream(self, request=message)
+
+        message.request_id = next(self.request_ids)
+        response_stream = ResponseStream(self, message.request_id, credit_batch)
+        with self.pending_lock:
+            self.streams[message.request_id] = response_stream
+
+        try:
+            self.send_message(message)
+        except Exception:
+            with self.pending_lock:
+                self.streams.pop(message.request_id, None)
+            raise
+        return response_stream
+
+    def fetch(self, message: Message, destinations):
+        """
+        Send a request and receive the attachments of its response straight into files,
+        without holding them in memory. The response handler is invoked as usual and
+        the received attachments are FileAttachment objects.
+
+        :param message: Message object to be sent
+        :param destinations: List with, for each attachment of the response, the path of
+                             the file to write or a binary file object opened for writing.
+                             None keeps the attachment in memory
+        :return: The response Message, or in pipeline mode its Future
+        """
+        if self.pipeline:
+            return self.submit(message, destinations=destinations)
+
+        self.destinations[None] = destinations
+        try:
+            self.send_message(message)
+            response_message = self.receive_response(self.timeout)
+        finally:
+            self.destinations.pop(None, None)
+        if response_message:
+            self.handle_response(response_message)
+        return response_message
+
+    def submit(self, message: Message, callback=None, destinations=None) -> Future:
+        """
+        Send a request without waiting for its response. Only available in pipeline mode.
+
+        :param message: Message object to be sent, its request_id is assigned here
+        :param callback: Optional function called with the response Message
+        :param destinations: Optional files to receive the attachments of the response into,
+                             see Client.fetch
+        :return: Future resolved with the response Message, or failed with the error
+                 raised if the request could not be sent
+        """
+        if not self.pipeline:
+            raise RuntimeError("submit is only available in pipeline mode")
+
+        future = Future()
+        if callback:
+            future.add_done_callback(lambda done: done.exception() or callback(done.result()))
+
+        message.request_id = next(self.request_ids)
+        with self.pending_lock:
+            self.pending_requests[message.request_id] = future
+            if destinations is not None:
+                self.destinations[message.request_id] = destinations
+
+        try:
+            self.send_message(message)
+        except Exception as e:
+            with self.pending_lock:
+                self.pending_requests.pop(message.request_id, None)
+                self.destinations.pop(message.request_id, None)
+            future.set_exception(e)
+        return future
+
+    def read_responses(self):
+        """
+        Read responses from the server and resolve the pending requests by their id.
+        Runs in the reader thread in pipeline mode until the connection is closed.
+        """
+        error = ConnectionError("Connection closed")
+        try:
+            while True:
+                response_message = self.receive_response()
+                if response_message is None:
+                    break
+
+                with self.pending_lock:
+                    stream = self.cancelled.get(response_message.request_id)
+                    if stream is not None:
+                        # answers a cancelled request, until the end of its stream
+                        if not stream or response_message.method in (STREAM_END_METHOD, 'error'):
+                            del self.cancelled[response_message.request_id]
+                        continue
+                    response_stream = self.streams.get(response_message.request_id)
+                    if response_stream is not None and response_message.method in (STREAM_END_METHOD, 'error'):
+                        del self.streams[response_message.request_id]
+                    future = self.pending_requests.pop(response_message.request_id, None)
+
+                if response_stream is not None:
+                    response_stream.put(response_message)
+                    continue
+
+                if future is None:
+                    print("No pending request for response id:", response_message.request_id)
+                    self.handle_response(response_message)
+                    continue
+
+                try:
+                    self.handle_response(response_message)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(response_message)
+        except Exception as e:
+            error = e
+        finally:
+            with self.pending_lock:
+                pending, self.pending_requests = self.pending_requests, {}
+                streams, self.streams = self.streams, {}
+            for future in pending.values():
+                future.set_exception(error)
+            for response_stream in streams.values():
+                response_stream.put(error)
+
     def send_message(self, message: Message):
         """
         Send a message to the connected server.
 
         :param message: Message object to be sent
+        :raise ConnectionError: If the client is not connected
         """
         if not self.client_socket:
-            print("Client is not connected.")
-            return
+            raise ConnectionError("Client is not connected")
 
-        # Encode the message before sending it
-        encoded_data = self.encoder.encode_message(message.to_json())
+        encoded_data = self.encode_request(message)
         try:
-            self.client_socket.sendall(encoded_data)
+            with self.send_lock:
+                send_frame(self.client_socket, encoded_data, self.max_frame_size, message.request_id,
+                           message.attachments)
         except Exception as e:
             print(f"Failed to send message: {e}")
+            self.abandon_call(message.request_id, e)
+            raise
+
+    def encode_request(self, message: Message):
+        """
+        Run the before hooks of the interceptors on a message about to be sent and
+        encode it. The Call of the request is kept until its response is received.
+
+        :param message: Message object to be sent. Requests get the deadline of the
+                        timeout of the client, if they have none
+        :return: The encoded message (bytes)
+        """
+        if message.method not in CONTROL_METHODS:
+            self.request_timeout(message)
+        if not self.interceptors or message.method in (HELLO_METHOD, CREDIT_METHOD, CANCEL_METHOD):
+            return self.encoder.encode(message)
 
-    def receive_response(self) -> Message:
+        call = Call(message, (self.host, self.port))
+        run_before(self.interceptors, call)
+        encoded_data = self.encoder.encode(message)
+        call.request_size = frame_size(encoded_data, message.attachments)
+        with self.pending_lock:
+            self.calls[message.request_id] = call
+        return encoded_data
+
+    def abandon_call(self, request_id, error):
+        """
+        Run the after hooks of the interceptors on a request that could not be sent.
+
+        :param request_id: The id of the request
+        :param error: The exception raised while sending it
+        """
+        with self.pending_lock:
+            call = self.calls.pop(request_id, None)
+        if call is not None:
+            call.error = error
+            run_after(self.interceptors, call)
+
+    def finish_call(self, response_message, frame):
+        """
+        Run the after hooks of the interceptors on the request a response answers.
+
+        :param response_message: The received Message
+        :param frame: Tuple of the request id, payload and attachments of the frame
+        """
+        if response_message.method == INVALIDATE_METHOD and response_message.request_id is None:
+            return
+        with self.pending_lock:
+            call = self.calls.pop(response_message.request_id, None)
+        if call is None:
+            # a later chunk of a stream
+            return
+        call.response = response_message
+        call.response_size = frame_size(frame[1], frame[2])
+        run_after(self.interceptors, call)
+
+    def readable(self, timeout=None):
+        """
+        Wait until a frame can be read from the connection.
+
+        :param timeout: Seconds to wait, None to wait forever
+        :return: True if received data is waiting to be read
+        """
+        return self.frame_reader.buffered() > 0 or \
+            (hasattr(self.client_socket, 'pending') and self.client_socket.pending() > 0) or \
+            bool(select.select([self.client_socket], [], [], timeout)[0])
+
+    def receive_response(self, timeout=None, stream=False) -> Message:
         """
         Receive a response from the server.
 
+        Without pipeline mode the response to a request that timed out is dropped
+        when it arrives, up to the end of the stream for a streamed response, so the
+        next response matches the next request.
+
+        :param timeout: Seconds to wait for the response to start arriving, None to wait forever
+        :param stream: True when receiving the chunks of a stream, all dropped on timeout
         :return: Message object created from the received data
         """
         if not self.client_socket:
             print("Client is not connected.")
             return None
 
-        data = read_socket(self.client_socket)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            if deadline is not None and not self.readable(max(0.0, deadline - time.monotonic())):
+                self.skipped_responses.append(stream)
+                raise TimeoutError(f"No response from the server in {timeout:.3f} seconds")
+            frame = self.frame_reader.read_frame(self.destinations)
+            if frame is None:
+                print("Connection closed by server.")
+                return None
+
+            response_message = self.decode_response(frame)
+            if response_message.method == INVALIDATE_METHOD and response_message.request_id is None:
+                # pushed by the server, not a response
+                self.handle_response(response_message)
+                continue
+            if self.skipped_responses and response_message.request_id is None:
+                # the late response to a request that timed out
+                if not self.skipped_responses[0] or response_message.method in (STREAM_END_METHOD, 'error'):
+                    self.skipped_responses.popleft()
+                continue
+            return response_message
+
+    def decode_response(self, frame):
+        """
+        Decode a received frame.
+
+        :param frame: Tuple of the request id, payload and attachments of the frame
+        :return: Message object created from the frame
+        """
+        request_id, data, attachments = frame
 
         # Decode the received message after receiving it completely
-        decoded_data = self.encoder.decode_message(data)
-        return Message.from_json(decoded_data)
+        response_message = self.encoder.decode(data, request_id)
+        if attachments:
+            response_message.attachments = attachments
+        if self.calls:
+            self.finish_call(response_message, frame)
+        return response_message
 
     def handle_response(self, response_message):
         """
         Handle a received response by invoking the registered handler.
 
-        :param response_message: Message object received from server
+        :param response_message: Message object received from server. The responses
+                                 of a batch are handled one by one, in order
         """
+        if response_message.method == BATCH_METHOD:
+            for message in response_message.unbatch():
+                self.handle_response(message)
+            return
+        if response_message.method == INVALIDATE_METHOD:
+            self.invalidate_pushed(response_message)
+            return
+        if response_message.method in (PING_METHOD, METRICS_METHOD):
+            return
+
         handler = self.response_handlers.get(response_message.method)
         if handler:
             handler(response_message)
@@ -132,6 +920,13 @@ class Client(object):
         if self.client_socket:
             print('Closing socket')
             try:
+                self.connection_type.disconnected(self.client_socket)
+                if self.reader_thread:
+                    if self.reader_thread.is_alive():
+                        # wakes up the reader thread blocked on the socket
+                        self.client_socket.shutdown(socket.SHUT_RDWR)
+                    self.reader_thread.join()
+                    self.reader_thread = None
                 self.client_socket.close()
             except Exception as e:
                 print(f"Failed to close socket: {e}")
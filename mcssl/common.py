@@ -1,27 +1,758 @@
-import io 
+import asyncio
+import contextlib
+import mmap
+import os
+import socket
+import ssl
+import stat
+import struct
 
-def read_socket(in_socket,size=1024):
+# Every frame starts with the length of its payload as an unsigned 32 bit
+# big endian integer, followed by the id of the request the frame belongs to
+# (0 for frames that are not part of a pipelined request)
+FRAME_HEADER = struct.Struct('!IQ')
+
+# Set in the length of frames carrying binary attachments. The header is then
+# followed by the number of attachments, as an unsigned 32 bit big endian
+# integer, and their sizes, as unsigned 64 bit big endian integers. The raw
+# attachments follow the payload
+ATTACHMENTS_FLAG = 0x80000000
+ATTACHMENT_COUNT = struct.Struct('!I')
+ATTACHMENT_SIZE = struct.Struct('!Q')
+
+# Maximum number of buffers passed to a single sendmsg call
+MAX_SEND_BUFFERS = 1024
+
+# Size of the chunks in which files are sent over SSL and received
+FILE_CHUNK_SIZE = 256 * 1024
+
+# Default limit for the payload of a single frame (16 MiB)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Highest limit for the payload of a single frame, its length must leave ATTACHMENTS_FLAG clear
+MAX_PAYLOAD_SIZE = ATTACHMENTS_FLAG - 1
+
+# Hosts starting with this prefix are paths of Unix domain sockets, e.g. unix:///run/app.sock
+UNIX_SCHEME = 'unix://'
+
+
+def unix_path(host):
+    """
+    Get the path of a Unix domain socket address.
+
+    :param host: Host address, unix:// followed by the path for Unix domain sockets
+    :return: The path of the socket, None for TCP hosts
+    """
+    if isinstance(host, str) and host.startswith(UNIX_SCHEME):
+        return host[len(UNIX_SCHEME):]
+    return None
+
+
+def socket_address(host, port):
+    """
+    Get the socket family and address of a host, see unix_path.
+
+    :param host: Host address or unix:// path
+    :param port: Port number, ignored for Unix domain sockets
+    :return: Tuple of the address family and the address to bind or connect to
+    """
+    path = unix_path(host)
+    if path is not None:
+        return socket.AF_UNIX, path
+    return socket.AF_INET, (host, port)
+
+
+def set_nodelay(connection):
+    """
+    Disable Nagle's algorithm on a TCP connection. Frames are written with several
+    sends (header, payload, TLS records), and with Nagle's algorithm the last
+    segment of a frame waits for the peer to acknowledge the previous ones, which
+    a delayed ACK holds back for up to 40 ms. Other sockets are left unchanged.
+
+    :param connection: The connected socket
+    """
+    if connection.family in (socket.AF_INET, socket.AF_INET6):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def remove_stale_socket(path):
+    """
+    Remove the socket file left by a server that is not running anymore, so the
+    path can be bound again. Sockets a server still listens on and other files
+    are left alone and make bind fail.
+
+    :param path: Path of the Unix domain socket
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+def remove_socket_file(host):
+    """
+    Remove the file of the Unix domain socket a server listens on, when it stops,
+    so the path does not point to a closed socket. Does nothing for TCP hosts.
+
+    :param host: Host address of the server, see unix_path
+    """
+    path = unix_path(host)
+    if path is None:
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class FrameError(Exception):
+    """
+    Raised when a frame violates the framing protocol, e.g. it exceeds the
+    maximum frame size or the peer closes the connection in the middle of it.
+    """
+
+
+class FileAttachment(object):
+    """
+    An attachment backed by a region of a file. It is sent straight from the file
+    with socket.sendfile, so handlers can serve files without reading them into
+    memory, and it is also how attachments received into a file are returned.
+
+    :param file: Path of the file, or binary file object opened for reading. File
+                 objects are not closed once sent
+    :param offset: Position of the region in the file (int)
+    :param length: Size of the region, None for the rest of the file (int)
+    """
+
+    def __init__(self, file, offset=0, length=None):
+        """
+        Initialize a FileAttachment object.
+
+        :param file: Path of the file, or binary file object opened for reading
+        :param offset: Position of the region in the file
+        :param length: Size of the region, None for the rest of the file
+        """
+        self.file = file
+        self.offset = offset
+        if length is None:
+            if isinstance(file, (str, os.PathLike)):
+                length = os.stat(file).st_size - offset
+            else:
+                length = os.fstat(file.fileno()).st_size - offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def open(self):
+        """
+        :return: Context manager giving the binary file object, files opened from a
+                 path are closed on exit
+        """
+        if isinstance(self.file, (str, os.PathLike)):
+            return open(self.file, 'rb')
+        return contextlib.nullcontext(self.file)
+
+    def read(self):
+        """
+        Read the region of the file into memory.
+
+        :return: bytes
+        """
+        with self.open() as file:
+            file.seek(self.offset)
+            return file.read(self.length)
+
+    def __repr__(self):
+        return f"FileAttachment(file={self.file!r}, offset={self.offset}, length={self.length})"
+
+
+def check_max_frame_size(max_frame_size):
+    """
+    Check a frame size limit: the length of a payload is sent in 31 bits, the
+    highest bit of the length field flags the frames carrying attachments.
+
+    :param max_frame_size: the maximum allowed size of a frame (int)
+    :return: max_frame_size
+    :raises ValueError: if the limit is above MAX_PAYLOAD_SIZE
+    """
+    if max_frame_size > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"max_frame_size cannot exceed {MAX_PAYLOAD_SIZE} bytes")
+    return max_frame_size
+
+
+def encode_frame(payload, max_frame_size=MAX_FRAME_SIZE, request_id=None, attachments=()):
+    """
+    Build the frame header for the given payload.
+
+    :param payload: the payload of the frame (bytes-like)
+    :param max_frame_size: the maximum allowed size of the payload and of the
+                           attachments not backed by a file
+    :param request_id: the id of the request the frame belongs to (int or None)
+    :param attachments: the attachments following the payload, as returned by attachment_views
+    :return: the packed frame header (bytes)
+    """
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise FrameError(f"Payload of {len(payload)} bytes exceeds the maximum of {MAX_PAYLOAD_SIZE} bytes")
+    size = len(payload) + sum(len(attachment) for attachment in attachments
+                              if not isinstance(attachment, FileAttachment))
+    if size > max_frame_size:
+        raise FrameError(f"Frame of {size} bytes exceeds the maximum of {max_frame_size} bytes")
+    if not attachments:
+        return FRAME_HEADER.pack(len(payload), request_id or 0)
+
+    return FRAME_HEADER.pack(len(payload) | ATTACHMENTS_FLAG, request_id or 0) \
+        + ATTACHMENT_COUNT.pack(len(attachments)) \
+        + struct.pack(f'!{len(attachments)}Q', *[len(attachment) for attachment in attachments])
+
+
+def attachment_views(attachments):
+    """
+    Get flat byte views of attachments, without copying them.
+
+    :param attachments: bytes, bytearray, memoryview or other buffer protocol objects,
+                        or FileAttachment objects
+    :return: list of memoryview objects of format 'B', and of the FileAttachment objects
+    """
+    return [attachment if isinstance(attachment, FileAttachment) else memoryview(attachment).cast('B')
+            for attachment in attachments]
+
+
+def sendmsg_all(out_socket, buffers):
+    """
+    Send all the buffers with scatter-gather sendmsg calls, so they are not
+    joined in a single copy.
+
+    :param out_socket: the socket to write
+    :param buffers: list of memoryview objects of format 'B'
+    """
+    while buffers:
+        sent = out_socket.sendmsg(buffers[:MAX_SEND_BUFFERS])
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def send_buffers(out_socket, buffers):
+    """
+    Send all the buffers, with sendmsg if the socket supports it.
+
+    :param out_socket: the socket to write
+    :param buffers: list of memoryview objects of format 'B'
+    """
+    if isinstance(out_socket, ssl.SSLSocket) or not hasattr(out_socket, 'sendmsg'):
+        # SSL sockets do not implement sendmsg
+        for buffer in buffers:
+            out_socket.sendall(buffer)
+    else:
+        sendmsg_all(out_socket, buffers)
+
+
+def send_file(out_socket, attachment):
+    """
+    Send the region of a file. Plain sockets use socket.sendfile, so the kernel
+    copies the file to the socket, SSL sockets are written in chunks from a
+    memory map of the file.
+
+    :param out_socket: the socket to write
+    :param attachment: the FileAttachment to send
+    """
+    if not attachment.length:
+        return
+
+    with attachment.open() as file:
+        if not isinstance(out_socket, ssl.SSLSocket):
+            out_socket.sendfile(file, attachment.offset, attachment.length)
+            return
+
+        # memory maps must start at a multiple of the allocation granularity
+        start = attachment.offset - attachment.offset % mmap.ALLOCATIONGRANULARITY
+        end = attachment.offset - start + attachment.length
+        with mmap.mmap(file.fileno(), end, offset=start, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for position in range(attachment.offset - start, end, FILE_CHUNK_SIZE):
+                    with view[position:min(position + FILE_CHUNK_SIZE, end)] as chunk:
+                        out_socket.sendall(chunk)
+
+
+def send_frame(out_socket, payload, max_frame_size=MAX_FRAME_SIZE, request_id=None, attachments=()):
+    """
+    Sends the payload prefixed with its frame header on out_socket
+
+    :param out_socket: the socket to write
+    :param payload: the payload of the frame (bytes-like)
+    :param max_frame_size: the maximum allowed size of the payload and of the
+                           attachments not backed by a file
+    :param request_id: the id of the request the frame belongs to (int or None)
+    :param attachments: buffer protocol objects sent as they are after the payload,
+                        or FileAttachment objects sent from their file
+    """
+    if attachments:
+        views = attachment_views(attachments)
+        buffers = [memoryview(encode_frame(payload, max_frame_size, request_id, views)),
+                   memoryview(payload).cast('B')]
+        for view in views:
+            if isinstance(view, FileAttachment):
+                send_buffers(out_socket, buffers)
+                buffers = []
+                send_file(out_socket, view)
+            else:
+                buffers.append(view)
+        send_buffers(out_socket, buffers)
+        return
+
+    header = encode_frame(payload, max_frame_size, request_id)
+
+    # small frames are joined so they leave in a single segment, large ones
+    # are sent as they are to avoid copying the payload
+    if len(payload) <= 4096:
+        out_socket.sendall(header + payload)
+    else:
+        out_socket.sendall(header)
+        out_socket.sendall(payload)
+
+
+def frame_buffers(payload, max_frame_size=MAX_FRAME_SIZE, request_id=None, attachments=()):
     """
-    Reads the data from the in_socket in blocks of 'size' into a BytesIO
+    Build the frame of a payload as a list of buffers, for sockets whose writes are
+    queued until they are writable. File attachments are read into memory.
+
+    :param payload: the payload of the frame (bytes-like)
+    :param max_frame_size: the maximum allowed size of the payload and of the
+                           attachments not backed by a file
+    :param request_id: the id of the request the frame belongs to (int or None)
+    :param attachments: buffer protocol objects or FileAttachment objects
+    :return: list of memoryview objects of format 'B'
+    """
+    views = attachment_views(attachments)
+    header = encode_frame(payload, max_frame_size, request_id, views)
+    if not views and len(payload) <= 4096:
+        return [memoryview(header + payload)]
+
+    buffers = [memoryview(header), memoryview(payload).cast('B')]
+    buffers.extend(memoryview(view.read()) if isinstance(view, FileAttachment) else view for view in views)
+    return buffers
+
+
+def open_destination(destination):
+    """
+    Open the destination of an attachment received into a file.
+
+    :param destination: Path of the file, or binary file object opened for writing
+    :return: tuple of a context manager giving the binary file object, and of the
+             position the attachment is written at
+    """
+    if isinstance(destination, (str, os.PathLike)):
+        return open(destination, 'wb'), 0
+    return contextlib.nullcontext(destination), destination.tell()
+
+
+class FrameReader(object):
+    """
+    Reads length-prefixed frames from a socket.
+
+    Data is received with recv_into into a reusable buffer, so several small
+    frames arriving together cost a single syscall. Frames that do not fit in
+    the buffer, and attachments, are received directly into a bytearray of the
+    exact size.
 
     :param in_socket: the socket to read
-    :param size: the size of the block to read
-    :return: the value of the BytesIO buffer
+    :param max_frame_size: the maximum allowed payload size (int)
+    :param buffer_size: the size of the reusable receive buffer (int)
     """
 
-    # create the buffer
-    buf = io.BytesIO()
-    done = False
+    def __init__(self, in_socket, max_frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024):
+        """
+        Initialize a FrameReader object.
+
+        :param in_socket: the socket to read
+        :param max_frame_size: the maximum allowed payload size
+        :param buffer_size: the size of the reusable receive buffer
+        """
+        self.socket = in_socket
+        self.max_frame_size = check_max_frame_size(max_frame_size)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.file_buffer = None  # chunk buffer of the attachments received into files
+
+    def buffered(self):
+        """
+        :return: the number of received bytes not consumed yet
+        """
+        return self.end - self.start
+
+    def _compact(self):
+        """
+        Move the bytes not consumed yet to the beginning of the buffer.
+        """
+        pending = self.end - self.start
+        self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
 
-    while not done:
-        # read the data
-        data = in_socket.recv(size)
-        if len(data) < size:
-            done=True
+    def _fill(self):
+        """
+        Receive more data at the end of the buffer, compacting it first if
+        there is no room left.
 
-        # append the data
-        buf.write(data)
+        :return: the number of bytes received, 0 at end of stream
+        """
+        if self.end == len(self.buffer):
+            self._compact()
 
-    return buf.getvalue()
+        received = self.socket.recv_into(self.view[self.end:])
+        self.end += received
+        return received
 
+    def read_into(self, target):
+        """
+        Fill target completely with the next bytes of the stream. Already
+        buffered bytes are used first, the rest is received directly into
+        target.
+
+        :param target: a writable bytes-like object
+        :return: False if the stream ended before any byte was read
+        """
+        target = memoryview(target).cast('B')
+        size = len(target)
+
+        taken = min(size, self.end - self.start)
+        target[:taken] = self.view[self.start:self.start + taken]
+        self.start += taken
+
+        while taken < size:
+            received = self.socket.recv_into(target[taken:])
+            if received == 0:
+                if taken == 0:
+                    return False
+                raise FrameError("Connection closed in the middle of a frame")
+            taken += received
+
+        return True
+
+    def read_exactly(self, size):
+        """
+        Read the given number of bytes into a new bytearray.
+
+        :param size: the number of bytes to read
+        :return: bytearray of the given size
+        """
+        data = bytearray(size)
+        if size and not self.read_into(data):
+            raise FrameError("Connection closed in the middle of a frame")
+        return data
+
+    def read_sizes(self):
+        """
+        Read the attachment sizes following the header of a frame.
+
+        :return: tuple of the sizes of the attachments
+        """
+        count, = ATTACHMENT_COUNT.unpack(self.read_exactly(ATTACHMENT_COUNT.size))
+        if count * ATTACHMENT_SIZE.size > self.max_frame_size:
+            raise FrameError(f"Frame with {count} attachments exceeds the maximum frame size")
+        return struct.unpack(f'!{count}Q', self.read_exactly(count * ATTACHMENT_SIZE.size))
+
+    def read_to_file(self, size, destination):
+        """
+        Receive an attachment straight into a file, in chunks.
+
+        :param size: the size of the attachment
+        :param destination: path of the file, or binary file object opened for writing
+        :return: FileAttachment of the received data
+        """
+        if self.file_buffer is None:
+            self.file_buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+
+        file_context, offset = open_destination(destination)
+        with file_context as file:
+            remaining = size
+            while remaining:
+                chunk = self.file_buffer[:min(remaining, FILE_CHUNK_SIZE)]
+                if not self.read_into(chunk):
+                    raise FrameError("Connection closed in the middle of a frame")
+                file.write(chunk)
+                remaining -= len(chunk)
+        return FileAttachment(destination, offset, size)
+
+    def read_frame(self, destinations=None):
+        """
+        Read the next frame from the socket.
+
+        :param destinations: dictionary mapping request ids (None for messages without
+                             id) to the list of the destinations of the attachments of
+                             the next frame of that request: path or binary file object
+                             to receive the attachment into, or None to keep it in memory.
+                             The entry of the request is removed when its frame is read
+        :return: tuple of the request id (int or None), the payload of the
+                 frame (bytes or bytearray) and the list of its attachments
+                 (bytearray, or FileAttachment if received into a file), None if
+                 the peer closed the connection between two frames
+        """
+        while self.end - self.start < FRAME_HEADER.size:
+            if self._fill() == 0:
+                if self.end == self.start:
+                    return None
+                raise FrameError("Connection closed in the middle of a frame")
+
+        length, request_id = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        self.start += FRAME_HEADER.size
+        request_id = request_id or None
+
+        files = destinations.pop(request_id, ()) if destinations else ()
+        sizes = ()
+        if length & ATTACHMENTS_FLAG:
+            length &= ~ATTACHMENTS_FLAG
+            sizes = self.read_sizes()
+        check_frame_size(length, sizes, files, self.max_frame_size)
+
+        if length > len(self.buffer):
+            # too big for the buffer, receive it in place
+            payload = self.read_exactly(length)
+        else:
+            while self.end - self.start < length:
+                if self.start + length > len(self.buffer):
+                    # make room for the rest of the frame
+                    self._compact()
+                if self._fill() == 0:
+                    raise FrameError("Connection closed in the middle of a frame")
+
+            payload = bytes(self.view[self.start:self.start + length])
+            self.start += length
+
+        # attachments are received in place, never through the buffer
+        attachments = []
+        for index, size in enumerate(sizes):
+            destination = files[index] if index < len(files) else None
+            if destination is None:
+                attachments.append(self.read_exactly(size))
+            else:
+                attachments.append(self.read_to_file(size, destination))
+        return request_id, payload, attachments
+
+
+class FrameParser(object):
+    """
+    Parses frames out of the data received on a non-blocking socket, fed as it
+    arrives, instead of reading them from a blocking socket like FrameReader.
+
+    :param max_frame_size: the maximum allowed size of the payload and attachments of a frame
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Initialize a FrameParser object.
+
+        :param max_frame_size: the maximum allowed size of the payload and attachments of a frame
+        """
+        self.max_frame_size = check_max_frame_size(max_frame_size)
+        self.buffer = bytearray()
+        self.start = 0  # offset of the first byte not parsed yet
+
+    def feed(self, data):
+        """
+        Add received data.
+
+        :param data: the received bytes (bytes-like)
+        """
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        Take the next complete frame out of the received data.
+
+        :return: tuple of the request id (int or None), the payload of the frame (bytes)
+                 and the list of its attachments (bytearray), None if the next frame
+                 is not completely received yet
+        """
+        buffer = self.buffer
+        offset = self.start + FRAME_HEADER.size
+        if len(buffer) < offset:
+            return None
+        length, request_id = FRAME_HEADER.unpack_from(buffer, self.start)
+
+        sizes = ()
+        if length & ATTACHMENTS_FLAG:
+            length &= ~ATTACHMENTS_FLAG
+            if len(buffer) < offset + ATTACHMENT_COUNT.size:
+                return None
+            count, = ATTACHMENT_COUNT.unpack_from(buffer, offset)
+            if count * ATTACHMENT_SIZE.size > self.max_frame_size:
+                raise FrameError(f"Frame with {count} attachments exceeds the maximum frame size")
+            offset += ATTACHMENT_COUNT.size
+            if len(buffer) < offset + count * ATTACHMENT_SIZE.size:
+                return None
+            sizes = struct.unpack_from(f'!{count}Q', buffer, offset)
+            offset += count * ATTACHMENT_SIZE.size
+        # checked before the frame is received, so oversized frames are not buffered
+        check_frame_size(length, sizes, (), self.max_frame_size)
+
+        end = offset + length + sum(sizes)
+        if len(buffer) < end:
+            return None
+
+        payload = bytes(buffer[offset:offset + length])
+        offset += length
+        attachments = []
+        for size in sizes:
+            attachments.append(buffer[offset:offset + size])
+            offset += size
+
+        self.start = end
+        if self.start == len(buffer):
+            buffer.clear()
+            self.start = 0
+        elif self.start > len(buffer) // 2:
+            # drop the parsed frames without moving the data too often
+            del buffer[:self.start]
+            self.start = 0
+        return request_id or None, payload, attachments
+
+
+def check_frame_size(length, sizes, files, max_frame_size):
+    """
+    Check the size of the payload and of the attachments of a frame that are
+    received into memory.
+
+    :param length: the length of the payload
+    :param sizes: the sizes of the attachments
+    :param files: the destinations of the attachments, None for the ones kept in memory
+    :param max_frame_size: the maximum allowed size
+    """
+    size = length + sum(size for index, size in enumerate(sizes)
+                        if index >= len(files) or files[index] is None)
+    if size > max_frame_size:
+        raise FrameError(f"Frame of {size} bytes exceeds the maximum of {max_frame_size} bytes")
+
+
+async def read_to_file_async(reader, size, destination):
+    """
+    Receive an attachment from an asyncio StreamReader straight into a file, in chunks.
+
+    :param reader: the asyncio.StreamReader to read
+    :param size: the size of the attachment
+    :param destination: path of the file, or binary file object opened for writing
+    :return: FileAttachment of the received data
+    """
+    file_context, offset = open_destination(destination)
+    with file_context as file:
+        remaining = size
+        while remaining:
+            chunk = await reader.read(min(remaining, FILE_CHUNK_SIZE))
+            if not chunk:
+                raise FrameError("Connection closed in the middle of a frame")
+            file.write(chunk)
+            remaining -= len(chunk)
+    return FileAttachment(destination, offset, size)
+
+
+async def read_frame_async(reader, max_frame_size=MAX_FRAME_SIZE, destinations=None):
+    """
+    Read the next frame from an asyncio StreamReader.
+
+    :param reader: the asyncio.StreamReader to read
+    :param max_frame_size: the maximum allowed payload size
+    :param destinations: destinations of the attachments by request id, see FrameReader.read_frame
+    :return: tuple of the request id (int or None), the payload of the
+             frame (bytes) and the list of its attachments (bytes, or
+             FileAttachment if received into a file), None if the peer closed
+             the connection between two frames
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise FrameError("Connection closed in the middle of a frame")
+
+    length, request_id = FRAME_HEADER.unpack(header)
+    request_id = request_id or None
+
+    try:
+        files = destinations.pop(request_id, ()) if destinations else ()
+        sizes = ()
+        if length & ATTACHMENTS_FLAG:
+            length &= ~ATTACHMENTS_FLAG
+            count, = ATTACHMENT_COUNT.unpack(await reader.readexactly(ATTACHMENT_COUNT.size))
+            if count * ATTACHMENT_SIZE.size > max_frame_size:
+                raise FrameError(f"Frame with {count} attachments exceeds the maximum frame size")
+            sizes = struct.unpack(f'!{count}Q', await reader.readexactly(count * ATTACHMENT_SIZE.size))
+        check_frame_size(length, sizes, files, max_frame_size)
+
+        payload = await reader.readexactly(length)
+        attachments = []
+        for index, size in enumerate(sizes):
+            destination = files[index] if index < len(files) else None
+            if destination is None:
+                attachments.append(await reader.readexactly(size))
+            else:
+                attachments.append(await read_to_file_async(reader, size, destination))
+        return request_id, payload, attachments
+    except asyncio.IncompleteReadError:
+        raise FrameError("Connection closed in the middle of a frame")
+
+
+def write_frame_async(writer, payload, max_frame_size=MAX_FRAME_SIZE, request_id=None, attachments=()):
+    """
+    Queue the payload prefixed with its frame header on an asyncio StreamWriter.
+    The caller is responsible for awaiting writer.drain(), the attachments must
+    not be modified until then. FileAttachment objects need send_frame_async.
+
+    :param writer: the asyncio.StreamWriter to write
+    :param payload: the payload of the frame (bytes-like)
+    :param max_frame_size: the maximum allowed size of the payload and attachments
+    :param request_id: the id of the request the frame belongs to (int or None)
+    :param attachments: buffer protocol objects sent as they are after the payload
+    """
+    if attachments:
+        views = attachment_views(attachments)
+        if any(isinstance(view, FileAttachment) for view in views):
+            raise ValueError("File attachments must be sent with send_frame_async")
+        writer.writelines([encode_frame(payload, max_frame_size, request_id, views), payload] + views)
+        return
+
+    writer.writelines((encode_frame(payload, max_frame_size, request_id), payload))
+
+
+async def send_frame_async(writer, payload, max_frame_size=MAX_FRAME_SIZE, request_id=None, attachments=()):
+    """
+    Write the payload prefixed with its frame header on an asyncio StreamWriter,
+    sending FileAttachment objects with loop.sendfile. Nothing else may be written
+    on the writer until it returns. The caller is responsible for awaiting
+    writer.drain().
+
+    :param writer: the asyncio.StreamWriter to write
+    :param payload: the payload of the frame (bytes-like)
+    :param max_frame_size: the maximum allowed size of the payload and of the
+                           attachments not backed by a file
+    :param request_id: the id of the request the frame belongs to (int or None)
+    :param attachments: buffer protocol objects sent as they are after the payload,
+                        or FileAttachment objects sent from their file
+    """
+    views = attachment_views(attachments)
+    if not any(isinstance(view, FileAttachment) for view in views):
+        write_frame_async(writer, payload, max_frame_size, request_id, views)
+        return
 
+    writer.writelines((encode_frame(payload, max_frame_size, request_id, views), payload))
+    for view in views:
+        if not isinstance(view, FileAttachment):
+            writer.write(view)
+        elif view.length:
+            await writer.drain()
+            with view.open() as file:
+                await asyncio.get_running_loop().sendfile(writer.transport, file, view.offset, view.length)
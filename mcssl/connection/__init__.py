@@ -1 +1 @@
-from .connection import Connection
+from .connection import Connection, ECDHE_CIPHERS, set_ciphers
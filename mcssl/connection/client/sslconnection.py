@@ -1,22 +1,87 @@
-from mcssl.connection import Connection
+from mcssl.connection import Connection, set_ciphers
 import ssl
+import threading
+import weakref
 
 class SSLConnection(Connection):
-    def __init__(self,cert,cert_hostname):
+    """
+    TLS client connections. With reuse_sessions, the session of the last connection
+    is passed to the next one, so the server can resume it with an abbreviated
+    handshake instead of a full one. TLS 1.3 servers send their session tickets
+    after the handshake, so a session is only available once something was read
+    from a connection. asyncio connections can not resume sessions.
+
+    :param cert: CA certificate file used to verify the server
+    :param cert_hostname: Expected host name of the server certificate
+    :param reuse_sessions: Resume the TLS session of the previous connection (bool)
+    :param ciphers: OpenSSL cipher list of the TLS 1.2 cipher suites, None for the defaults
+    :param ecdhe_only: Only allow ECDHE key exchanges in TLS 1.2 (bool)
+    """
+
+    def __init__(self,cert,cert_hostname,reuse_sessions=True,ciphers=None,ecdhe_only=False):
         self.cert = cert
         self.cert_hostname=cert_hostname
+        self.reuse_sessions = reuse_sessions
 
         self.context = None
         
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         context.verify_mode = ssl.CERT_REQUIRED
         context.load_verify_locations(self.cert)
+        set_ciphers(context, ciphers, ecdhe_only)
 
         self.context = context
 
+        self.lock = threading.Lock()
+        self.session = None
+        self.last_connection = None  # weak reference to the last connected socket
+        self.resumed = 0
+        self.full = 0
+
 
     def wrap_socket(self,client_socket):
-        return self.context.wrap_socket(client_socket,server_hostname=self.cert_hostname)
+        return self.context.wrap_socket(client_socket,server_hostname=self.cert_hostname,
+                                        session=self.current_session())
+
+    def current_session(self):
+        """
+        :return: The SSLSession to resume on the next connection, None for a full handshake
+        """
+        if not self.reuse_sessions:
+            return None
+        with self.lock:
+            connection = self.last_connection() if self.last_connection else None
+        if connection is not None:
+            self.save_session(connection)
+        return self.session
+
+    def save_session(self, connection):
+        """
+        Keep the session of a connection if it can be resumed.
+
+        :param connection: The SSLSocket
+        """
+        try:
+            session = connection.session
+        except (ValueError, OSError):
+            return
+        if session is not None and (session.has_ticket or session.id):
+            with self.lock:
+                self.session = session
 
+    def connected(self, connection):
+        with self.lock:
+            if connection.session_reused:
+                self.resumed += 1
+            else:
+                self.full += 1
+            if isinstance(connection, ssl.SSLSocket):
+                self.last_connection = weakref.ref(connection)
 
+    def disconnected(self, connection):
+        if self.reuse_sessions:
+            self.save_session(connection)
 
+    def stats(self):
+        with self.lock:
+            return {'resumed': self.resumed, 'full': self.full}
@@ -1,8 +1,51 @@
 from abc import ABC, abstractmethod
 
+# TLS 1.2 cipher suites with forward secrecy from an ephemeral elliptic curve key
+# exchange, TLS 1.3 suites always use an ephemeral key exchange
+ECDHE_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+
 class Connection(ABC):
+    # SSLContext used by the connection, None for plain connections
+    context = None
+
     @abstractmethod
     def wrap_socket(self,client_socket):
         pass
 
+    def connected(self, connection):
+        """
+        Called with every established connection, after its handshake. On a server,
+        only with the connections it accepts, not with those rejected over its limit.
+
+        :param connection: The wrapped socket, or the SSLObject of asyncio TLS connections
+        """
+        pass
+
+    def disconnected(self, connection):
+        """
+        Called with every connection about to be closed. On a server, only with the
+        connections it accepted.
+
+        :param connection: The connection passed to connected
+        """
+        pass
+
+    def stats(self):
+        """
+        :return: Dictionary of the counters of the connections
+        """
+        return {}
+
+
+def set_ciphers(context, ciphers=None, ecdhe_only=False):
+    """
+    Restrict the TLS 1.2 cipher suites of a context.
 
+    :param context: The SSLContext
+    :param ciphers: OpenSSL cipher list, None to keep the defaults
+    :param ecdhe_only: Only allow the ECDHE cipher suites of ciphers, or ECDHE_CIPHERS
+    """
+    if ecdhe_only:
+        ciphers = f"{ciphers}:-kRSA:-kDHE:-kPSK" if ciphers else ECDHE_CIPHERS
+    if ciphers:
+        context.set_ciphers(ciphers)
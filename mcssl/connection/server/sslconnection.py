@@ -1,8 +1,26 @@
-from mcssl.connection import Connection
+from mcssl.connection import Connection, set_ciphers
 import ssl
+import sys
+import threading
 
 class SSLConnection(Connection):
-    def __init__(self,cert,key):
+    """
+    TLS server connections. Clients can resume their sessions with an abbreviated
+    handshake from the session tickets sent to them, num_tickets per TLS 1.3
+    connection. Without tickets sessions are not resumed: OpenSSL drops the sessions
+    of its session cache whose connection was closed without a TLS shutdown.
+
+    :param cert: Certificate chain file of the server
+    :param key: Private key file of the server
+    :param session_tickets: Send session tickets to the clients (bool)
+    :param num_tickets: Number of TLS 1.3 session tickets sent per connection (int)
+    :param ciphers: OpenSSL cipher list of the TLS 1.2 cipher suites, None for the defaults
+    :param ecdhe_only: Only allow ECDHE key exchanges in TLS 1.2 (bool)
+    :param curve: Name of the elliptic curve of the ECDHE key exchanges, e.g. 'prime256v1',
+                  None for the defaults
+    """
+
+    def __init__(self,cert,key,session_tickets=True,num_tickets=2,ciphers=None,ecdhe_only=False,curve=None):
         self.cert = cert
         self.key = key
         self.context = None
@@ -13,11 +31,34 @@ class SSLConnection(Connection):
         except ssl.SSLError as e:
             sys.exit('Error in SSL certificate/password')
 
+        if session_tickets:
+            context.num_tickets = num_tickets
+        else:
+            context.options |= ssl.OP_NO_TICKET
+            context.num_tickets = 0
+        set_ciphers(context, ciphers, ecdhe_only)
+        if curve:
+            context.set_ecdh_curve(curve)
+
         self.context = context
 
+        self.lock = threading.Lock()
+        self.resumed = 0
+        self.full = 0
+
 
     def wrap_socket(self,client_socket):
         return self.context.wrap_socket(client_socket, server_side=True)
 
+    def connected(self, connection):
+        with self.lock:
+            if connection.session_reused:
+                self.resumed += 1
+            else:
+                self.full += 1
 
-
+    def stats(self):
+        with self.lock:
+            stats = {'resumed': self.resumed, 'full': self.full}
+        stats['session_stats'] = self.context.session_stats()
+        return stats
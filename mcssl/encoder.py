@@ -1,11 +1,314 @@
+import collections
+import copy
+import json
+import lzma
+import struct
+import threading
+import zlib
+from .common  import FrameError, MAX_FRAME_SIZE
+from .message import Message
+
+# Registered codecs by name, see register_codec
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Register a codec so encoders can use it and negotiate it with the peer.
+
+    A codec has a unique name and turns the dictionary representation of a
+    Message into bytes and back with dumps and loads. It can also implement
+    peek_method, returning the method of an encoded message without decoding
+    the rest, or None when it cannot, to support lazy decoding.
+
+    :param codec: The codec instance to register
+    :return: The registered codec
+    """
+    CODECS[codec.name] = codec
+    return codec
+
+
+class JSONCodec(object):
+    """
+    Encodes messages as UTF-8 JSON text, the default and fallback codec.
+    """
+    name = 'json'
+
+    def dumps(self, data):
+        """
+        :param data: The dictionary representation of a Message
+        :return: The encoded data (bytes)
+        """
+        return json.dumps(data).encode()
+
+    def loads(self, encoded_data):
+        """
+        :param encoded_data: The encoded data (bytes-like)
+        :return: The dictionary representation of a Message
+        """
+        return json.loads(encoded_data)
+
+    # Message.to_dict puts the method first
+    METHOD_PREFIX = b'{"method": "'
+
+    def peek_method(self, encoded_data):
+        """
+        :param encoded_data: The encoded data (bytes or bytearray)
+        :return: The method of the encoded message, None if it cannot be read
+                 without decoding the whole message
+        """
+        start = len(self.METHOD_PREFIX)
+        if encoded_data[:start] != self.METHOD_PREFIX:
+            return None
+        end = encoded_data.find(b'"', start)
+        if end < 0 or encoded_data.find(b'\\', start, end) >= 0:
+            return None
+        return str(encoded_data[start:end], 'utf-8')
+
+
+class BinaryCodec(object):
+    """
+    Encodes messages as compact tagged binary values packed with struct.
+
+    Every value starts with a one byte tag. Integers and floats are packed as
+    8 byte big endian numbers, strings and bytes are prefixed with their length
+    and lists of only floats or only integers are packed as a single array, so
+    numeric payloads need neither text formatting nor parsing.
+    """
+    name = 'binary'
+
+    LENGTH = struct.Struct('!I')
+    INT = struct.Struct('!q')
+    FLOAT = struct.Struct('!d')
+
+    def dumps(self, data):
+        """
+        :param data: The dictionary representation of a Message
+        :return: The encoded data (bytes)
+        """
+        out = bytearray()
+        self._pack(data, out)
+        return bytes(out)
+
+    def loads(self, encoded_data):
+        """
+        :param encoded_data: The encoded data (bytes-like)
+        :return: The dictionary representation of a Message
+        """
+        value, offset = self._unpack(memoryview(encoded_data), 0)
+        return value
+
+    # Message.to_dict puts the method first: a map whose first key is the string 'method'
+    METHOD_KEY = b's\x00\x00\x00\x06method'
+
+    def peek_method(self, encoded_data):
+        """
+        :param encoded_data: The encoded data (bytes-like)
+        :return: The method of the encoded message, None if it cannot be read
+                 without decoding the whole message
+        """
+        data = memoryview(encoded_data)
+        if data[:1] != b'm' or data[5:16] != self.METHOD_KEY or data[16:17] != b's':
+            return None
+        (length,) = self.LENGTH.unpack_from(data, 17)
+        return str(data[21:21 + length], 'utf-8')
+
+    def _pack(self, value, out):
+        kind = type(value)
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif kind is int:
+            if -2**63 <= value < 2**63:
+                out += b'i'
+                out += self.INT.pack(value)
+            else:
+                digits = str(value).encode()
+                out += b'I'
+                out += self.LENGTH.pack(len(digits))
+                out += digits
+        elif kind is float:
+            out += b'd'
+            out += self.FLOAT.pack(value)
+        elif kind is str:
+            encoded = value.encode()
+            out += b's'
+            out += self.LENGTH.pack(len(encoded))
+            out += encoded
+        elif kind in (bytes, bytearray, memoryview):
+            out += b'b'
+            out += self.LENGTH.pack(len(value))
+            out += value
+        elif kind in (list, tuple):
+            if value and all(type(item) is float for item in value):
+                out += b'D'
+                out += self.LENGTH.pack(len(value))
+                out += struct.pack(f'!{len(value)}d', *value)
+            elif value and all(type(item) is int and -2**63 <= item < 2**63 for item in value):
+                out += b'Q'
+                out += self.LENGTH.pack(len(value))
+                out += struct.pack(f'!{len(value)}q', *value)
+            else:
+                out += b'l'
+                out += self.LENGTH.pack(len(value))
+                for item in value:
+                    self._pack(item, out)
+        elif kind is dict:
+            out += b'm'
+            out += self.LENGTH.pack(len(value))
+            for key, item in value.items():
+                self._pack(key, out)
+                self._pack(item, out)
+        else:
+            raise TypeError(f"Object of type {kind.__name__} cannot be encoded by the binary codec")
+
+    def _unpack(self, data, offset):
+        tag = data[offset]
+        offset += 1
+
+        if tag == 0x4e:    # N
+            return None, offset
+        if tag == 0x54:    # T
+            return True, offset
+        if tag == 0x46:    # F
+            return False, offset
+        if tag == 0x69:    # i
+            return self.INT.unpack_from(data, offset)[0], offset + 8
+        if tag == 0x64:    # d
+            return self.FLOAT.unpack_from(data, offset)[0], offset + 8
+
+        (length,) = self.LENGTH.unpack_from(data, offset)
+        offset += 4
+
+        if tag == 0x73:    # s
+            return str(data[offset:offset + length], 'utf-8'), offset + length
+        if tag == 0x62:    # b
+            return bytes(data[offset:offset + length]), offset + length
+        if tag == 0x49:    # I
+            return int(str(data[offset:offset + length], 'ascii')), offset + length
+        if tag == 0x44:    # D
+            return list(struct.unpack_from(f'!{length}d', data, offset)), offset + 8 * length
+        if tag == 0x51:    # Q
+            return list(struct.unpack_from(f'!{length}q', data, offset)), offset + 8 * length
+        if tag == 0x6c:    # l
+            items = []
+            for _ in range(length):
+                item, offset = self._unpack(data, offset)
+                items.append(item)
+            return items, offset
+        if tag == 0x6d:    # m
+            items = {}
+            for _ in range(length):
+                key, offset = self._unpack(data, offset)
+                items[key], offset = self._unpack(data, offset)
+            return items, offset
+
+        raise ValueError(f"Unknown binary codec tag: {tag:#x}")
+
+
+register_codec(JSONCodec())
+register_codec(BinaryCodec())
+
+
 class Encoder(object):
     """
     Provides methods to encode and decode message data.
 
+    :param codec: Name of the registered codec used to encode messages (str)
+    :param accepted_codecs: Names of the codecs this encoder agrees to switch to
+                            during the connection handshake, in order of preference (list)
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, codec='json', accepted_codecs=None):
+        """
+        Initialize an Encoder object.
+
+        :param codec: Name of the registered codec used to encode messages
+        :param accepted_codecs: Names of the codecs this encoder agrees to switch to
+                                during the handshake, None for every registered codec.
+                                JSON is always accepted as the fallback
+        """
+        self.codec = CODECS[codec]
+        if accepted_codecs is None:
+            accepted_codecs = [codec] + [name for name in CODECS if name != codec]
+        self.accepted_codecs = list(accepted_codecs)
+        if JSONCodec.name not in self.accepted_codecs:
+            self.accepted_codecs.append(JSONCodec.name)
+
+    def with_codec(self, codec):
+        """
+        Create a copy of this encoder using another codec, used when the
+        handshake agrees on a codec for a connection.
+
+        :param codec: Name of the registered codec
+        :return: Encoder instance
+        """
+        encoder = copy.copy(self)
+        encoder.codec = CODECS[codec]
+        return encoder
+
+    def for_connection(self):
+        """
+        Get the encoder of a new connection. Encoders keeping per-connection
+        state return a copy, this one is stateless and returns itself.
+
+        :return: Encoder instance
+        """
+        return self
+
+    def choose_codec(self, proposed_codecs):
+        """
+        Pick the codec of a connection among the ones proposed by the client.
+
+        :param proposed_codecs: Codec names in the client's order of preference (list)
+        :return: Name of the first proposed codec this encoder accepts, 'json' if none
+        """
+        for name in proposed_codecs:
+            if name in CODECS and name in self.accepted_codecs:
+                return name
+        return JSONCodec.name
+
+    def encode(self, message):
+        """
+        Encode a Message with the codec of the encoder.
+
+        :param message: The Message to be encoded
+        :return: Encoded message data (bytes)
+        """
+        if self.codec.name == JSONCodec.name:
+            return self.encode_message(message.to_json())
+        return self.codec.dumps(message.to_dict())
+
+    def decode(self, encoded_data, request_id=None, lazy=False):
+        """
+        Decode a Message with the codec of the encoder.
+
+        :param encoded_data: The encoded message data (bytes-like)
+        :param request_id: Id of the request read from the frame header
+        :param lazy: Only decode the method now and the rest of the message on
+                     first access, when the codec supports it
+        :return: Message object
+        """
+        if lazy:
+            peek_method = getattr(self.codec, 'peek_method', None)
+            method = peek_method(encoded_data) if peek_method else None
+            if method is not None:
+                return Message.lazy(method, lambda: self.load(encoded_data), request_id)
+        return Message.from_dict(self.load(encoded_data), request_id)
+
+    def load(self, encoded_data):
+        """
+        Decode the dictionary representation of a Message with the codec of the encoder.
+
+        :param encoded_data: The encoded message data (bytes-like)
+        :return: Dictionary representing the message
+        """
+        if self.codec.name == JSONCodec.name:
+            return json.loads(self.decode_message(encoded_data))
+        return self.codec.loads(encoded_data)
 
     def encode_message(self, message):
         """
@@ -24,3 +327,273 @@ class Encoder(object):
         :return: Decoded message string
         """
         return encoded_data.decode('UTF-8')
+
+
+class CompressionStats(object):
+    """
+    Counts the bytes before and after compression of a CompressingEncoder.
+
+    :param parent: Stats that also receive every count, e.g. the totals of a server (CompressionStats)
+    """
+
+    def __init__(self, parent=None):
+        """
+        Initialize a CompressionStats object.
+
+        :param parent: Stats that also receive every count
+        """
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.compressed_frames = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def record(self, raw_size, wire_size, compressed):
+        """
+        Count one encoded or decoded message.
+
+        :param raw_size: Size of the message before compression
+        :param wire_size: Size of the message as sent on the connection
+        :param compressed: True if the message was compressed
+        """
+        with self.lock:
+            self.frames += 1
+            self.compressed_frames += compressed
+            self.raw_bytes += raw_size
+            self.wire_bytes += wire_size
+        if self.parent is not None:
+            self.parent.record(raw_size, wire_size, compressed)
+
+    def __getstate__(self):
+        """
+        Pickle the counts only, e.g. when the encoder is sent to a process pool worker.
+        """
+        state = self.__dict__.copy()
+        del state['lock']
+        state['parent'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def ratio(self):
+        """
+        :return: The compression ratio achieved, raw bytes / wire bytes (float)
+        """
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def __repr__(self):
+        return (f"CompressionStats(frames={self.frames}, compressed_frames={self.compressed_frames}, "
+                f"raw_bytes={self.raw_bytes}, wire_bytes={self.wire_bytes}, ratio={self.ratio:.2f})")
+
+
+class CompressingEncoder(object):
+    """
+    Wraps an Encoder and compresses the messages it encodes when they reach a
+    size threshold. Both sides of a connection must use a CompressingEncoder
+    configured with the same algorithm and dictionary.
+
+    Every encoded message starts with a flag byte telling whether and how the rest
+    is compressed, so small messages are sent as they are.
+
+    :param encoder: The wrapped Encoder instance
+    :param threshold: Minimum encoded size for a message to be compressed (int)
+    :param algorithm: 'zlib' or 'lzma' (str)
+    :param level: Compression level, 0-9 (int)
+    :param zdict: Preset dictionary for zlib, see train_dictionary (bytes)
+    :param max_frame_size: Maximum size of a decompressed message (int)
+    """
+
+    RAW = 0
+    ZLIB = 1
+    LZMA = 2
+
+    ALGORITHMS = {'zlib': ZLIB, 'lzma': LZMA}
+
+    def __init__(self, encoder=None, threshold=1024, algorithm='zlib', level=6, zdict=None,
+                 max_frame_size=MAX_FRAME_SIZE):
+        """
+        Initialize a CompressingEncoder object.
+
+        :param encoder: The wrapped Encoder instance, a JSON Encoder if None
+        :param threshold: Minimum encoded size for a message to be compressed
+        :param algorithm: 'zlib' or 'lzma'
+        :param level: Compression level, 0-9
+        :param zdict: Preset dictionary for zlib, trained on sample traffic
+        :param max_frame_size: Maximum size of a decompressed message, bigger ones are
+                               rejected with a FrameError before they are fully inflated
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+        if zdict is not None and algorithm != 'zlib':
+            raise ValueError("Preset dictionaries are only supported by zlib")
+
+        self.encoder = encoder if encoder is not None else Encoder()
+        self.threshold = threshold
+        self.algorithm = self.ALGORITHMS[algorithm]
+        self.level = level
+        self.zdict = zdict
+        self.max_frame_size = max_frame_size
+        self.lzma_filters = [{'id': lzma.FILTER_LZMA2, 'preset': level}]
+        self.stats = CompressionStats()
+
+    @property
+    def codec(self):
+        """
+        :return: The codec of the wrapped encoder
+        """
+        return self.encoder.codec
+
+    @property
+    def accepted_codecs(self):
+        """
+        :return: The codecs accepted by the wrapped encoder
+        """
+        return self.encoder.accepted_codecs
+
+    def choose_codec(self, proposed_codecs):
+        """
+        Pick the codec of a connection, see Encoder.choose_codec.
+
+        :param proposed_codecs: Codec names in the client's order of preference (list)
+        :return: Name of the chosen codec
+        """
+        return self.encoder.choose_codec(proposed_codecs)
+
+    def with_codec(self, codec):
+        """
+        Create a copy of this encoder whose wrapped encoder uses another codec.
+        The copy shares the stats of this encoder.
+
+        :param codec: Name of the registered codec
+        :return: CompressingEncoder instance
+        """
+        encoder = copy.copy(self)
+        encoder.encoder = self.encoder.with_codec(codec)
+        return encoder
+
+    def for_connection(self):
+        """
+        Create the encoder of a new connection, with its own stats that are also
+        added to the stats of this encoder.
+
+        :return: CompressingEncoder instance
+        """
+        encoder = copy.copy(self)
+        encoder.stats = CompressionStats(parent=self.stats)
+        return encoder
+
+    def compress(self, data):
+        """
+        :param data: The encoded message
+        :return: The data compressed with the algorithm of the encoder (bytes)
+        """
+        if self.algorithm == self.LZMA:
+            return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.lzma_filters)
+        if self.zdict is None:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.zdict)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, flag, data):
+        """
+        :param flag: The compression flag of the message
+        :param data: The compressed message
+        :return: The decompressed data (bytes)
+        """
+        # one byte more than allowed tells an oversized message from one of the maximum size
+        limit = self.max_frame_size + 1
+        if flag == self.LZMA:
+            decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self.lzma_filters)
+            decompressed = decompressor.decompress(data, max_length=limit)
+        elif flag == self.ZLIB:
+            if self.zdict is None:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            else:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=self.zdict)
+            decompressed = decompressor.decompress(data, limit)
+        else:
+            raise ValueError(f"Unknown compression flag: {flag}")
+
+        if len(decompressed) > self.max_frame_size:
+            raise FrameError(f"Decompressed message exceeds the maximum of {self.max_frame_size} bytes")
+        return decompressed
+
+    def encode(self, message):
+        """
+        Encode a Message with the wrapped encoder and compress it if it is big enough.
+
+        :param message: The Message to be encoded
+        :return: Encoded message data, starting with the compression flag (bytes)
+        """
+        data = self.encoder.encode(message)
+        if len(data) >= self.threshold:
+            compressed = self.compress(data)
+            if len(compressed) < len(data):
+                self.stats.record(len(data), len(compressed) + 1, True)
+                return bytes((self.algorithm,)) + compressed
+
+        self.stats.record(len(data), len(data) + 1, False)
+        return bytes((self.RAW,)) + data
+
+    def decode(self, encoded_data, request_id=None, lazy=False):
+        """
+        Decompress the data if needed and decode it with the wrapped encoder.
+
+        :param encoded_data: The encoded message data, starting with the compression flag
+        :param request_id: Id of the request read from the frame header
+        :param lazy: Decode the message lazily, see Encoder.decode
+        :return: Message object
+        """
+        flag = encoded_data[0]
+        data = bytes(memoryview(encoded_data)[1:])
+        if flag != self.RAW:
+            data = self.decompress(flag, data)
+        self.stats.record(len(data), len(encoded_data), flag != self.RAW)
+        return self.encoder.decode(data, request_id, lazy)
+
+
+def train_dictionary(samples, size=16 * 1024, encoder=None, gram=8):
+    """
+    Build a preset zlib dictionary from sample traffic.
+
+    Each sample is scored by how many of its byte sequences also appear in the
+    other samples. The most typical samples fill the dictionary, the most typical
+    at the end where zlib reaches them with the shortest distances.
+
+    :param samples: Sample Messages, or already encoded messages (bytes)
+    :param size: Maximum size of the dictionary (int)
+    :param encoder: Encoder used to encode Message samples, a JSON Encoder if None
+    :param gram: Length of the byte sequences compared between samples (int)
+    :return: The dictionary (bytes)
+    """
+    encoder = encoder if encoder is not None else Encoder()
+    encoded = []
+    for sample in samples:
+        if isinstance(sample, Message):
+            sample = encoder.encode(sample)
+        encoded.append(bytes(sample))
+
+    # in how many samples each sequence appears
+    counts = collections.Counter()
+    for data in encoded:
+        counts.update({data[i:i + gram] for i in range(len(data) - gram + 1)})
+
+    def typicality(data):
+        grams = len(data) - gram + 1
+        if grams <= 0:
+            return 0
+        return sum(counts[data[i:i + gram]] for i in range(grams)) / grams
+
+    chosen = []
+    total = 0
+    for data in sorted(set(encoded), key=typicality, reverse=True):
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+
+    return b''.join(reversed(chosen))
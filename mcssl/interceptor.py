@@ -0,0 +1,240 @@
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+
+
+def frame_size(payload, attachments=()):
+    """
+    :param payload: The encoded message of a frame, None if not available
+    :param attachments: The attachments of the frame
+    :return: Size of the payload and the attachments of a frame, in bytes
+    """
+    return (len(payload) if payload is not None else 0) + sum(len(attachment) for attachment in attachments)
+
+
+class Call(object):
+    """
+    A request going through the interceptors of a server or a client.
+
+    :param message: The request Message
+    :param address: Address of the client on a server, of the server on a client
+    :param request_size: Size of the request frame, attachments included (int)
+    """
+
+    __slots__ = ('message', 'address', 'request_size', 'response', 'response_size', 'started', 'duration',
+                 'error', 'entered', 'context')
+
+    def __init__(self, message, address=None, request_size=0):
+        """
+        Initialize a Call object.
+
+        :param message: The request Message
+        :param address: Address of the client on a server, of the server on a client
+        :param request_size: Size of the request frame, attachments included. On a client
+                             it is known once the request is encoded, after the before hooks
+        """
+        self.message = message
+        self.address = address
+        self.request_size = request_size
+        self.response = None  # response Message, None for cached responses on a server
+        self.response_size = 0
+        self.started = time.perf_counter()
+        self.duration = None  # seconds from the before hooks to the after hooks
+        self.error = None  # exception raised while answering the request on a server
+        self.entered = 0  # number of interceptors whose before hook ran
+        self.context = {}  # state kept by the interceptors between their hooks
+
+
+class Interceptor(object):
+    """
+    Base class of the interceptors, which are added to a Server or a Client with
+    add_interceptor to run code around every request, e.g. tracing, profiling or
+    authorization checks.
+
+    The before hooks run in the order the interceptors were added, and the after
+    hooks in the reverse order, only for the interceptors whose before hook ran.
+
+    On a server the hooks run on the thread (or task) answering the request: before
+    the cache lookup and the handler, and after the response is sent. On a client
+    the before hook runs before the request is encoded and the after hook when its
+    response, or the first chunk of a stream, is received, on the thread reading it.
+    Interceptors that need both hooks on the same thread set server_only and cannot
+    be added to a client.
+    """
+
+    # True if the interceptor can only be added to a server
+    server_only = False
+
+    def before(self, call):
+        """
+        Called before a request is handled on a server, or sent by a client. On a
+        client the message can be changed, e.g. to add options.
+
+        :param call: The Call of the request
+        :return: On a server, a Message sent as the response instead of dispatching
+                 the request, e.g. an error for unauthorized requests. None to continue
+        """
+        return None
+
+    def after(self, call):
+        """
+        Called once a request is answered, with its duration and the response.
+        Exceptions raised here are printed and ignored.
+
+        :param call: The Call of the request
+        """
+        pass
+
+
+def run_before(interceptors, call):
+    """
+    Run the before hooks of interceptors, in order, until one of them returns a response.
+
+    :param interceptors: List of Interceptor objects
+    :param call: The Call of the request
+    :return: The Message returned by a before hook, or None
+    """
+    for interceptor in interceptors:
+        call.entered += 1
+        response_message = interceptor.before(call)
+        if response_message is not None:
+            return response_message
+    return None
+
+
+def run_after(interceptors, call):
+    """
+    Run the after hooks of the interceptors whose before hook ran, in reverse order.
+
+    :param interceptors: List of Interceptor objects
+    :param call: The Call of the request
+    """
+    call.duration = time.perf_counter() - call.started
+    for interceptor in reversed(interceptors[:call.entered]):
+        try:
+            interceptor.after(call)
+        except Exception as e:
+            print(f"Interceptor {type(interceptor).__name__} failed: {e}")
+
+
+class ProfilingInterceptor(Interceptor):
+    """
+    Interceptor profiling a sample of the requests with cProfile and keeping the
+    profiles of the slowest ones, e.g.
+
+        profiler = ProfilingInterceptor(slowest=5, sample_rate=0.1)
+        server.add_interceptor(profiler)
+        ...
+        print(profiler.report())
+
+    Only one request is profiled at a time, so the profiles of concurrent requests
+    are not mixed; requests arriving while another one is profiled are not sampled.
+    On AsyncServer the profile of a request also covers the tasks running while it
+    awaits.
+
+    It cannot be added to a client, whose after hooks run on the thread reading the
+    responses while cProfile must be disabled on the thread that enabled it.
+
+    :param slowest: Number of profiles kept (int)
+    :param sample_rate: Fraction of the requests profiled (float)
+    :param methods: Methods to profile, None for all of them (iterable of str)
+    """
+
+    server_only = True
+
+    def __init__(self, slowest=10, sample_rate=1.0, methods=None):
+        """
+        Initialize a ProfilingInterceptor object.
+
+        :param slowest: Number of profiles kept, those of the slowest requests
+        :param sample_rate: Fraction of the requests profiled, between 0 and 1
+        :param methods: Methods to profile, None for all of them
+        """
+        self.slowest = slowest
+        self.sample_rate = sample_rate
+        self.methods = set(methods) if methods is not None else None
+        self.profiling = threading.Lock()  # held while a request is profiled
+        self.lock = threading.Lock()
+        self.profiles = []  # min heap of (duration, sequence number, profile dictionary)
+        self.sequence = itertools.count()
+        self.sampled = 0
+
+    def before(self, call):
+        if self.methods is not None and call.message.method not in self.methods:
+            return None
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        if not self.profiling.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active
+            self.profiling.release()
+            return None
+        call.context['profile'] = profile
+        return None
+
+    def after(self, call):
+        profile = call.context.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self.profiling.release()
+
+        with self.lock:
+            self.sampled += 1
+            if len(self.profiles) >= self.slowest and call.duration <= self.profiles[0][0]:
+                return
+            entry = (call.duration, next(self.sequence), {
+                'method': call.message.method,
+                'duration': call.duration,
+                'request_size': call.request_size,
+                'response_size': call.response_size,
+                'error': repr(call.error) if call.error is not None else None,
+                'stats': pstats.Stats(profile)
+            })
+            if len(self.profiles) >= self.slowest:
+                heapq.heapreplace(self.profiles, entry)
+            else:
+                heapq.heappush(self.profiles, entry)
+
+    def slowest_calls(self):
+        """
+        :return: List of dictionaries describing the profiled requests kept, slowest first,
+                 with their method, duration, request and response sizes, error, and
+                 cProfile statistics as a pstats.Stats object
+        """
+        with self.lock:
+            return [entry[2] for entry in sorted(self.profiles, reverse=True)]
+
+    def report(self, sort='cumulative', limit=20):
+        """
+        Format the profiles of the slowest requests.
+
+        :param sort: Sort key of the statistics, see pstats.Stats.sort_stats
+        :param limit: Number of functions listed per request
+        :return: The report (str)
+        """
+        output = io.StringIO()
+        for call in self.slowest_calls():
+            output.write(f"{call['method']}: {call['duration'] * 1000:.3f} ms, "
+                         f"{call['request_size']} bytes in, {call['response_size']} bytes out\n")
+            stats = call['stats']
+            stats.stream = output
+            stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def clear(self):
+        """
+        Drop the profiles kept.
+        """
+        with self.lock:
+            self.profiles = []
+            self.sampled = 0
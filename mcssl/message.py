@@ -1,31 +1,238 @@
 import json
+import time
 from datetime import datetime, timezone
 
+# Method of the messages exchanged by client and server to agree on a codec
+HELLO_METHOD = '__hello__'
+# Method of the messages carrying many requests, or their responses, in one frame
+BATCH_METHOD = '__batch__'
+# Method of the message ending the chunks streamed in response to a request
+STREAM_END_METHOD = '__end__'
+# Method of the messages granting the server credit to send more chunks of a stream
+CREDIT_METHOD = '__credit__'
+# Method of the messages pushed by a server to tell clients cached responses are stale
+INVALIDATE_METHOD = '__invalidate__'
+# Method of the health check messages, answered by the server with the same method
+PING_METHOD = '__ping__'
+# Method of the requests reading the metrics of a server, answered with the same method
+METRICS_METHOD = '__metrics__'
+# Method of the messages telling the server a client gave up on a pipelined request
+CANCEL_METHOD = '__cancel__'
+
+def deadline_from_budget(timeout_ms, received):
+    """
+    Turn the time left to answer a received request into a deadline.
+
+    :param timeout_ms: Milliseconds left when the request was sent, None without deadline
+    :param received: When the request was received, as time.monotonic_ns()
+    :return: The deadline, as time.monotonic_ns(), None without deadline
+    """
+    if timeout_ms is None:
+        return None
+    return received + int(timeout_ms) * 10**6
+
 class Message(object):
     """
     Represents a message object that can be serialized to JSON and deserialized from JSON.
     Includes method name, arguments, options, and timestamp information.
 
+    A message can be lazy: only its method is decoded and the rest of the data is
+    decoded the first time args, options, the timestamp or the deadline are accessed,
+    so a server can route or reject a request without decoding large arguments.
+
+    A request can carry a deadline, after which the client no longer waits for its
+    response. Servers do not run the handlers of expired requests, and handlers can
+    read the time left with remaining() to bound their own work. The deadline is
+    sent as the time left, and turned back into a deadline of the monotonic clock
+    of the receiver when the message is received, so the clocks of the client and
+    the server do not need to agree.
+
     :param method: The method name this message is intended for (str)
     :param args: List of positional arguments for the method (list)
     :param options: Dictionary of keyword arguments for the method (dict)
-    :param timestamp: ISO-formatted string timestamp of when the message was created (datetime str)
+    :param timestamp: When the message was created, as UTC epoch nanoseconds (int) or ISO-formatted string
+    :param request_id: Id used to match a response to its request, None if not pipelined (int)
+    :param attachments: Raw binary data sent next to the encoded message (list of buffer protocol objects)
+    :param deadline: When the client stops waiting for the response, as time.monotonic_ns(), None if never (int)
     """
 
-    def __init__(self, method, args=None, options=None, timestamp=None):
+    __slots__ = ('method', '_args', '_options', '_timestamp', 'request_id', 'attachments', '_deadline',
+                 'cancelled', '_loader')
+
+    def __init__(self, method, args=None, options=None, timestamp=None, request_id=None, attachments=None,
+                 deadline=None):
         """
         Initialize a Message object.
 
         :param method: The method name this message is intended for
         :param args: List of positional arguments for the method
         :param options: Dictionary of keyword arguments for the method
-        :param timestamp: ISO-formatted string timestamp of when the message was created (UTC)
+        :param timestamp: When the message was created, as UTC epoch nanoseconds or
+                          ISO-formatted string. It is only formatted when read as a string
+        :param request_id: Id used to match a response to its request. It travels in the
+                           frame header, not in the JSON representation
+        :param attachments: Raw binary data (bytes, bytearray, memoryview or any buffer
+                            protocol object) sent as it is after the encoded message, so it
+                            is neither encoded nor copied, or FileAttachment objects sent
+                            straight from a file. Received attachments are bytearrays, or
+                            FileAttachment objects when received into a file
+        :param deadline: When the client stops waiting for the response, as
+                         time.monotonic_ns(), None if it waits forever
         """
         self.method = method
-        self.args = args if args is not None else []
-        self.options = options if options is not None else {}
-        # If no timestamp provided, use current time in UTC
-        self.timestamp = timestamp if timestamp is not None else datetime.now(timezone.utc).isoformat()
+        self._args = args if args is not None else []
+        self._options = options if options is not None else {}
+        # If no timestamp provided, use current time
+        self._timestamp = timestamp if timestamp is not None else time.time_ns()
+        self.request_id = request_id
+        self.attachments = attachments if attachments is not None else []
+        self._deadline = deadline
+        # set by the server when the client cancels the request, it is not sent
+        self.cancelled = False
+        self._loader = None
+
+    @staticmethod
+    def lazy(method, loader, request_id=None):
+        """
+        Create a Message whose data is decoded on first access.
+
+        :param method: The method name, already decoded
+        :param loader: Function returning the dictionary representation of the message
+        :param request_id: Id of the request read from the frame header
+        :return: Message object
+        """
+        message = Message.__new__(Message)
+        message.method = method
+        message.request_id = request_id
+        message.attachments = []
+        message.cancelled = False
+        # when the message was received, the time left it carries is counted from there
+        message._deadline = time.monotonic_ns()
+        message._loader = loader
+        return message
+
+    def _load(self):
+        """
+        Decode the data of a lazy message.
+        """
+        data = self._loader()
+        self._loader = None
+        self._args = data.get('args', [])
+        self._options = data.get('options', {})
+        self._timestamp = data.get('timestamp')
+        self._deadline = deadline_from_budget(data.get('timeout_ms'), self._deadline)
+
+    @property
+    def args(self):
+        if self._loader is not None:
+            self._load()
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        if self._loader is not None:
+            self._load()
+        self._args = args
+
+    @property
+    def options(self):
+        if self._loader is not None:
+            self._load()
+        return self._options
+
+    @options.setter
+    def options(self, options):
+        if self._loader is not None:
+            self._load()
+        self._options = options
+
+    @property
+    def timestamp_ns(self):
+        """
+        :return: When the message was created, as UTC epoch nanoseconds (int)
+        """
+        if self._loader is not None:
+            self._load()
+        timestamp = self._timestamp
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+            return (int(timestamp.timestamp()) * 10**9) + timestamp.microsecond * 1000
+        return timestamp
+
+    @property
+    def timestamp(self):
+        """
+        :return: When the message was created, as ISO-formatted string (UTC)
+        """
+        if self._loader is not None:
+            self._load()
+        timestamp = self._timestamp
+        if isinstance(timestamp, int):
+            seconds, nanoseconds = divmod(timestamp, 10**9)
+            timestamp = datetime.fromtimestamp(seconds, timezone.utc) \
+                            .replace(microsecond=nanoseconds // 1000).isoformat()
+        return timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        if self._loader is not None:
+            self._load()
+        self._timestamp = timestamp
+
+    @property
+    def deadline(self):
+        """
+        :return: When the client stops waiting for the response, as time.monotonic_ns(),
+                 None if it waits forever (int)
+        """
+        if self._loader is not None:
+            self._load()
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        if self._loader is not None:
+            self._load()
+        self._deadline = deadline
+
+    def remaining(self):
+        """
+        :return: Seconds left before the deadline, 0.0 once it passed or the request was
+                 cancelled, None without deadline (float)
+        """
+        if self.cancelled:
+            return 0.0
+        deadline = self.deadline
+        if deadline is None:
+            return None
+        return max(0.0, (deadline - time.monotonic_ns()) / 1e9)
+
+    def expired(self):
+        """
+        :return: True if the deadline passed or the request was cancelled
+        """
+        return self.cancelled or (self.deadline is not None and time.monotonic_ns() >= self._deadline)
+
+    def to_dict(self):
+        """
+        Convert the message object into the dictionary encoded by the codecs.
+
+        :return: Dictionary representation of the Message object
+        """
+        if self._loader is not None:
+            self._load()
+        data = {
+            'method': self.method,
+            'args': self._args,
+            'options': self._options,
+            'timestamp': self._timestamp  # Include the timestamp
+        }
+        if self._deadline is not None:
+            # only sent when set, so messages without deadline are encoded as before.
+            # The time left is sent rather than the deadline, the clocks of the client
+            # and the server may not agree
+            data['timeout_ms'] = max(0, (self._deadline - time.monotonic_ns()) // 10**6)
+        return data
 
     def to_json(self):
         """
@@ -33,27 +240,66 @@ class Message(object):
 
         :return: JSON string of the Message object
         """
-        return json.dumps({
-            'method': self.method,
-            'args': self.args,
-            'options': self.options,
-            'timestamp': self.timestamp  # Include the timestamp
-        })
+        return json.dumps(self.to_dict())
 
     @staticmethod
-    def from_json(json_str):
+    def from_dict(data, request_id=None):
         """
-        Create a Message instance from a JSON string.
+        Create a Message instance from its dictionary representation.
 
-        :param json_str: JSON string representing a message
-        :return: Message object created from the JSON data
+        :param data: Dictionary representing a message
+        :param request_id: Id of the request read from the frame header
+        :return: Message object created from the data
         """
-        data = json.loads(json_str)
         method = data.get('method')
         args = data.get('args', [])
         options = data.get('options', {})
         timestamp = data.get('timestamp')  # Extract the timestamp
-        return Message(method=method, args=args, options=options, timestamp=timestamp)
+        deadline = deadline_from_budget(data.get('timeout_ms'), time.monotonic_ns())
+        return Message(method=method, args=args, options=options, timestamp=timestamp, request_id=request_id,
+                       deadline=deadline)
+
+    @staticmethod
+    def from_json(json_str, request_id=None):
+        """
+        Create a Message instance from a JSON string.
+
+        :param json_str: JSON string representing a message
+        :param request_id: Id of the request read from the frame header
+        :return: Message object created from the JSON data
+        """
+        return Message.from_dict(json.loads(json_str), request_id)
+
+    @staticmethod
+    def batch(messages):
+        """
+        Pack many messages into a single batch Message, sent as one frame.
+        The attachments of the messages are not sent.
+
+        :param messages: The Message objects, in order
+        :return: Batch Message whose args are the dictionary representations of the messages
+        """
+        return Message(method=BATCH_METHOD, args=[message.to_dict() for message in messages])
+
+    def unbatch(self):
+        """
+        Unpack the messages of a batch Message.
+
+        :return: List of Message objects, in order. A message that is not a batch,
+                 e.g. an error, is returned alone in the list
+        """
+        if self.method != BATCH_METHOD:
+            return [self]
+        return [Message.from_dict(data) for data in self.args]
+
+    def __reduce__(self):
+        """
+        Pickle the decoded message, e.g. to send it to a process pool worker.
+        """
+        attachments = [bytes(attachment) if isinstance(attachment, memoryview) else attachment
+                       for attachment in self.attachments]
+        return (Message, (self.method, self.args, self.options, self._timestamp, self.request_id, attachments,
+                          self._deadline))
 
     def __repr__(self):
         """
@@ -61,6 +307,4 @@ class Message(object):
 
         :return: String representation of the Message instance
         """
-        return f"Message(method={self.method}, args={self.args}, options={self.options}, timestamp={self.timestamp})"
-
-
+        return f"Message(method={self.method}, args={self.args}, options={self.options}, timestamp={self.timestamp}, request_id={self.request_id})"
@@ -0,0 +1,294 @@
+import threading
+import time
+
+# Number of buckets of the latency histograms, bucket i counts the durations
+# below 2**i microseconds (and at least 2**(i-1)), the last one all the longer ones
+HISTOGRAM_BUCKETS = 32
+
+# Name the requests of unknown methods are recorded under
+UNKNOWN_METHOD = '<unknown>'
+
+
+class Histogram(object):
+    """
+    Latency histogram with power of two buckets, in microseconds, so recording a
+    duration costs a few integer operations.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        """
+        Initialize an empty Histogram object.
+        """
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Record a duration.
+
+        :param seconds: The duration (float)
+        """
+        self.counts[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile, as the upper bound of the bucket it falls in.
+
+        :param fraction: The percentile, between 0 and 1 (float)
+        :return: The duration in seconds (float)
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** index / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: Dictionary with the count, mean, max and percentiles of the durations in
+                 seconds, and the non empty buckets as [upper bound in seconds, count] pairs
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': [[2 ** index / 1e6, count] for index, count in enumerate(self.counts) if count]
+        }
+
+
+class MethodMetrics(object):
+    """
+    Counters and latency histograms of the requests of one method.
+    """
+
+    __slots__ = ('requests', 'errors', 'cache_hits', 'bytes_in', 'bytes_out', 'decode', 'handler', 'send')
+
+    def __init__(self):
+        """
+        Initialize a MethodMetrics object.
+        """
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decode = Histogram()
+        self.handler = Histogram()
+        self.send = Histogram()
+
+    def snapshot(self, uptime):
+        """
+        :param uptime: Seconds the metrics were recorded for, to compute the throughput
+        :return: Dictionary of the counters and histograms
+        """
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'cache_hits': self.cache_hits,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'requests_per_second': self.requests / uptime if uptime else 0.0,
+            'decode': self.decode.snapshot(),
+            'handler': self.handler.snapshot(),
+            'send': self.send.snapshot()
+        }
+
+
+class Metrics(object):
+    """
+    Metrics of a server: per method request counts, error counts, bytes in and out
+    and latency histograms of the decoding of the requests, of the handlers and of
+    the encoding and sending of the responses, and connection gauges.
+
+    The measurements of a request are recorded at once when it is answered, so the
+    lock is taken once per request.
+    """
+
+    def __init__(self):
+        """
+        Initialize a Metrics object.
+        """
+        self.lock = threading.Lock()
+        self.methods = {}  # method -> MethodMetrics
+        self.started = time.monotonic()
+        self.connections = 0
+        self.connections_opened = 0
+        self.connections_rejected = 0
+        self.requests_active = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_opened += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def connection_rejected(self):
+        with self.lock:
+            self.connections_rejected += 1
+
+    def timer(self, message, payload=None, known=True, decode=True):
+        """
+        Start measuring a request.
+
+        :param message: The received request Message
+        :param payload: The encoded frame payload of the request
+        :param known: False if no handler is registered for the method of the request
+        :param decode: False if the request is passed encoded to a process
+        :return: RequestTimer of the request
+        """
+        # created first, a request failing to decode does not stay active
+        timer = RequestTimer(self, message.method if known else UNKNOWN_METHOD, message, payload, decode)
+        with self.lock:
+            self.requests_active += 1
+        return timer
+
+    def record(self, method, decode, handler, send, bytes_in, bytes_out, error=False, cache_hit=False):
+        """
+        Record the measurements of an answered request.
+
+        :param method: Name of the method
+        :param decode: Seconds spent decoding the request
+        :param handler: Seconds spent in the handler, None if it did not run
+        :param send: Seconds spent encoding and sending the response, None if not sent
+        :param bytes_in: Size of the request, attachments included
+        :param bytes_out: Size of the response, attachments included
+        :param error: True if the handler failed or answered with an error
+        :param cache_hit: True if the response came from the cache of the method
+        """
+        with self.lock:
+            self.requests_active -= 1
+            metrics = self.methods.get(method)
+            if metrics is None:
+                metrics = self.methods[method] = MethodMetrics()
+            metrics.requests += 1
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+            metrics.decode.add(decode)
+            if handler is not None:
+                metrics.handler.add(handler)
+            if send is not None:
+                metrics.send.add(send)
+            if error:
+                metrics.errors += 1
+            if cache_hit:
+                metrics.cache_hits += 1
+
+    def snapshot(self):
+        """
+        :return: Dictionary of the metrics, safe to encode with any codec
+        """
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            return {
+                'uptime': uptime,
+                'connections': {
+                    'open': self.connections,
+                    'opened': self.connections_opened,
+                    'rejected': self.connections_rejected
+                },
+                'requests_active': self.requests_active,
+                'methods': {method: metrics.snapshot(uptime) for method, metrics in self.methods.items()}
+            }
+
+
+class RequestTimer(object):
+    """
+    Measures the stages of a request, created by Metrics.timer. The arguments of the
+    request are decoded here, unless it is passed encoded to a process, so their
+    decoding is not measured as handler time.
+    """
+
+    __slots__ = ('metrics', 'method', 'bytes_in', 'decode', 'handler', 'stage_started', 'error', 'cache_hit')
+
+    def __init__(self, metrics, method, message, payload=None, decode=True):
+        self.metrics = metrics
+        self.method = method
+        self.bytes_in = (len(payload) if payload is not None else 0) + \
+            sum(len(attachment) for attachment in message.attachments)
+        started = time.perf_counter()
+        if decode:
+            message.args  # decodes a lazy message
+        self.stage_started = time.perf_counter()
+        self.decode = self.stage_started - started
+        self.handler = None
+        self.error = False
+        self.cache_hit = False
+
+    def handled(self, cache_hit=False):
+        """
+        Mark the end of the handler, or of the cache lookup.
+
+        :param cache_hit: True if the response came from the cache
+        """
+        now = time.perf_counter()
+        if not cache_hit:
+            self.handler = now - self.stage_started
+        self.cache_hit = cache_hit
+        self.stage_started = now
+
+    def failed(self):
+        """
+        Record a request whose handler raised an exception.
+        """
+        self.handled()
+        self.error = True
+        self.metrics.record(self.method, self.decode, self.handler, None, self.bytes_in, 0, True)
+
+    def unsent(self):
+        """
+        Record a request whose response could not be encoded or sent, as an error.
+        """
+        self.metrics.record(self.method, self.decode, self.handler, None, self.bytes_in, 0, True, self.cache_hit)
+
+    def sent(self, encoded_response=None, attachments=(), error=False):
+        """
+        Record a request once its response is sent.
+
+        :param encoded_response: The encoded response, None for streams
+        :param attachments: The attachments of the response
+        :param error: True if the response is an error
+        """
+        send = time.perf_counter() - self.stage_started
+        bytes_out = (len(encoded_response) if encoded_response is not None else 0) + \
+            sum(len(attachment) for attachment in attachments)
+        self.metrics.record(self.method, self.decode, self.handler, send, self.bytes_in, bytes_out,
+                            error or self.error, self.cache_hit)
+
+
+class NoTimer(object):
+    """
+    Stands for the RequestTimer of requests when metrics are disabled.
+    """
+
+    __slots__ = ()
+
+    def handled(self, cache_hit=False):
+        pass
+
+    def failed(self):
+        pass
+
+    def unsent(self):
+        pass
+
+    def sent(self, encoded_response=None, attachments=(), error=False):
+        pass
+
+
+NO_TIMER = NoTimer()
@@ -0,0 +1,271 @@
+import collections
+import contextlib
+import threading
+import time
+from .client  import Client
+from .message import Message
+
+from .connection.client import *
+
+
+class ClientPool(object):
+    """
+    Keeps up to size connected Clients to a server and lends them to threads, so
+    connections, and their TLS handshake, are reused instead of being set up for
+    every use, e.g.
+
+        pool = ClientPool('localhost', 10000, Encoder(), size=4)
+        response = pool.request(Message(method='add', args=[1, 2]))
+
+        with pool.connection() as client:
+            client.request(Message(method='add', args=[3, 4]))
+
+    Clients returned to the pool are lent again most recently used first. Clients
+    idle for more than max_idle seconds are closed, and clients idle for more than
+    ping_interval seconds are checked with a ping before being lent again, so
+    connections closed by the server or the network are replaced with new ones.
+
+    The Clients of a pool share its response handlers and interceptors.
+
+    :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket (str)
+    :param port: Port number of the server (int)
+    :param encoder: Encoder instance for encoding/decoding messages
+    :param connection_type: PlainConnection or SSLConnection used to connect
+    :param size: Maximum number of connections (int)
+    :param max_idle: Seconds after which an idle connection is closed, None to keep them (float)
+    :param ping_interval: Seconds of idleness after which a connection is pinged before
+                          being lent, None to never ping (float)
+    :param ping_timeout: Seconds to wait for the answer to a ping (float)
+    :param client_options: Other arguments of the Clients, e.g. pipeline or max_frame_size
+    """
+
+    def __init__(self, host='localhost', port=10000, encoder=None, connection_type=PlainConnection(),
+                 size=8, max_idle=300.0, ping_interval=30.0, ping_timeout=5.0, **client_options):
+        """
+        Initialize a ClientPool object, no connection is made until a client is acquired.
+
+        :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket
+        :param port: Port number of the server
+        :param encoder: Encoder instance for encoding/decoding messages
+        :param connection_type: PlainConnection or SSLConnection used to connect
+        :param size: Maximum number of connections
+        :param max_idle: Seconds after which an idle connection is closed, None to keep them
+        :param ping_interval: Seconds of idleness after which a connection is pinged before
+                              being lent, None to never ping
+        :param ping_timeout: Seconds to wait for the answer to a ping
+        :param client_options: Other keyword arguments of the Clients
+        """
+        self.host = host
+        self.port = port
+        self.encoder = encoder
+        self.connection_type = connection_type
+        self.client_options = client_options
+        self.size = size
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.response_handlers = {}
+        self.interceptors = []
+
+        self.idle = collections.deque()  # (time returned, Client), most recently returned last
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.closed = False
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+
+    def register_response_handler(self):
+        """
+        Register a handler function for a specific response message type, for all
+        the Clients of the pool.
+
+        :return: Decorator function to register the handler
+        """
+        def decorator(func):
+            self.response_handlers[func.__name__] = func
+            return func
+        return decorator
+
+    def add_interceptor(self, interceptor):
+        """
+        Add an interceptor run around every request of the Clients of the pool.
+        See Interceptor.
+
+        :param interceptor: Interceptor instance
+        :return: The interceptor
+        """
+        if interceptor.server_only:
+            raise ValueError(f"{type(interceptor).__name__} can only be added to a server")
+        self.interceptors.append(interceptor)
+        return interceptor
+
+    def create_client(self):
+        """
+        Create and connect a new Client.
+
+        :return: The connected Client
+        """
+        client = Client(self.host, self.port, self.encoder, self.connection_type, **self.client_options)
+        client.response_handlers = self.response_handlers
+        client.interceptors = self.interceptors
+        client.connect()
+        with self.lock:
+            self.created += 1
+        return client
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a connected Client, it must be given back with release.
+
+        :param timeout: Seconds to wait for a client when all of them are in use,
+                        None to wait forever
+        :return: The connected Client
+        """
+        if self.closed:
+            raise ConnectionError("Client pool is closed")
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("No client available in the pool")
+
+        try:
+            self.close_idle()
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    released, client = self.idle.pop()
+
+                if self.broken(client) or (self.ping_interval is not None and
+                                           time.monotonic() - released > self.ping_interval and
+                                           not client.ping(self.ping_timeout)):
+                    self.discard(client)
+                    continue
+
+                with self.lock:
+                    self.reused += 1
+                    self.in_use += 1
+                return client
+
+            client = self.create_client()
+            with self.lock:
+                self.in_use += 1
+            return client
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, client, discard=False):
+        """
+        Give back a Client borrowed with acquire.
+
+        :param client: The Client
+        :param discard: Close the connection instead of keeping it, e.g. after an error
+                        left it in an unknown state
+        """
+        broken = self.broken(client)
+        with self.lock:
+            self.in_use -= 1
+            keep = not (discard or broken or self.closed)
+            if keep:
+                self.idle.append((time.monotonic(), client))
+        if not keep:
+            self.discard(client)
+        self.slots.release()
+
+    @staticmethod
+    def broken(client):
+        """
+        Tell whether a Client is known to have lost its connection, without a round trip.
+
+        :param client: The Client
+        :return: True if the connection is lost
+        """
+        # the reader thread of a pipelined client stops when the connection is lost
+        return not client.client_socket or \
+            (client.reader_thread is not None and not client.reader_thread.is_alive())
+
+    def discard(self, client):
+        """
+        Close the connection of a Client that is not kept in the pool.
+
+        :param client: The Client
+        """
+        with self.lock:
+            self.recycled += 1
+        client.close()
+
+    def close_idle(self):
+        """
+        Close the connections idle for more than max_idle seconds.
+        """
+        if self.max_idle is None:
+            return
+        expired = []
+        with self.lock:
+            deadline = time.monotonic() - self.max_idle
+            while self.idle and self.idle[0][0] < deadline:
+                expired.append(self.idle.popleft()[1])
+        for client in expired:
+            self.discard(client)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a connected Client for the duration of a with block. The connection
+        is closed instead of being given back if the block raises an exception,
+        since the client may be in the middle of a request.
+
+        :param timeout: Seconds to wait for a client, None to wait forever
+        :return: Context manager giving the Client
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def request(self, message: Message, timeout=None) -> Message:
+        """
+        Send a request with a borrowed Client and wait for its response.
+
+        :param message: Message object to be sent
+        :param timeout: Seconds to wait for a client, None to wait forever
+        :return: The response Message
+        """
+        with self.connection(timeout) as client:
+            response_message = client.request(message)
+            if response_message is None:
+                raise ConnectionError("Connection closed")
+        return response_message
+
+    def stats(self):
+        """
+        :return: Dictionary of the connection counters of the pool
+        """
+        with self.lock:
+            return {
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'created': self.created,
+                'reused': self.reused,
+                'recycled': self.recycled
+            }
+
+    def close(self):
+        """
+        Close the idle connections, the borrowed ones are closed when released.
+        """
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, collections.deque()
+        for released, client in idle:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,370 @@
+import argparse
+import collections
+import contextlib
+import json
+import socket
+import sys
+import threading
+import time
+from .bench   import percentile
+from .capture import REQUEST_RECORD, read_capture
+from .client  import Client
+from .common  import MAX_FRAME_SIZE, send_frame
+from .encoder import Encoder
+from .message import CREDIT_METHOD
+
+from .connection import client as client_connection
+
+
+class ReplayRequest(object):
+    """
+    A request of a capture log, with the responses the server sent to it.
+
+    :param record: The CaptureRecord of the request
+    """
+
+    __slots__ = ('timestamp', 'request_id', 'method', 'payload', 'attachments', 'expected', 'recorded',
+                 'stream', 'after')
+
+    def __init__(self, record):
+        self.timestamp = record.timestamp
+        self.request_id = record.request_id
+        self.method = record.method
+        self.payload = record.payload
+        self.attachments = record.attachments
+        self.expected = 0  # number of response frames recorded, e.g. the chunks of a stream
+        self.recorded = None  # seconds from the request to its last response frame on the server
+        # for credit messages, index of the request of the stream on the connection and
+        # number of its response frames recorded before the credit
+        self.stream = None
+        self.after = 0
+
+
+def load_capture(path):
+    """
+    Read the requests of a capture log and match them with their recorded responses.
+
+    Responses with an id answer the last request with that id on their connection,
+    credit messages aside. Requests without an id are answered in order, so their
+    responses answer the last request without id received before them.
+
+    :param path: Path of the capture log
+    :return: Dictionary of connection number -> list of ReplayRequest objects, in order
+    """
+    connections = {}
+    latest = {}  # (connection, request id) -> index of the request answered by the responses with that id
+    for record in read_capture(path):
+        if record.kind == REQUEST_RECORD:
+            request = ReplayRequest(record)
+            requests = connections.setdefault(record.connection, [])
+            stream = latest.get((record.connection, record.request_id))
+            if record.method == CREDIT_METHOD and stream is not None:
+                request.stream = stream
+                request.after = requests[stream].expected
+            elif record.method != CREDIT_METHOD:
+                latest[record.connection, record.request_id] = len(requests)
+            requests.append(request)
+            continue
+
+        index = latest.get((record.connection, record.request_id))
+        if index is None:
+            # e.g. a connection rejected before sending anything
+            continue
+        request = connections[record.connection][index]
+        request.expected += 1
+        request.recorded = (record.timestamp - request.timestamp) / 1e9
+    return connections
+
+
+def wait_until(deadline):
+    """
+    Sleep until a time of time.perf_counter.
+
+    :param deadline: The time to wake up at
+    """
+    delay = deadline - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def replay_connection(requests, connect, start, origin, speed=1.0, timeout=30.0):
+    """
+    Send the requests of a captured connection on a new connection and measure the
+    time until their last response frame arrives.
+
+    Requests are sent at their recorded time divided by speed, and requests without
+    id also wait for the response to the previous one, like the client that sent them.
+    Credit messages wait until the chunks of their stream received before them in the
+    capture are received again, since the server ignores credit for streams it has not
+    started yet.
+
+    :param requests: The ReplayRequest objects of the connection, in order
+    :param connect: Function returning a connected Client
+    :param start: time.perf_counter time of the start of the replay
+    :param origin: Timestamp of the first request of the capture, in nanoseconds
+    :param speed: Factor dividing the recorded delays, None to send as fast as possible
+    :param timeout: Seconds to wait for a response
+    :return: List of (ReplayRequest, latency in seconds or None if not answered) of the
+             requests expecting a response
+    """
+    def scheduled(request):
+        return start + (request.timestamp - origin) / 1e9 / speed
+
+    if speed is not None:
+        wait_until(scheduled(requests[0]))
+    client = connect()
+
+    sent = [None] * len(requests)
+    received = [0] * len(requests)
+    latencies = [None] * len(requests)
+    done = [threading.Event() for _ in requests]
+    by_id = {}  # request id -> index of the request waiting for its responses
+    without_id = collections.deque()  # indexes of the requests without id waiting, in order
+    progress = threading.Condition()  # notified when a response frame arrives
+
+    def read_responses():
+        try:
+            while True:
+                frame = client.frame_reader.read_frame()
+                if frame is None:
+                    break
+                now = time.perf_counter()
+                request_id = frame[0]
+                with progress:
+                    if request_id is None:
+                        if not without_id:
+                            # pushed by the server
+                            continue
+                        index = without_id[0]
+                    else:
+                        index = by_id.get(request_id)
+                        if index is None:
+                            continue
+                    received[index] += 1
+                    progress.notify_all()
+                    if received[index] < requests[index].expected:
+                        continue
+                    latencies[index] = now - sent[index]
+                    if request_id is None:
+                        without_id.popleft()
+                    else:
+                        del by_id[request_id]
+                done[index].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            # nothing more will be answered
+            for event in done:
+                event.set()
+            with progress:
+                progress.notify_all()
+
+    reader = threading.Thread(target=read_responses, daemon=True)
+    reader.start()
+
+    previous = None  # index of the last request without id expecting a response
+    try:
+        for index, request in enumerate(requests):
+            if speed is not None:
+                wait_until(scheduled(request))
+            if request.request_id is None and previous is not None:
+                done[previous].wait(timeout)
+            if request.stream is not None:
+                with progress:
+                    progress.wait_for(lambda: received[request.stream] >= request.after or
+                                      done[request.stream].is_set(), timeout)
+            with progress:
+                if request.expected:
+                    if request.request_id is None:
+                        without_id.append(index)
+                        previous = index
+                    else:
+                        by_id[request.request_id] = index
+                sent[index] = time.perf_counter()
+            send_frame(client.client_socket, request.payload, client.max_frame_size, request.request_id,
+                       request.attachments)
+
+        deadline = time.perf_counter() + timeout
+        for index, request in enumerate(requests):
+            if request.expected:
+                done[index].wait(max(0.0, deadline - time.perf_counter()))
+    except OSError as e:
+        print(f"Replay of a connection failed: {e}")
+    finally:
+        with contextlib.suppress(OSError):
+            # wakes up the reader
+            client.client_socket.shutdown(socket.SHUT_RDWR)
+        client.close()
+
+    return [(request, latencies[index]) for index, request in enumerate(requests) if request.expected]
+
+
+def latency_summary(latencies):
+    """
+    :param latencies: Latencies in seconds
+    :return: Dictionary with the count and the mean, percentiles and max in milliseconds,
+             None without latencies
+    """
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'latency_ms': {
+            'mean': sum(ordered) / len(ordered) * 1000,
+            'p50': percentile(ordered, 0.5) * 1000,
+            'p99': percentile(ordered, 0.99) * 1000,
+            'p999': percentile(ordered, 0.999) * 1000,
+            'max': ordered[-1] * 1000
+        }
+    }
+
+
+def replay(path, host='localhost', port=10000, connection_type=None, speed=1.0, repeat=1, timeout=30.0,
+           max_frame_size=MAX_FRAME_SIZE):
+    """
+    Send the traffic of a capture log to a server, every captured connection on its
+    own connection, and compare the latencies with the recorded ones.
+
+    The recorded latencies are measured by the server that captured the traffic, from
+    the reception of a request to the sending of its last response frame. The replayed
+    ones are measured by the client and include the round trip.
+
+    :param path: Path of the capture log, see Server.start_capture
+    :param host: Host address of the server, or unix:// followed by the path of a Unix domain socket
+    :param port: Port number of the server
+    :param connection_type: PlainConnection or SSLConnection used to connect, plain if None
+    :param speed: Factor dividing the recorded delays between requests, e.g. 2 to replay
+                  twice as fast, None to send them as fast as possible
+    :param repeat: Number of times every captured connection is replayed concurrently
+    :param timeout: Seconds to wait for a response
+    :param max_frame_size: Maximum size of a frame
+    :return: Dictionary of the results
+    """
+    connections = load_capture(path)
+    if not connections:
+        raise ValueError(f"No request in the capture log: {path}")
+    if connection_type is None:
+        connection_type = client_connection.PlainConnection()
+    origin = min(requests[0].timestamp for requests in connections.values())
+    end = max(requests[-1].timestamp for requests in connections.values())
+
+    def connect():
+        client = Client(host, port, Encoder(), connection_type, max_frame_size)
+        client.connect()
+        return client
+
+    results = []
+    lock = threading.Lock()
+
+    def run(requests):
+        try:
+            replayed = replay_connection(requests, connect, start, origin, speed, timeout)
+        except Exception as e:
+            print(f"Replay of a connection failed: {e}")
+            replayed = [(request, None) for request in requests if request.expected]
+        with lock:
+            results.extend(replayed)
+
+    threads = [threading.Thread(target=run, args=(requests,), daemon=True)
+               for _ in range(repeat) for requests in connections.values()]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    methods = {}
+    for request, latency in results:
+        recorded, replayed = methods.setdefault(request.method, ([], []))
+        recorded.append(request.recorded)
+        if latency is not None:
+            replayed.append(latency)
+
+    recorded = latency_summary([request.recorded for request, latency in results])
+    replayed = latency_summary([latency for request, latency in results if latency is not None])
+    slowdown = None
+    if recorded is not None and replayed is not None:
+        slowdown = {key: replayed['latency_ms'][key] / recorded['latency_ms'][key]
+                    for key in ('p50', 'p99', 'p999') if recorded['latency_ms'][key]}
+    return {
+        'capture': path,
+        'speed': speed if speed is not None else 'max',
+        'connections': len(connections) * repeat,
+        'requests': sum(len(requests) for requests in connections.values()) * repeat,
+        'answered': replayed['count'] if replayed is not None else 0,
+        'unanswered': sum(1 for request, latency in results if latency is None),
+        'seconds': elapsed,
+        'recorded_seconds': (end - origin) / 1e9,
+        'requests_per_second': len(results) / elapsed if elapsed else 0.0,
+        'recorded': recorded,
+        'replayed': replayed,
+        'slowdown': slowdown,
+        'methods': {method: {'recorded': latency_summary(recorded_latencies),
+                             'replayed': latency_summary(replayed_latencies)}
+                    for method, (recorded_latencies, replayed_latencies) in methods.items()}
+    }
+
+
+def parse_speed(text):
+    """
+    :param text: 'max' or a positive number
+    :return: The speed factor, None for max
+    """
+    if text == 'max':
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("the speed must be positive")
+    return speed
+
+
+def main(argv=None):
+    """
+    Entry point of python -m mcssl.replay.
+
+    :param argv: Command line arguments, sys.argv if None
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m mcssl.replay',
+        description='Replay the traffic of a capture log recorded with Server.start_capture against a '
+                    'server and report the latencies against the recorded ones as JSON.')
+    parser.add_argument('capture', help='Path of the capture log')
+    parser.add_argument('--host', default='localhost',
+                        help='Host of the server, or unix:// followed by a socket path (default: localhost)')
+    parser.add_argument('--port', type=int, default=10000, help='Port of the server (default: 10000)')
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help='Factor dividing the recorded delays, e.g. 2 for twice as fast, or max '
+                             '(default: 1, the original speed)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of concurrent replays of every captured connection (default: 1)')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Seconds to wait for a response (default: 30)')
+    parser.add_argument('--cert', help='CA certificate to connect with TLS, plain connections if not given')
+    parser.add_argument('--cert-hostname', default='localhost',
+                        help='Expected host name of the server certificate (default: localhost)')
+    parser.add_argument('--max-frame-size', type=int, default=MAX_FRAME_SIZE,
+                        help='Maximum size of a frame')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    connection_type = None
+    if args.cert is not None:
+        connection_type = client_connection.SSLConnection(args.cert, args.cert_hostname)
+
+    # the clients log with print, the results alone go to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = replay(args.capture, args.host, args.port, connection_type, args.speed, args.repeat,
+                         args.timeout, args.max_frame_size)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
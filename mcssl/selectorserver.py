@@ -0,0 +1,646 @@
+import collections
+import functools
+import inspect
+import itertools
+import selectors
+import socket
+import ssl
+import threading
+import time
+from .common  import FrameError, FrameParser, MAX_SEND_BUFFERS, frame_buffers, remove_socket_file, set_nodelay
+from .message import CANCEL_METHOD, CREDIT_METHOD, HELLO_METHOD, METRICS_METHOD, PING_METHOD, Message
+from .server  import DRAIN_POLL_INTERVAL, Server, acquire_slot, error_message, release_slot
+from .interceptor import frame_size
+from .connection.server import *
+
+# Size of the buffer the sockets are read into
+RECEIVE_BUFFER_SIZE = 256 * 1024
+# Default size of the responses queued on a connection above which it is not read
+MAX_QUEUED_BYTES = 4 * 1024 * 1024
+
+
+class SelectorServer(Server):
+    """
+    Represents a server that handles all its client connections on a single thread
+    with the selectors module (epoll on Linux), without asyncio.
+
+    The sockets are non-blocking: frames are parsed out of the received data as it
+    arrives, and responses are queued per connection and written when the socket is
+    writable. Handlers are registered with register_method exactly like for Server.
+    Requests without an id are answered in order, by default on the event loop thread,
+    and pipelined requests are handled by the executor of the server, as on Server.
+    Responses sent from other threads are written by the event loop thread.
+
+    The responses queued on a connection are bounded: above max_queued_bytes the
+    connection is not read, and handler threads sending to it wait, until half of
+    them are written. The slots of a pipelined request are released once its
+    response is written, so max_in_flight also bounds the unread responses.
+
+    :param host: Host address to bind the server, or unix:// followed by the path of a Unix domain socket (str)
+    :param port: Port number to listen on (int)
+    :param encoder: Encoder instance for encoding/decoding messages
+    :param connection_type: PlainConnection or SSLConnection used for the client connections
+    :param max_frame_size: Maximum size of a single message frame (int)
+    :param inline: Run the handlers of requests without id on the event loop thread (bool)
+    :param max_queued_bytes: Size of the responses queued on a connection above which it is not read (int)
+    """
+
+    def __init__(self, *args, inline=True, max_queued_bytes=MAX_QUEUED_BYTES, **kwargs):
+        """
+        Initialize a SelectorServer object, the other arguments are the same as for Server.
+
+        :param inline: Run the handlers of requests without id on the event loop thread,
+                       which is the fastest for short handlers but blocks all the
+                       connections while they run. Otherwise they run on the executor and
+                       the connection is not read until the response is sent, so requests
+                       are still answered in order. Handlers registered with
+                       executor="process" and generator handlers never run on the
+                       event loop thread
+        :param max_queued_bytes: Size of the responses queued on a connection above which
+                                 the connection is not read and the handler threads sending
+                                 to it wait, so a client that does not read its responses
+                                 cannot make the server buffer without limit
+        """
+        super().__init__(*args, **kwargs)
+        self.inline = inline
+        self.max_queued_bytes = max_queued_bytes
+        self.selector = None
+        self.loop_thread = None
+        self.calls = collections.deque()  # (function, args) run by the event loop thread
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.receive_buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+
+    def start_server(self, server_socket=None):
+        """
+        Start the server and run the event loop until stop_server is called.
+
+        :param server_socket: Already listening socket to accept connections from,
+                              created if not given
+        """
+        created = server_socket is None
+        self.server_socket = server_socket if server_socket is not None else self.create_server_socket()
+        self.server_socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.loop_thread = threading.current_thread()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.run_calls)
+
+        try:
+            while not self.stop_main_thread:
+                self.poll()
+            self.selector.unregister(self.server_socket)
+            self.drain()
+        finally:
+            for session in list(self.sessions):
+                self.close_session(session)
+            self.selector.close()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            if created:
+                remove_socket_file(self.host)
+            self.server_socket.close()
+
+    def poll(self, timeout=None):
+        """
+        Wait for the events of the sockets and handle them.
+
+        :param timeout: Maximum number of seconds to wait, None to wait for an event
+        """
+        for key, mask in self.selector.select(timeout):
+            try:
+                key.data(mask)
+            except Exception as e:
+                print(f"Error in the event loop: {e}")
+
+    def idle(self):
+        """
+        :return: True if no request is being answered and all the responses are written
+        """
+        return super().idle() and not any(session.paused or session.write_queue for session in list(self.sessions))
+
+    def drain(self, timeout=None):
+        """
+        Run the event loop until the requests being answered are answered and their
+        responses written, see Server.drain. Runs on the event loop thread.
+
+        :param timeout: Maximum number of seconds to wait, drain_timeout if None
+        :return: True if no request is left
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.drain_timeout)
+        while not self.idle():
+            if time.monotonic() >= deadline:
+                print("Stopping with requests still being answered")
+                return False
+            self.poll(DRAIN_POLL_INTERVAL)
+        return True
+
+    def stop_server(self):
+        """
+        Stop the server, can be called from any thread.
+        """
+        self.stop_main_thread = True
+        self.stop_capture()
+        self.call_soon(lambda: None)
+
+    def drop_session(self, session):
+        """
+        Close a client connection on the event loop thread, see Server.drop_session.
+        Can be called from any thread.
+
+        :param session: The Session of the client
+        """
+        self.call_soon(self.close_session, session)
+
+    def call_soon(self, function, *args):
+        """
+        Run a function on the event loop thread, can be called from any thread.
+
+        :param function: The function to run
+        :param args: The arguments of the function
+        """
+        self.calls.append((function, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (AttributeError, BlockingIOError, OSError):
+            # not started, or enough wakeups are pending already
+            pass
+
+    def run_calls(self, mask):
+        """
+        Run the functions queued with call_soon.
+
+        :param mask: The selector events of the wakeup socket
+        """
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            function, args = self.calls.popleft()
+            function(*args)
+
+    def accept(self, mask):
+        """
+        Accept a client connection.
+
+        :param mask: The selector events of the listening socket
+        """
+        try:
+            client_connection, client_address = self.server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            # taken by another worker process
+            return
+        self.serve_connection(client_connection, client_address)
+
+    def serve_connection(self, client_connection, client_address):
+        """
+        Start handling a connected socket, with a non-blocking TLS handshake first
+        for SSLConnection.
+
+        :param client_connection: The connected socket of the client (socket)
+        :param client_address: The address of the client
+        """
+        client_connection.setblocking(False)
+        set_nodelay(client_connection)
+        context = self.connection_type.context
+        if context is not None:
+            client_connection = context.wrap_socket(client_connection, server_side=True,
+                                                    do_handshake_on_connect=False)
+
+        session = self.create_session(client_connection, client_address)
+        self.selector.register(client_connection, session.events, functools.partial(self.handle_events, session))
+        if context is not None:
+            session.handshaking = True
+            self.do_handshake(session)
+        else:
+            self.start_session(session)
+
+    def socketpair(self):
+        """
+        Create a connected pair of sockets, handle one end like an accepted client
+        connection and return the other one, see Server.socketpair. The server must
+        be running.
+
+        :return: The client end of the pair (socket)
+        """
+        if self.selector is None:
+            raise RuntimeError("Server is not running")
+        server_end, client_end = socket.socketpair()
+        self.call_soon(self.serve_connection, server_end, 'socketpair')
+        return client_end
+
+    def create_session(self, connection, address):
+        """
+        Create the state of a new client connection, see Server.create_session, with
+        the buffers of the non-blocking socket.
+
+        :param connection: The non-blocking socket of the client
+        :param address: The address of the client (tuple)
+        :return: Session instance
+        """
+        session = super().create_session(connection, address)
+        session.parser = FrameParser(self.max_frame_size)
+        session.write_queue = collections.deque()  # memoryviews waiting to be sent
+        session.queued_bytes = 0  # total size of the responses queued since the connection started
+        session.written_bytes = 0  # total size of the responses written since the connection started
+        session.backlogged = False  # too many responses queued, not read until half are written
+        session.writable = threading.Condition(session.send_lock)  # notified when backlogged is cleared
+        session.releases = collections.deque()  # queued_bytes once the response of a request is queued
+        session.events = selectors.EVENT_READ  # events the selector watches
+        session.handshaking = False
+        session.started = False  # holds a connection slot
+        session.paused = False  # not read until the response to a request is sent
+        session.flush_scheduled = False
+        session.close_after_flush = False
+        # the SSL layer needs the socket writable to read, or readable to write
+        session.read_wants_write = False
+        session.write_wants_read = False
+        return session
+
+    def do_handshake(self, session):
+        """
+        Continue the TLS handshake of a connection.
+
+        :param session: The Session of the client
+        """
+        try:
+            session.connection.do_handshake()
+        except ssl.SSLWantReadError:
+            self.watch(session, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.watch(session, selectors.EVENT_WRITE)
+            return
+        except OSError:
+            print("SSL Error")
+            self.close_session(session)
+            return
+
+        session.handshaking = False
+        self.start_session(session)
+
+    def start_session(self, session):
+        """
+        Start serving a connection once it is established, or reject it if there are
+        too many connections.
+
+        :param session: The Session of the client
+        """
+        if not acquire_slot(self.connection_slots):
+            print(f"Rejecting connection from {session.address}: too many connections")
+            if self.metrics is not None:
+                self.metrics.connection_rejected()
+            session.close_after_flush = True
+            self.send_response(session, error_message('Server busy'), None)
+            return
+
+        print(f"Connection from {session.address}")
+        session.started = True
+        self.connection_type.connected(session.connection)
+        self.sessions.add(session)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        self.update_events(session)
+
+    def handle_events(self, session, mask):
+        """
+        Handle the selector events of a connection.
+
+        :param session: The Session of the client
+        :param mask: The selector events
+        """
+        if session.closed:
+            # closed while handling an earlier event of the same select call
+            return
+        if session.handshaking:
+            self.do_handshake(session)
+            return
+        if mask & selectors.EVENT_WRITE or (mask & selectors.EVENT_READ and session.write_wants_read):
+            self.flush(session)
+        if mask & selectors.EVENT_READ or (mask & selectors.EVENT_WRITE and session.read_wants_write):
+            self.receive(session)
+
+    def watch(self, session, events):
+        """
+        Change the selector events watched on a connection.
+
+        :param session: The Session of the client
+        :param events: The events to watch
+        """
+        if events != session.events and not session.closed:
+            session.events = events
+            self.selector.modify(session.connection, events, functools.partial(self.handle_events, session))
+
+    def update_events(self, session):
+        """
+        Watch the events a connection is waiting for: readable unless paused, and
+        writable while responses are queued.
+
+        :param session: The Session of the client
+        """
+        events = 0
+        if (not session.paused and not session.close_after_flush and not session.backlogged) or \
+                session.write_wants_read:
+            events |= selectors.EVENT_READ
+        if session.write_queue or session.read_wants_write:
+            events |= selectors.EVENT_WRITE
+        # the selector needs at least one event
+        self.watch(session, events or selectors.EVENT_READ)
+
+    def receive(self, session):
+        """
+        Read the data available on a connection and handle the complete frames.
+
+        :param session: The Session of the client
+        """
+        if session.paused or session.close_after_flush or session.backlogged:
+            return
+        session.read_wants_write = False
+        closed = False
+        while not session.paused and not session.backlogged:
+            try:
+                received = session.connection.recv_into(self.receive_buffer)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
+                break
+            except ssl.SSLWantWriteError:
+                session.read_wants_write = True
+                break
+            except OSError as e:
+                print(f"Connection error from {session.address}: {e}")
+                self.close_session(session)
+                return
+            if received == 0:
+                closed = True
+                break
+            session.parser.feed(self.receive_buffer[:received])
+            # the frames are handled as they arrive, so reading stops as soon as a
+            # request pauses the connection or its responses pile up
+            self.process_frames(session)
+            if session.closed:
+                return
+            if received < len(self.receive_buffer) and not isinstance(session.connection, ssl.SSLSocket):
+                # the socket is drained, SSL sockets may still hold decrypted data
+                break
+
+        if closed:
+            self.close_session(session)
+        else:
+            self.update_events(session)
+
+    def process_frames(self, session):
+        """
+        Handle the complete frames received on a connection, until one of them
+        pauses it or too many responses are queued.
+
+        :param session: The Session of the client
+        """
+        while not session.paused and not session.backlogged and not session.closed:
+            try:
+                frame = session.parser.next_frame()
+            except FrameError as e:
+                print(f"Invalid frame from {session.address}: {e}")
+                self.close_session(session)
+                return
+            if frame is None:
+                return
+            self.handle_frame(session, *frame)
+
+    def handle_frame(self, session, request_id, data, attachments):
+        """
+        Route a received frame like Server.handle_client does.
+
+        :param session: The Session of the client
+        :param request_id: The id of the request (int or None)
+        :param data: The payload of the frame
+        :param attachments: The attachments of the frame
+        """
+        # Only the method is decoded here, so requests can be routed or
+        # rejected without decoding their arguments
+        try:
+            message = session.encoder.decode(data, request_id, lazy=True)
+        except FrameError as e:
+            print(f"Invalid frame from {session.address}: {e}")
+            self.close_session(session)
+            return
+        if attachments:
+            message.attachments = attachments
+        if self.capture is not None:
+            self.capture.request(session.number, message.method, request_id, data, attachments)
+
+        if message.method == HELLO_METHOD:
+            self.negotiate_codec(session, message)
+        elif message.method == PING_METHOD:
+            self.send_response(session, Message(method=PING_METHOD), message.request_id)
+        elif message.method == METRICS_METHOD:
+            self.send_response(session, self.metrics_response(), message.request_id)
+        elif message.method == CREDIT_METHOD:
+            session.grant_credit(message.request_id, message.args[0])
+        elif message.method == CANCEL_METHOD:
+            session.cancel(message.request_id)
+        elif message.request_id is None:
+            # streams run on the executor, paced by the writes of their chunks
+            if self.inline and message.method not in self.process_methods and \
+                    not inspect.isgeneratorfunction(self.method_handlers.get(message.method)):
+                try:
+                    self.respond(session, message, data)
+                except Exception as e:
+                    print(f"Failed to handle request from {session.address}: {e}")
+                    self.close_session(session)
+                return
+            # answered in order: the connection is not read until the response is sent
+            session.paused = True
+            self.executor.submit(self.respond, session, message, data) \
+                .add_done_callback(lambda future: self.call_soon(self.resume, session, future))
+        elif not acquire_slot(session.in_flight_slots):
+            self.send_response(session, error_message('Too many requests in flight'), message.request_id)
+        elif not acquire_slot(self.pending_slots):
+            release_slot(session.in_flight_slots)
+            self.send_response(session, error_message('Server busy'), message.request_id)
+        else:
+            session.in_flight[message.request_id] = message
+            self.executor.submit(self.respond, session, message, data) \
+                .add_done_callback(functools.partial(self.request_done, session, message.request_id))
+
+    def request_done(self, session, request_id, future):
+        """
+        Release the slots of a pipelined request once it is answered and its
+        response is written.
+
+        :param session: The Session of the client
+        :param request_id: The id of the request
+        :param future: The Future of the respond call
+        """
+        session.in_flight.pop(request_id, None)
+        if future.exception():
+            print(f"Failed to handle request from {session.address}: {future.exception()}")
+        with session.send_lock:
+            if not session.closed and session.written_bytes < session.queued_bytes:
+                # released by flush once everything queued so far is written
+                session.releases.append(session.queued_bytes)
+                return
+        self.release_request(session)
+
+    def release_request(self, session):
+        """
+        Release the slots of a pipelined request.
+
+        :param session: The Session of the client
+        """
+        release_slot(session.in_flight_slots)
+        release_slot(self.pending_slots)
+
+    def resume(self, session, future):
+        """
+        Read a connection again once the request that paused it is answered.
+
+        :param session: The Session of the client
+        :param future: The Future of the respond call
+        """
+        if session.closed:
+            return
+        session.paused = False
+        if future.exception():
+            print(f"Failed to handle request from {session.address}: {future.exception()}")
+            self.close_session(session)
+            return
+        self.process_frames(session)
+        if not session.closed:
+            self.update_events(session)
+
+    def send_encoded(self, session, encoded_response, request_id, attachments=(), timeout=None):
+        """
+        Queue an already encoded response tagged with the id of its request, it is
+        written by the event loop thread. Can be called from any thread.
+
+        :param session: The Session of the client
+        :param encoded_response: The encoded response (bytes)
+        :param request_id: The id of the request being answered (int or None)
+        :param attachments: The attachments of the response
+        :param timeout: Seconds to wait while too many responses are queued on the
+                        connection, None to wait forever. TimeoutError is raised when
+                        they run out, at once on the event loop thread
+        """
+        buffers = frame_buffers(encoded_response, self.max_frame_size, request_id, attachments)
+        on_loop = threading.current_thread() is self.loop_thread
+        with session.send_lock:
+            if on_loop:
+                # the event loop thread cannot wait, it stops reading the connection instead
+                if timeout is not None and session.backlogged:
+                    raise TimeoutError("Too many responses are queued")
+            elif not session.writable.wait_for(lambda: not session.backlogged or session.closed, timeout):
+                raise TimeoutError("Too many responses are queued")
+            if session.closed:
+                return
+            session.write_queue.extend(buffers)
+            session.queued_bytes += sum(len(buffer) for buffer in buffers)
+            if session.queued_bytes - session.written_bytes > self.max_queued_bytes:
+                session.backlogged = True
+            if self.capture is not None:
+                self.capture.response(session.number, request_id, frame_size(encoded_response, attachments))
+            if not on_loop:
+                if session.flush_scheduled:
+                    return
+                session.flush_scheduled = True
+
+        if on_loop:
+            self.flush(session)
+        else:
+            self.call_soon(self.flush, session)
+
+    def flush(self, session):
+        """
+        Write as much of the queued responses of a connection as the socket accepts.
+
+        :param session: The Session of the client
+        """
+        if session.closed:
+            return
+        session.write_wants_read = False
+        is_ssl = isinstance(session.connection, ssl.SSLSocket)
+        released = 0
+        resumed = False
+        with session.send_lock:
+            session.flush_scheduled = False
+            queue = session.write_queue
+            try:
+                while queue:
+                    if is_ssl:
+                        # SSL sockets do not implement sendmsg
+                        sent = session.connection.send(queue[0])
+                    else:
+                        sent = session.connection.sendmsg(list(itertools.islice(queue, MAX_SEND_BUFFERS)))
+                    session.written_bytes += sent
+                    while sent:
+                        if sent >= len(queue[0]):
+                            sent -= len(queue[0])
+                            queue.popleft()
+                        else:
+                            queue[0] = queue[0][sent:]
+                            sent = 0
+            except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError):
+                pass
+            except ssl.SSLWantReadError:
+                session.write_wants_read = True
+            except OSError as e:
+                print(f"Connection error from {session.address}: {e}")
+                queue.clear()
+                session.written_bytes = session.queued_bytes
+                session.close_after_flush = True
+
+            while session.releases and session.releases[0] <= session.written_bytes:
+                session.releases.popleft()
+                released += 1
+            if session.backlogged and session.queued_bytes - session.written_bytes <= self.max_queued_bytes // 2:
+                session.backlogged = False
+                session.writable.notify_all()
+                resumed = True
+
+        for _ in range(released):
+            self.release_request(session)
+        if session.close_after_flush and not queue:
+            self.close_session(session)
+        elif resumed:
+            # the frames already received first, then the socket, which may hold
+            # data the selector does not report again for SSL connections
+            self.process_frames(session)
+            self.receive(session)
+            if not session.closed:
+                self.update_events(session)
+        else:
+            self.update_events(session)
+
+    def close_session(self, session):
+        """
+        Close a connection and release its resources.
+
+        :param session: The Session of the client
+        """
+        if session.closed:
+            return
+        if session.started:
+            print(f"Closing connection to {session.address}")
+        with session.send_lock:
+            session.close()
+            session.write_queue.clear()
+            released = len(session.releases)
+            session.releases.clear()
+            session.writable.notify_all()
+        for _ in range(released):
+            self.release_request(session)
+        try:
+            self.selector.unregister(session.connection)
+        except (KeyError, ValueError):
+            pass
+        if session.started:
+            self.sessions.discard(session)
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            release_slot(self.connection_slots)
+            self.connection_type.disconnected(session.connection)
+        session.connection.close()
@@ -1,30 +1,256 @@
+import collections
+import functools
+import inspect
+import itertools
+import os
+import select
+import signal
 import socket
 import threading
+import time
+import traceback
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 import ssl
 from datetime import datetime, timezone, timedelta
-from .common  import read_socket
-from .message import Message
-from .encoder import Encoder
+from .common  import FrameError, FrameReader, MAX_FRAME_SIZE, check_max_frame_size, remove_socket_file, \
+                     remove_stale_socket, send_frame, set_nodelay, socket_address
+from .message import BATCH_METHOD, CANCEL_METHOD, CREDIT_METHOD, HELLO_METHOD, INVALIDATE_METHOD, METRICS_METHOD, \
+                     PING_METHOD, STREAM_END_METHOD, Message
+from .encoder import Encoder, JSONCodec
+from .cache   import make_cache
+from .metrics import NO_TIMER, Metrics
+from .interceptor import Call, frame_size, run_after, run_before
+from .capture import CaptureWriter
 from .connection.server import *
 
+# Seconds a stopped server waits for the requests being answered, by default
+DRAIN_TIMEOUT = 10.0
+# Interval at which a draining server checks the requests being answered
+DRAIN_POLL_INTERVAL = 0.05
+# Interval at which the workers of run_workers check whether they are stopped
+WORKER_ACCEPT_TIMEOUT = 1.0
+# Delay before a crashed worker is restarted, doubled for each recent restart
+WORKER_RESTART_DELAY = 0.1
+WORKER_MAX_RESTART_DELAY = 10.0
+# Seconds a pushed message waits for a connection to take it, before the connection is dropped
+PUSH_TIMEOUT = 1.0
+
+
+def error_message(reason):
+    """
+    Build the error Message sent back when a request cannot be handled.
+
+    :param reason: Description of the error (str)
+    :return: Message with method 'error'
+    """
+    return Message(
+        method='error',
+        args=[reason],
+        options={}
+    )
+
+
+def expired_message(message):
+    """
+    Build the error Message answering a request that expired or was cancelled
+    before its response was sent.
+
+    :param message: The request Message
+    :return: Message with method 'error'
+    """
+    return error_message('Cancelled' if message.cancelled else 'Deadline exceeded')
+
+
+def acquire_slot(slots):
+    """
+    Take a slot from a semaphore without blocking.
+
+    :param slots: BoundedSemaphore limiting a resource, None if unlimited
+    :return: True if the slot was taken
+    """
+    return slots is None or slots.acquire(blocking=False)
+
+
+def release_slot(slots):
+    """
+    Give back a slot taken with acquire_slot.
+
+    :param slots: BoundedSemaphore limiting a resource, None if unlimited
+    """
+    if slots is not None:
+        slots.release()
+
+
+def run_in_process(handler, encoder, message=None, shared_name=None, size=0, request_id=None):
+    """
+    Run a handler in a worker process of the process pool.
+
+    The request is either the pickled message, or the encoded frame payload stored
+    in a shared memory block that is decoded here.
+
+    :param handler: The registered handler function
+    :param encoder: Encoder instance used to decode the payload
+    :param message: The request Message, if not passed through shared memory
+    :param shared_name: Name of the shared memory block holding the payload
+    :param size: Size of the payload in the shared memory block
+    :param request_id: The id of the request
+    :return: The response Message returned by the handler
+    """
+    if shared_name is not None:
+        shared = SharedMemory(name=shared_name)
+        try:
+            message = encoder.decode(bytes(shared.buf[:size]), request_id)
+        finally:
+            shared.close()
+    if message.expired():
+        # waited too long in the queue of the pool
+        return expired_message(message)
+    return handler(message)
+
+
+class Session(object):
+    """
+    State of a client connection on the server.
+
+    :param connection: The socket of the client, or its asyncio.StreamWriter on AsyncServer
+    :param address: The address of the client (tuple)
+    :param encoder: Encoder instance used on this connection
+    :param max_in_flight: Maximum number of pipelined requests in flight (int)
+    :param stream_window: Number of chunks a stream can send ahead of the credit granted by the client (int)
+    :param number: Number of the connection on the server, in the order they were accepted (int)
+    """
+
+    def __init__(self, connection, address, encoder, max_in_flight=None, stream_window=16, number=0):
+        """
+        Initialize a Session object.
+
+        :param connection: The socket of the client, or its asyncio.StreamWriter
+        :param address: The address of the client
+        :param encoder: Encoder instance used on this connection
+        :param max_in_flight: Maximum number of pipelined requests in flight, None if unlimited
+        :param stream_window: Number of chunks a stream can send ahead of the credit
+                              granted by the client
+        :param number: Number of the connection on the server, it identifies the
+                       connection in capture logs
+        """
+        self.connection = connection
+        self.address = address
+        self.encoder = encoder
+        self.number = number
+        self.send_lock = threading.Lock()
+        self.in_flight_slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.stream_window = stream_window
+        self.streams = {}  # request id -> semaphore counting the credit of the stream
+        self.in_flight = {}  # request id -> Message of the pipelined requests being answered
+        self.busy = False  # a request without id is being answered
+        self.closed = False
+
+    def grant_credit(self, request_id, count):
+        """
+        Let a stream send more chunks, on a credit message from the client.
+
+        :param request_id: The id of the request being streamed
+        :param count: Number of chunks the client consumed
+        """
+        credit = self.streams.get(request_id)
+        if credit is None:
+            return
+        for _ in range(min(int(count), self.stream_window)):
+            credit.release()
+
+    def cancel(self, request_id):
+        """
+        Mark a pipelined request cancelled, on a cancel message from the client. The
+        handler is not run if it has not started, and a stream stops at its next chunk.
+
+        :param request_id: The id of the request
+        """
+        message = self.in_flight.get(request_id)
+        if message is None:
+            # already answered
+            return
+        message.cancelled = True
+        credit = self.streams.get(request_id)
+        if credit is not None:
+            # wakes up a stream waiting for credit
+            credit.release()
+
+    def close(self):
+        """
+        Mark the connection closed and wake up the streams waiting for credit.
+        """
+        self.closed = True
+        for credit in list(self.streams.values()):
+            credit.release()
+
 
 class Server(object):
     """
     Represents a server that handles incoming client connections and processes messages.
 
-    :param host: Host address to bind the server (str)
+    :param host: Host address to bind the server, or unix:// followed by the path of a Unix domain socket (str)
     :param port: Port number to listen on (int)
     :param encoder: Encoder instance for encoding/decoding messages
+    :param max_frame_size: Maximum size of a single message frame (int)
+    :param backlog: Size of the accept backlog of the listening socket (int)
+    :param max_connections: Maximum number of concurrent client connections (int)
+    :param max_in_flight: Maximum number of pipelined requests in flight per connection (int)
+    :param handler_threads: Number of threads running the handlers of pipelined requests (int)
+    :param max_pending: Maximum number of pipelined requests queued or running on all connections (int)
+    :param process_workers: Number of processes running the handlers registered with executor="process" (int)
+    :param shared_memory_threshold: Payload size from which requests go to the processes through shared memory (int)
+    :param stream_window: Number of chunks a stream can send ahead of the credit granted by the client (int)
+    :param metrics: Record per method latency histograms and counters, see metrics_snapshot (bool)
+    :param capture: Path of a capture log recording the traffic of the server, see start_capture (str)
+    :param drain_timeout: Seconds a stopped server waits for the requests being answered (float)
+    :param push_timeout: Seconds a pushed message waits for a connection to take it (float)
     """
 
-    def __init__(self, host='localhost', port=10000, encoder=None,connection_type=PlainConnection()):
+    def __init__(self, host='localhost', port=10000, encoder=None,connection_type=PlainConnection(),
+                 max_frame_size=MAX_FRAME_SIZE, backlog=5, max_connections=None, max_in_flight=None,
+                 handler_threads=None, max_pending=None, process_workers=None,
+                 shared_memory_threshold=64 * 1024, stream_window=16, metrics=False, capture=None,
+                 drain_timeout=DRAIN_TIMEOUT, push_timeout=PUSH_TIMEOUT):
         """
         Initialize a Server object.
 
-        :param host: Host address to bind the server
+        Connections and requests over the limits are not queued: they are answered
+        right away with an error Message, so an overloaded server stays responsive.
+        A limit of None means unlimited.
+
+        :param host: Host address to bind the server, or unix:// followed by the path of a Unix domain socket
         :param port: Port number to listen on
         :param encoder: Encoder instance for encoding/decoding messages
+        :param max_frame_size: Maximum size of a single message frame, at most
+                               MAX_PAYLOAD_SIZE (2 GiB - 1), ValueError is raised above it
+        :param backlog: Size of the accept backlog of the listening socket
+        :param max_connections: Maximum number of concurrent client connections
+        :param max_in_flight: Maximum number of pipelined requests in flight per connection
+        :param handler_threads: Number of threads running the handlers of pipelined
+                                requests, None for the ThreadPoolExecutor default
+        :param max_pending: Maximum number of pipelined requests queued or running on
+                            all connections
+        :param process_workers: Number of processes running the handlers registered with
+                                executor="process", None for the number of CPUs
+        :param shared_memory_threshold: Requests whose encoded payload is at least this big
+                                        are passed to the processes through shared memory
+                                        instead of being pickled
+        :param stream_window: Number of chunks a pipelined stream can send before the
+                              client grants more credit, so a slow consumer does not make
+                              the client buffer without limit
+        :param metrics: Record the number of requests, errors and bytes and the latency
+                        histograms of the decoding, the handler and the encoding and sending
+                        of the requests of every method, and the connection gauges. Clients
+                        can read them with the metrics method
+        :param capture: Path of a capture log to record the traffic of the server into,
+                        None to not capture it. See start_capture
+        :param drain_timeout: Seconds a stopped server waits for the requests being
+                              answered before its event loop or process ends, see drain
+        :param push_timeout: Seconds a pushed message waits for a connection that is busy
+                             or does not read, before the connection is dropped, see push
         """
         self.host = host
         self.port = port
@@ -33,99 +259,854 @@ class Server(object):
         self.method_handlers = {}
         self.encoder = encoder  # Encoder instance passed as an argument
         self.connection_type = connection_type
+        self.max_frame_size = check_max_frame_size(max_frame_size)
+        self.backlog = backlog
+        self.max_in_flight = max_in_flight
+        # runs the handlers of pipelined requests, so they can be answered out of order
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix='mcssl-handler')
+        self.connection_slots = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.pending_slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.process_methods = set()
+        self.caches = {}  # method -> ResponseCache of the methods registered with cache
+        self.process_workers = process_workers
+        self.process_pool = None  # created on first use, after the workers are forked
+        self.process_pool_lock = threading.Lock()
+        self.sessions = set()  # Sessions of the connected clients
+        self.shared_memory_threshold = shared_memory_threshold
+        self.stream_window = stream_window
+        self.metrics = Metrics() if metrics else None
+        self.interceptors = []  # Interceptors run around every request, in order
+        self.connection_numbers = itertools.count(1)
+        self.capture = None  # CaptureWriter while the traffic is captured
+        self.drain_timeout = drain_timeout
+        self.push_timeout = push_timeout
+        if capture is not None:
+            self.start_capture(capture)
 
-    def start_server(self):
-        """
-        Start the server by binding to the address and listening for connections.
+    def create_server_socket(self, reuse_port=False):
         """
-        # Create a TCP/IP socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = (self.host, self.port)
+        Create the listening socket of the server.
 
-        print(f'Starting up on {server_address[0]} port {server_address[1]}')
+        :param reuse_port: Set SO_REUSEPORT so several processes can bind the same port
+        :return: The bound and listening socket
+        """
+        family, server_address = socket_address(self.host, self.port)
+        if family == socket.AF_UNIX:
+            if reuse_port:
+                raise ValueError("reuse_port is not supported by Unix domain sockets")
+            print(f'Starting up on {self.host}')
+            remove_stale_socket(server_address)
+        else:
+            print(f'Starting up on {server_address[0]} port {server_address[1]}')
 
+        # Create a TCP/IP or Unix domain socket
+        server_socket = socket.socket(family, socket.SOCK_STREAM)
         try:
-            self.server_socket.bind(server_address)
-            self.server_socket.listen(5)  # Listen for incoming connections
+            if reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind(server_address)
+            server_socket.listen(self.backlog)  # Listen for incoming connections
         except Exception as e:
             print(f"Failed to start server: {e}")
+            server_socket.close()
             raise
+        return server_socket
+
+    def start_server(self, server_socket=None):
+        """
+        Start the server by binding to the address and listening for connections.
+
+        :param server_socket: Already listening socket to accept connections from,
+                              created if not given. It is left open when the server stops
+        """
+        created = server_socket is None
+        self.server_socket = server_socket if server_socket is not None else self.create_server_socket()
         try:
-            while not self.stop_main_thread:
-                try:
-                    client_connection, client_address = self.server_socket.accept()
-                    wrapped_connection = self.connection_type.wrap_socket(client_connection)
-                    threading.Thread(target=self.handle_client, 
-                                 args=(wrapped_connection,client_address)).start()
-                except ssl.SSLError as ex:
-                    print("SSL Error")
-        except Exception as e:
-            print(e)
+            try:
+                while not self.stop_main_thread:
+                    try:
+                        client_connection, client_address = self.server_socket.accept()
+                        self.serve_connection(client_connection, client_address)
+                    except TimeoutError:
+                        # the sockets of the workers time out to check stop_main_thread
+                        pass
+                    except ssl.SSLError as ex:
+                        print("SSL Error")
+            except Exception as e:
+                print(e)
+            self.drain()
+        finally:
+            if created:
+                remove_socket_file(self.host)
+                self.server_socket.close()
+
+    def serve_connection(self, client_connection, client_address):
+        """
+        Wrap a connected socket with the connection type of the server and handle
+        the client on its own thread, or reject it if there are too many connections.
 
-    def register_method(self):
+        :param client_connection: The connected socket of the client (socket)
+        :param client_address: The address of the client
+        """
+        set_nodelay(client_connection)
+        wrapped_connection = self.connection_type.wrap_socket(client_connection)
+        if not acquire_slot(self.connection_slots):
+            print(f"Rejecting connection from {client_address}: too many connections")
+            if self.metrics is not None:
+                self.metrics.connection_rejected()
+            self.reject_connection(wrapped_connection, client_address)
+            return
+        self.connection_type.connected(wrapped_connection)
+        threading.Thread(target=self.handle_client, 
+                     args=(wrapped_connection,client_address)).start()
+
+    def socketpair(self):
+        """
+        Create a connected pair of sockets, handle one end like an accepted client
+        connection and return the other one, e.g. to connect a Client to the
+        server in the same process without a listening socket:
+
+            client.connect(server.socketpair())
+
+        :return: The client end of the pair (socket)
+        """
+        server_end, client_end = socket.socketpair()
+
+        def serve():
+            try:
+                self.serve_connection(server_end, 'socketpair')
+            except ssl.SSLError:
+                print("SSL Error")
+                server_end.close()
+
+        # the TLS handshake of the server end needs the client to connect
+        threading.Thread(target=serve, daemon=True).start()
+        return client_end
+
+    def start_capture(self, path):
+        """
+        Start recording the received frames, and the ids and sizes of the sent ones,
+        into a capture log that mcssl.replay sends again to a server, e.g. to
+        reproduce production traffic:
+
+            python -m mcssl.replay traffic.capture --port 10000 --speed 2
+
+        With run_workers, each worker captures its own traffic into the log path
+        followed by its pid, and the worker number is in the top 8 bits of the
+        connection numbers.
+
+        :param path: Path of the capture log, overwritten if it exists
+        """
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+        print(f"Capturing traffic into {path}")
+
+    def stop_capture(self):
+        """
+        Stop recording the traffic and flush the capture log.
+        """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+            print(f"Captured {capture.records} frames into {capture.path}")
+
+    def add_interceptor(self, interceptor):
+        """
+        Add an interceptor run around every request, after those already added.
+        See Interceptor.
+
+        :param interceptor: Interceptor instance
+        :return: The interceptor
+        """
+        self.interceptors.append(interceptor)
+        return interceptor
+
+    def register_method(self, executor=None, cache=None):
         """
         Register a handler function for a specific message method.
 
+        A handler returns the response Message, or is a generator yielding the response
+        as many Message chunks which are sent as soon as they are yielded. The stream
+        is ended by a message with method STREAM_END_METHOD.
+
+        Requests whose deadline passed, or cancelled by the client, are answered with
+        an error without running the handler. Handlers can bound their work with
+        message.remaining() and check message.expired() while they run.
+
+        :param executor: Where the handler runs: None to run it on the thread handling
+                         the request, "process" to run CPU-heavy handlers in a process pool
+                         outside the GIL. Process handlers must be module level functions
+        :param cache: Cache the encoded responses of a handler that only depends on the args
+                      and options of the request: True for the defaults, a dictionary of
+                      ResponseCache arguments (max_entries, ttl, max_bytes) or a
+                      ResponseCache instance. Error responses and streams are not cached
         :return: Decorator function to register the handler
         """
+        if executor not in (None, 'process'):
+            raise ValueError(f"Unknown executor: {executor}")
+
+        cache = make_cache(cache)
+
         def decorator(func):
+            if executor == 'process' and (inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)):
+                raise ValueError("Generator handlers cannot run in the process pool")
             self.method_handlers[func.__name__] = func
+            if executor == 'process':
+                self.process_methods.add(func.__name__)
+            else:
+                self.process_methods.discard(func.__name__)
+            if cache is not None:
+                self.caches[func.__name__] = cache
+            else:
+                self.caches.pop(func.__name__, None)
             return func
         return decorator
 
+    def invalidate(self, method, *args, **options):
+        """
+        Tell that the responses of a method changed: remove them from its cache, if
+        it was registered with cache, and push an invalidation message to all the
+        connected clients so they drop them from their own cache.
+
+        :param method: Name of the method
+        :param args: Positional arguments of the request whose responses changed
+        :param options: Keyword arguments of the request whose responses changed.
+                        Without args and options all the responses of the method changed
+        :return: The number of responses removed from the cache of the server
+        """
+        removed = 0
+        cache = self.caches.get(method)
+        if cache is not None:
+            removed = cache.invalidate(list(args), options) if args or options else cache.invalidate()
+
+        self.push(Message(method=INVALIDATE_METHOD,
+                          args=[method, list(args), options] if args or options else [method]))
+        return removed
+
+    def push(self, message):
+        """
+        Send a message, without request id, to all the connected clients.
+
+        A client that does not take the message within push_timeout, because it does
+        not read its connection or a large response is being sent to it, is dropped
+        rather than holding up the push to the other clients, so it cannot keep
+        responses that were invalidated.
+
+        :param message: The Message to send
+        """
+        for session in list(self.sessions):
+            try:
+                self.send_response(session, message, None, self.push_timeout)
+            except TimeoutError:
+                print(f"Dropping {session.address}: the connection does not take pushed messages")
+                self.drop_session(session)
+            except OSError as e:
+                print(f"Failed to push to {session.address}: {e}")
+
+    def drop_session(self, session):
+        """
+        Close a client connection from another thread than the one serving it, which
+        then cleans the connection up. Can be called from any thread.
+
+        :param session: The Session of the client
+        """
+        try:
+            session.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def cache_stats(self):
+        """
+        :return: Dictionary of the hit/miss counters of the cache of every cached method
+        """
+        return {method: cache.stats() for method, cache in self.caches.items()}
+
+    def submit_to_process(self, handler, message, payload=None, encoder=None):
+        """
+        Run a handler in the process pool.
+
+        :param handler: The registered handler function
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :param encoder: Encoder instance that decodes the payload
+        :return: concurrent.futures.Future of the response Message
+        """
+        with self.process_pool_lock:
+            if self.process_pool is None:
+                # the workers must share the resource tracker of the server, which owns
+                # and unlinks the shared memory blocks
+                resource_tracker.ensure_running()
+                self.process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+
+        # attachments are not part of the payload, such messages are pickled
+        if payload is None or len(payload) < self.shared_memory_threshold or message.attachments:
+            return self.process_pool.submit(run_in_process, handler, None, message)
+
+        shared = SharedMemory(create=True, size=len(payload))
+        shared.buf[:len(payload)] = payload
+
+        def release(future):
+            shared.close()
+            shared.unlink()
+
+        future = self.process_pool.submit(run_in_process, handler, encoder or self.encoder, None,
+                                          shared.name, len(payload), message.request_id)
+        future.add_done_callback(release)
+        return future
+
+    def call_handler(self, handler, message, payload=None, encoder=None):
+        """
+        Invoke a handler where it was registered to run.
+
+        :param handler: The registered handler function
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :param encoder: Encoder instance that decodes the payload
+        :return: The response Message
+        """
+        if message.method in self.process_methods:
+            return self.submit_to_process(handler, message, payload, encoder).result()
+        if message.expired():
+            return expired_message(message)
+        return handler(message)
+
+    def dispatch(self, message, payload=None, encoder=None):
+        """
+        Invoke the handler registered for the method of the message.
+
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :param encoder: Encoder instance that decodes the payload
+        :return: The response Message returned by the handler, or an error Message
+        """
+        if message.method == BATCH_METHOD:
+            return self.dispatch_batch(message, encoder)
+
+        handler = self.method_handlers.get(message.method)
+        if handler:
+            return self.call_handler(handler, message, payload, encoder)
+
+        return error_message('Unknown method')
+
+    def dispatch_batch(self, message, encoder=None):
+        """
+        Invoke the handlers of all the requests of a batch, in order.
+
+        :param message: The received batch Message
+        :param encoder: Encoder instance of the connection
+        :return: Batch Message with the responses, in the order of the requests
+        """
+        responses = []
+        for data in message.args:
+            if message.expired():
+                responses.append(expired_message(message))
+                continue
+            if not isinstance(data, dict):
+                responses.append(error_message('Malformed batch request'))
+                continue
+            response_message = self.dispatch(Message.from_dict(data), None, encoder)
+            if inspect.isgenerator(response_message):
+                response_message.close()
+                response_message = error_message('Cannot stream in a batch')
+            responses.append(response_message)
+        return Message.batch(responses)
+
+    def negotiate_codec(self, session, message):
+        """
+        Answer the codec handshake of a client and switch the connection to the
+        codec both sides agree on.
+
+        :param session: The Session of the client
+        :param message: The hello Message listing the codecs proposed by the client
+        """
+        codec = self.encoder.choose_codec(message.args)
+        self.send_response(session, Message(method=HELLO_METHOD, args=[codec]), message.request_id)
+        session.encoder = self.encoder.with_codec(codec)
+        print(f"Using codec {codec} with {session.address}")
+
+    def send_response(self, session, response_message, request_id, timeout=None):
+        """
+        Encode and send a response tagged with the id of its request.
+
+        :param session: The Session of the client
+        :param response_message: The Message to send
+        :param request_id: The id of the request being answered (int or None)
+        :param timeout: Seconds to wait for the connection to take the response, see send_encoded
+        :return: Size of the response frame
+        """
+        # Encode the response before sending it
+        encoded_response = session.encoder.encode(response_message)
+        self.send_encoded(session, encoded_response, request_id, response_message.attachments, timeout)
+        return frame_size(encoded_response, response_message.attachments)
+
+    def send_encoded(self, session, encoded_response, request_id, attachments=(), timeout=None):
+        """
+        Send an already encoded response tagged with the id of its request.
+
+        :param session: The Session of the client
+        :param encoded_response: The encoded response (bytes)
+        :param request_id: The id of the request being answered (int or None)
+        :param attachments: The attachments of the response
+        :param timeout: Seconds to wait for another response being sent on the connection
+                        and then for the socket to be writable, None to wait forever.
+                        TimeoutError is raised when they run out, before anything is
+                        sent. Meant for small messages, which a writable socket takes
+                        at once
+        """
+        if not session.send_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError("Another response is being sent")
+        try:
+            if timeout is not None and not select.select([], [session.connection], [], timeout)[1]:
+                raise TimeoutError("The connection is not writable")
+            send_frame(session.connection, encoded_response, self.max_frame_size, request_id, attachments)
+        finally:
+            session.send_lock.release()
+        if self.capture is not None:
+            self.capture.response(session.number, request_id, frame_size(encoded_response, attachments))
+
+    def cached_response(self, session, message):
+        """
+        Look up the cached response of a request.
+
+        :param session: The Session of the client
+        :param message: The received Message object
+        :return: Tuple of the cache of the method, the cache key of the request and the
+                 cached response (tuple of the encoded response and its attachments, or
+                 None on a miss). The cache is None if the method is not cached
+        """
+        cache = self.caches.get(message.method)
+        if cache is None:
+            return None, None, None
+        key = cache.key(message, session.encoder.codec.name)
+        return cache, key, cache.get(key)
+
+    def start_timer(self, message, payload=None):
+        """
+        Start measuring a request, if metrics are enabled.
+
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :return: RequestTimer of the request, or NO_TIMER when metrics are disabled
+        """
+        if self.metrics is None:
+            return NO_TIMER
+        known = message.method in self.method_handlers or message.method == BATCH_METHOD
+        return self.metrics.timer(message, payload, known, message.method not in self.process_methods)
+
+    def metrics_snapshot(self):
+        """
+        :return: Dictionary of the metrics of the server, see Metrics.snapshot, or None
+                 if metrics are disabled
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
+
+    def metrics_response(self):
+        """
+        Build the answer to a metrics request of a client.
+
+        :return: Message whose only argument is the metrics snapshot, or an error Message
+        """
+        if self.metrics is None:
+            return error_message('Metrics are disabled')
+        return Message(method=METRICS_METHOD, args=[self.metrics.snapshot()])
+
+    def respond(self, session, message, payload=None):
+        """
+        Dispatch a message and send the response tagged with the id of the request,
+        running the interceptors around it.
+
+        :param session: The Session of the client
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        """
+        if not self.interceptors:
+            self.answer(session, message, payload)
+            return
+
+        call = Call(message, session.address, frame_size(payload, message.attachments))
+        try:
+            response_message = run_before(self.interceptors, call)
+            if response_message is not None:
+                call.response = response_message
+                call.response_size = self.send_response(session, response_message, message.request_id)
+            else:
+                call.response, call.response_size = self.answer(session, message, payload)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            run_after(self.interceptors, call)
+
+    def answer(self, session, message, payload=None):
+        """
+        Answer a message from the cache of its method, or dispatch it, and send the
+        response tagged with the id of the request.
+
+        :param session: The Session of the client
+        :param message: The received Message object
+        :param payload: The encoded frame payload of the message, if available
+        :return: Tuple of the response Message, None if it came from the cache or was
+                 streamed, and the size of the response frame
+        """
+        timer = self.start_timer(message, payload)
+        cache, key, cached = self.cached_response(session, message)
+        if cached is not None:
+            timer.handled(cache_hit=True)
+            try:
+                self.send_encoded(session, cached[0], message.request_id, cached[1])
+            except BaseException:
+                timer.unsent()
+                raise
+            timer.sent(cached[0], cached[1])
+            return None, frame_size(cached[0], cached[1])
+
+        # Handle incoming message by invoking registered handlers or error handling
+        try:
+            response_message = self.dispatch(message, payload, session.encoder)
+        except BaseException:
+            timer.failed()
+            raise
+        timer.handled()
+        streamed = inspect.isgenerator(response_message)
+        try:
+            if streamed:
+                self.send_stream(session, response_message, message.request_id, message)
+            else:
+                if message.cancelled:
+                    # the client no longer waits for the response
+                    response_message = expired_message(message)
+                encoded_response = session.encoder.encode(response_message)
+                if cache is not None and response_message.method != 'error':
+                    cache.put_encoded(key, encoded_response, response_message.attachments)
+                self.send_encoded(session, encoded_response, message.request_id, response_message.attachments)
+        except BaseException:
+            # the request does not stay active in the metrics
+            timer.unsent()
+            raise
+        if streamed:
+            timer.sent()
+            return None, 0
+        timer.sent(encoded_response, response_message.attachments, response_message.method == 'error')
+        return response_message, frame_size(encoded_response, response_message.attachments)
+
+    def send_stream(self, session, chunks, request_id, request=None):
+        """
+        Send the chunks yielded by a generator handler as they are produced, then
+        the end of stream message.
+
+        Pipelined streams only send stream_window chunks ahead of the credit granted
+        by the client with credit messages. Requests without an id are answered on the
+        thread reading the connection, so their chunks are only slowed down by the socket.
+        A stream whose request expires or is cancelled ends with an error instead.
+
+        :param session: The Session of the client
+        :param chunks: Generator yielding the response Messages
+        :param request_id: The id of the request being answered (int or None)
+        :param request: The request Message, to stop at its deadline
+        """
+        credit = None
+        if request_id is not None:
+            credit = threading.Semaphore(session.stream_window)
+            session.streams[request_id] = credit
+        end_message = Message(method=STREAM_END_METHOD)
+        try:
+            for chunk in chunks:
+                if credit is not None:
+                    credit.acquire()
+                if session.closed:
+                    return
+                if request is not None and request.expired():
+                    end_message = expired_message(request)
+                    return
+                self.send_response(session, chunk, request_id)
+        finally:
+            chunks.close()
+            session.streams.pop(request_id, None)
+            if not session.closed:
+                self.send_response(session, end_message, request_id)
+
+    def reject_connection(self, client_connection, client_address):
+        """
+        Tell a client the server is busy and close its connection.
+
+        :param client_connection: The socket connection object for the client (socket)
+        :param client_address: The address of the connected client (tuple)
+        """
+        try:
+            self.send_response(self.create_session(client_connection, client_address),
+                               error_message('Server busy'), None)
+        except OSError:
+            pass
+        finally:
+            client_connection.close()
+
+    def create_session(self, connection, address):
+        """
+        Create the state of a new client connection. Connections start with the
+        JSON codec until the client asks for another one.
+
+        :param connection: The socket of the client
+        :param address: The address of the client (tuple)
+        :return: Session instance
+        """
+        encoder = self.encoder.for_connection()
+        if encoder.codec.name != JSONCodec.name:
+            encoder = encoder.with_codec(JSONCodec.name)
+        return Session(connection, address, encoder, self.max_in_flight, self.stream_window,
+                       next(self.connection_numbers))
+
     def handle_client(self, client_connection, client_address):
         """
         Handle communication with a connected client.
 
+        Messages without a request id are answered in order on this thread, pipelined
+        requests are handled by the executor and answered as soon as they complete.
+
         :param client_connection: The socket connection object for the client (socket)
         :param client_address: The address of the connected client (tuple)
         """
         print(f"Connection from {client_address}")
 
+        frame_reader = FrameReader(client_connection, self.max_frame_size)
+        session = self.create_session(client_connection, client_address)
+        self.sessions.add(session)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+        def request_done(request_id, future):
+            session.in_flight.pop(request_id, None)
+            release_slot(session.in_flight_slots)
+            release_slot(self.pending_slots)
+            if future.exception():
+                print(f"Failed to handle request from {client_address}: {future.exception()}")
+
         try:
             while True:
-                data = read_socket(client_connection)
-                if len(data) == 0:
-                    client_connection.close()
+                try:
+                    frame = frame_reader.read_frame()
+                except FrameError as e:
+                    print(f"Invalid frame from {client_address}: {e}")
+                    return
+                if frame is None:
                     return
+                request_id, data, attachments = frame
 
-                # Decode the received message after receiving it completely
-                decoded_data = self.encoder.decode_message(data)
-                message = Message.from_json(decoded_data)
+                # Only the method is decoded here, so requests can be routed or
+                # rejected without decoding their arguments
+                try:
+                    message = session.encoder.decode(data, request_id, lazy=True)
+                except FrameError as e:
+                    print(f"Invalid frame from {client_address}: {e}")
+                    return
+                if attachments:
+                    message.attachments = attachments
+                if self.capture is not None:
+                    self.capture.request(session.number, message.method, request_id, data, attachments)
 
-                # Handle incoming message by invoking registered handlers or error handling
-                handler = self.method_handlers.get(message.method)
-                if handler:
-                    response_message = handler(message)
+                if message.method == HELLO_METHOD:
+                    self.negotiate_codec(session, message)
+                elif message.method == PING_METHOD:
+                    self.send_response(session, Message(method=PING_METHOD), message.request_id)
+                elif message.method == METRICS_METHOD:
+                    self.send_response(session, self.metrics_response(), message.request_id)
+                elif message.method == CREDIT_METHOD:
+                    session.grant_credit(message.request_id, message.args[0])
+                elif message.method == CANCEL_METHOD:
+                    session.cancel(message.request_id)
+                elif message.request_id is None:
+                    session.busy = True
+                    try:
+                        self.respond(session, message, data)
+                    finally:
+                        session.busy = False
+                elif not acquire_slot(session.in_flight_slots):
+                    self.send_response(session, error_message('Too many requests in flight'), message.request_id)
+                elif not acquire_slot(self.pending_slots):
+                    release_slot(session.in_flight_slots)
+                    self.send_response(session, error_message('Server busy'), message.request_id)
                 else:
-                    response_message = Message(
-                        method='error',
-                        args=['Unknown method'],
-                        options={}
-                    )
-
-                # Encode the response before sending it
-                encoded_response = self.encoder.encode_message(response_message.to_json())
-                client_connection.sendall(encoded_response)
+                    session.in_flight[message.request_id] = message
+                    self.executor.submit(self.respond, session, message, data) \
+                        .add_done_callback(functools.partial(request_done, message.request_id))
 
         finally:
             # Clean up the connection
             print(f"Closing connection to {client_address}")
+            session.close()
+            self.sessions.discard(session)
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            release_slot(self.connection_slots)
+            self.connection_type.disconnected(client_connection)
             client_connection.close()
 
     def stop_server(self):
         self.stop_main_thread = True
+        self.stop_capture()
 
         # makes a dummy connection just to unlock accept method
         # and trigger the graceful stop
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((self.host,self.port))
+        family, server_address = socket_address(self.host, self.port)
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as dummy:
+                dummy.connect(server_address)
+        except OSError:
+            # not listening anymore
+            pass
 
+    def idle(self):
+        """
+        :return: True if no request is being answered
+        """
+        return not any(session.busy or session.in_flight for session in list(self.sessions))
 
-    def run(self):
+    def drain(self, timeout=None):
         """
-        Run the server loop, accepting and handling client connections.
+        Wait for the requests being answered, once the server stopped accepting
+        connections, so they are not cut short when the process ends.
+
+        :param timeout: Maximum number of seconds to wait, drain_timeout if None
+        :return: True if no request is left
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.drain_timeout)
+        while not self.idle():
+            if time.monotonic() >= deadline:
+                print("Stopping with requests still being answered")
+                return False
+            time.sleep(DRAIN_POLL_INTERVAL)
+        return True
+
+    def serve_worker(self, server_socket):
+        """
+        Serve connections in a worker process forked by run_workers.
+
+        :param server_socket: The listening socket of the worker
+        """
+        # the worker does not block in accept, so it sees stop_main_thread even when the
+        # dummy connection of stop_server reaches another worker
+        server_socket.settimeout(WORKER_ACCEPT_TIMEOUT)
+        self.start_server(server_socket)
+
+    def run_workers(self, workers, reuse_port=False, max_restarts=10, restart_window=60.0):
+        """
+        Fork worker processes that each run the accept/handle loop of the server and
+        supervise them: dead workers are restarted, SIGINT and SIGTERM stop them all.
+        Blocks until the workers are stopped.
+
+        The workers share the listening socket created here, or with reuse_port each
+        one binds its own socket with SO_REUSEPORT and the kernel balances the
+        connections between them. On SIGTERM a worker stops accepting connections and
+        waits for the requests being answered, see drain_timeout.
+
+        Workers are restarted after a delay that doubles with each recent restart, and
+        when they keep dying the other workers are stopped and RuntimeError is raised.
+        A capture started on the server is replaced by one log per worker, see start_capture.
+
+        :param workers: Number of worker processes
+        :param reuse_port: Bind one socket per worker with SO_REUSEPORT
+        :param max_restarts: Maximum number of restarts within restart_window
+        :param restart_window: Seconds over which the restarts are counted
         """
+        listening_socket = None if reuse_port else self.create_server_socket()
+        children = set()
+        stopping = False
+        restarts = collections.deque()  # times of the recent restarts
+        gave_up = False
+        worker_numbers = itertools.count(1)
 
+        # a writer inherited by the workers would mix their records, each one opens its own
+        capture_path = None
+        if self.capture is not None:
+            capture_path = self.capture.path
+            self.capture.close()
+            self.capture = None
+            os.unlink(capture_path)
+
+        def spawn():
+            worker = next(worker_numbers)
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_server())
+                self.connection_numbers = itertools.count(((worker & 0xFF) << 24) + 1)
+                if capture_path is not None:
+                    self.start_capture(f"{capture_path}.{os.getpid()}")
+                status = 1
+                try:
+                    self.serve_worker(listening_socket or self.create_server_socket(reuse_port=True))
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    self.stop_capture()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            children.add(pid)
+
+        def shutdown(signum, frame):
+            nonlocal stopping
+            if stopping:
+                return
+            print('Shutting down workers...')
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        for _ in range(workers):
+            spawn()
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            children.discard(pid)
+            if stopping:
+                continue
+
+            now = time.monotonic()
+            while restarts and restarts[0] < now - restart_window:
+                restarts.popleft()
+            if len(restarts) >= max_restarts:
+                print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, "
+                      f"{len(restarts)} restarts in {restart_window} seconds, giving up")
+                gave_up = True
+                shutdown(None, None)
+                continue
+
+            delay = min(WORKER_RESTART_DELAY * 2 ** len(restarts), WORKER_MAX_RESTART_DELAY)
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, "
+                  f"restarting it in {delay:.1f} seconds")
+            restarts.append(now)
+            while not stopping and time.monotonic() < now + delay:
+                time.sleep(DRAIN_POLL_INTERVAL)
+            if not stopping:
+                spawn()
+
+        if listening_socket is not None:
+            remove_socket_file(self.host)
+            listening_socket.close()
+        if gave_up:
+            raise RuntimeError("Workers keep exiting")
+
+    def run(self, workers=None, reuse_port=False):
+        """
+        Run the server loop, accepting and handling client connections.
+
+        :param workers: If set, run that many worker processes with run_workers instead
+                        of a single server thread. This call then blocks until the
+                        workers are stopped
+        :param reuse_port: With workers, bind one socket per worker with SO_REUSEPORT
+        """
+        if workers:
+            self.run_workers(workers, reuse_port)
+            return
 
         try:
             self.main_thread = threading.Thread(target=self.start_server,args=())
@@ -0,0 +1,119 @@
+import shutil
+import socket
+import subprocess
+import time
+
+import pytest
+
+from mcssl.asyncserver import AsyncServer
+from mcssl.client import Client
+from mcssl.encoder import Encoder
+from mcssl.selectorserver import SelectorServer
+from mcssl.server import Server
+
+SERVER_TYPES = [Server, AsyncServer, SelectorServer]
+
+
+def free_port():
+    """
+    :return: A TCP port of localhost nothing listens on (int)
+    """
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    """
+    Wait until condition() is true.
+
+    :param condition: Function called until it returns a true value
+    :param timeout: Seconds to wait before failing the test
+    :return: The value returned by condition
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        value = condition()
+        if value or time.monotonic() > deadline:
+            assert value, "timed out waiting for a condition"
+            return value
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    """
+    Create a self-signed certificate for localhost with the openssl command.
+
+    :return: Tuple of the paths of the certificate and of its private key
+    """
+    if shutil.which('openssl') is None:
+        pytest.skip("the openssl command is not available")
+    directory = tmp_path_factory.mktemp('certificate')
+    cert, key = str(directory / 'cert.pem'), str(directory / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture(params=SERVER_TYPES, ids=lambda server_type: server_type.__name__)
+def server_type(request):
+    return request.param
+
+
+@pytest.fixture
+def serve():
+    """
+    Start a server in the background, stopped at the end of the test:
+
+        server = serve(Server(port=free_port(), encoder=Encoder()))
+    """
+    servers = []
+
+    def serve(server):
+        server.run()
+        servers.append(server)
+        wait_for(lambda: server.server_socket is not None)
+        return server
+
+    yield serve
+    for server in servers:
+        server.stop_server()
+        server.main_thread.join(5)
+
+
+@pytest.fixture
+def make_server(serve):
+    """
+    Create a server of a given type on a free port with a JSON encoder, register
+    its handlers with setup and start it.
+    """
+    def make_server(server_type, setup=None, **kwargs):
+        kwargs.setdefault('port', free_port())
+        kwargs.setdefault('encoder', Encoder())
+        server = server_type(**kwargs)
+        if setup is not None:
+            setup(server)
+        return serve(server)
+
+    return make_server
+
+
+@pytest.fixture
+def connect(serve):
+    """
+    Connect a Client to a running server, closed at the end of the test.
+    """
+    clients = []
+
+    def connect(server, **kwargs):
+        kwargs.setdefault('encoder', Encoder())
+        client = Client(host=server.host, port=server.port, **kwargs)
+        client.connect()
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.close()
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+from mcssl.asyncserver import AsyncServer
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    if isinstance(server, AsyncServer):
+        # plain handlers run on the event loop of AsyncServer
+        @server.register_method()
+        async def sleep(message):
+            await asyncio.sleep(message.args[0])
+            return Message('slept', args=message.args)
+    else:
+        @server.register_method()
+        def sleep(message):
+            time.sleep(message.args[0])
+            return Message('slept', args=message.args)
+
+
+def test_requests_in_flight_are_limited(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers, max_in_flight=2), pipeline=True)
+
+    futures = [client.submit(Message('sleep', args=[0.3])) for _ in range(4)]
+    responses = [future.result(5) for future in futures]
+
+    assert [response.method for response in responses] == ['slept', 'slept', 'error', 'error']
+    assert responses[2].args == ['Too many requests in flight']
+    # the slots are free again once the responses are sent
+    assert client.submit(Message('sleep', args=[0])).result(5).method == 'slept'
+
+
+def test_pending_requests_are_limited(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, max_pending=1)
+    first, second = connect(server, pipeline=True), connect(server, pipeline=True)
+
+    slow = first.submit(Message('sleep', args=[0.3]))
+    time.sleep(0.1)
+    rejected = second.submit(Message('sleep', args=[0])).result(5)
+
+    assert rejected.args == ['Server busy']
+    assert slow.result(5).method == 'slept'
+    assert second.submit(Message('sleep', args=[0])).result(5).method == 'slept'
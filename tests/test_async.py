@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+from mcssl.asyncclient import AsyncClient
+from mcssl.asyncserver import AsyncServer
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    @server.register_method()
+    async def sleep(message):
+        await asyncio.sleep(message.args[0])
+        return Message('slept', args=message.args)
+
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def collect_sums(client, sums):
+    @client.register_response_handler()
+    def sum(message):
+        sums.append(message.args[0])
+
+
+def test_async_handlers_run_concurrently(make_server, connect):
+    server = make_server(AsyncServer, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    started = time.monotonic()
+    futures = [client.submit(Message('sleep', args=[0.3])) for _ in range(10)]
+
+    assert all(future.result(5).args == [0.3] for future in futures)
+    # the handlers waited together, not one after the other
+    assert time.monotonic() - started < 2.0
+
+
+def test_async_client_requests_are_awaitable(server_type, make_server):
+    servers = [make_server(server_type, setup_handlers), make_server(server_type, setup_handlers)]
+
+    async def run():
+        clients = [AsyncClient(port=server.port, encoder=Encoder()) for server in servers]
+        sums = []
+        try:
+            requests = []
+            for client in clients:
+                await client.connect()
+                collect_sums(client, sums)
+
+                @client.register_request()
+                def add(*args):
+                    return True
+                requests += [add(i, 1) for i in range(10)]
+
+            # the requests to both servers are awaited together
+            assert await asyncio.gather(*requests) == [True] * 20
+            assert sorted(sums) == sorted(list(range(1, 11)) * 2)
+        finally:
+            for client in clients:
+                await client.close()
+
+    asyncio.run(run())
+
+
+def test_async_request_guard(server_type, make_server):
+    server = make_server(server_type, setup_handlers)
+
+    async def run():
+        client = AsyncClient(port=server.port, encoder=Encoder())
+        await client.connect()
+        sums = []
+        collect_sums(client, sums)
+
+        @client.register_request()
+        async def add(*args):
+            # a coroutine can decide whether the request is sent
+            return all(isinstance(arg, int) for arg in args)
+
+        try:
+            assert await add(1, 2)
+            try:
+                await add(1, 'two')
+            except Exception as e:
+                assert 'malformed' in str(e)
+            else:
+                raise AssertionError("malformed request sent")
+            assert sums == [3]
+        finally:
+            await client.close()
+
+    asyncio.run(run())
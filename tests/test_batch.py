@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+from mcssl.asyncclient import AsyncClient
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def test_batch_round_trip(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+
+    @client.register_request()
+    def add(*args):
+        return True
+
+    with client.batch() as batch:
+        for i in range(10):
+            add(i, 1)
+
+    assert [response.args for response in batch.result] == [[i + 1] for i in range(10)]
+    assert client.current_batch is None
+
+
+def test_batch_only_collects_its_thread(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers), pipeline=True)
+
+    @client.register_request()
+    def add(*args):
+        return True
+
+    futures = []
+    with client.batch() as batch:
+        add(1, 1)
+        thread = threading.Thread(target=lambda: futures.append(add(2, 2)))
+        thread.start()
+        thread.join()
+        # the other thread did not join the batch
+        assert len(batch.messages) == 1
+        assert futures[0].result(5).args == [4]
+
+    assert [response.args for response in batch.result.result(5)] == [[2]]
+
+
+def test_async_batch_only_collects_its_task(server_type, make_server):
+    server = make_server(server_type, setup_handlers)
+
+    async def run():
+        client = AsyncClient(port=server.port, encoder=Encoder())
+        await client.connect()
+
+        @client.register_request()
+        def add(*args):
+            return True
+
+        async def add_later(event):
+            await event.wait()
+            await add(2, 2)
+
+        try:
+            event = asyncio.Event()
+            # created outside of the batch, the task does not join it
+            task = asyncio.create_task(add_later(event))
+            async with client.batch() as batch:
+                await add(1, 1)
+                event.set()
+                await asyncio.wait_for(task, 5)
+                assert len(batch.messages) == 1
+            assert [response.args for response in batch.result] == [[2]]
+            assert client.current_batch is None
+        finally:
+            await client.close()
+
+    asyncio.run(run())
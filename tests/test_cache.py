@@ -0,0 +1,73 @@
+import socket
+import time
+
+from mcssl.message import Message
+from tests.conftest import wait_for
+
+
+def setup_handlers(server):
+    server.squared = []
+
+    @server.register_method(cache=True)
+    def square(message):
+        server.squared.append(message.args[0])
+        return Message('square', args=[message.args[0] ** 2])
+
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def test_server_caches_encoded_responses(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server)
+
+    assert [client.request(Message('square', args=[3])).args for _ in range(3)] == [[9]] * 3
+    assert client.request(Message('square', args=[4])).args == [16]
+
+    assert server.squared == [3, 4]
+    assert server.cache_stats()['square']['hits'] == 2
+    assert server.invalidate('square', 3) == 1
+    assert client.request(Message('square', args=[3])).args == [9]
+    assert server.squared == [3, 4, 3]
+
+
+def test_invalidation_is_pushed_to_clients(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    @client.register_request(cache=True)
+    def square(value):
+        return True
+
+    assert square(3).result(5).args == [9]
+    assert square(3).result(5).args == [9]
+    assert client.cache_stats()['square']['hits'] == 1
+
+    server.invalidate('square')
+
+    wait_for(lambda: client.cache_stats()['square']['entries'] == 0)
+    assert square(3).result(5).args == [9]
+    assert server.squared == [3, 3]
+
+
+def test_stalled_client_is_dropped(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, push_timeout=0.2)
+    client = connect(server, pipeline=True)
+    stalled = socket.create_connection((server.host, server.port))
+    try:
+        wait_for(lambda: len(server.sessions) == 2)
+        message = Message('news', args=['x' * 4096])
+
+        # the client reading its connection keeps getting the pushes while the
+        # buffers of the other one fill up
+        started = time.monotonic()
+        while len(server.sessions) == 2:
+            assert time.monotonic() - started < 30, "the stalled client was not dropped"
+            for _ in range(100):
+                server.push(message)
+            time.sleep(0.01)
+
+        assert client.submit(Message('add', args=[1, 2])).result(5).args == [3]
+    finally:
+        stalled.close()
@@ -0,0 +1,79 @@
+import os
+import signal
+
+from mcssl.capture import REQUEST_RECORD, RESPONSE_RECORD, CaptureWriter, read_capture
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+from mcssl.server import Server
+from tests.conftest import free_port
+from tests.test_workers import connect_when_listening, exit_status, start_supervisor
+
+
+def test_records_round_trip(tmp_path):
+    path = tmp_path / 'traffic.capture'
+    writer = CaptureWriter(path)
+    writer.request(1, 'echo', 7, b'payload', [b'first', b'second'])
+    writer.request(2, 'notify', None, b'{}')
+    writer.response(1, 7, 5 * 1024 ** 3)
+    writer.close()
+
+    records = list(read_capture(path))
+
+    assert [record.kind for record in records] == [REQUEST_RECORD, REQUEST_RECORD, RESPONSE_RECORD]
+    request, notification, response = records
+    assert (request.connection, request.method, request.request_id) == (1, 'echo', 7)
+    assert request.payload == b'payload'
+    assert request.attachments == [b'first', b'second']
+    assert notification.request_id is None
+    assert notification.attachments == []
+    # sizes over 4 GiB fit in the records
+    assert response.size == 5 * 1024 ** 3
+    assert request.timestamp <= notification.timestamp <= response.timestamp
+
+
+def test_cut_record_ends_the_log(tmp_path):
+    path = tmp_path / 'traffic.capture'
+    writer = CaptureWriter(path)
+    writer.request(1, 'echo', 1, b'payload')
+    writer.request(1, 'echo', 2, b'payload')
+    writer.close()
+    data = path.read_bytes()
+    path.write_bytes(data[:-3])
+
+    assert [record.request_id for record in read_capture(path)] == [1]
+
+
+def capture_workers(path, port):
+    server = Server(port=port, encoder=Encoder(), capture=path)
+
+    @server.register_method()
+    def echo(message):
+        return Message('echo', args=message.args)
+
+    server.run(workers=2)
+    return 0
+
+
+def test_workers_capture_into_their_own_log(tmp_path):
+    path = tmp_path / 'traffic.capture'
+    port = free_port()
+
+    supervisor = start_supervisor(capture_workers, str(path), port)
+    clients = [connect_when_listening(port) for _ in range(4)]
+    for i, client in enumerate(clients):
+        assert client.request(Message('echo', args=[i])).args == [i]
+        client.close()
+    os.kill(supervisor.pid, signal.SIGTERM)
+    assert exit_status(supervisor) == 0
+
+    logs = sorted(tmp_path.glob('traffic.capture.*'))
+    assert 1 <= len(logs) <= 2
+    assert not path.exists()
+    requests = []
+    for log in logs:
+        records = list(read_capture(log))
+        workers = {record.connection >> 24 for record in records}
+        # one worker per log, flushed when the worker stopped
+        assert len(workers) == 1 and workers != {0}
+        requests += [record for record in records if record.kind == REQUEST_RECORD and record.method == 'echo']
+    assert len(requests) == 4
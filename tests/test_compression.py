@@ -0,0 +1,57 @@
+import pickle
+
+import pytest
+
+from mcssl.common import FrameError
+from mcssl.encoder import CompressingEncoder, Encoder
+from mcssl.message import Message
+
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'lzma'])
+def test_round_trip(algorithm):
+    encoder = CompressingEncoder(algorithm=algorithm, threshold=16)
+    message = Message('echo', args=['a' * 5000])
+
+    encoded = encoder.encode(message)
+
+    assert encoded[0] == CompressingEncoder.ALGORITHMS[algorithm]
+    assert len(encoded) < 5000
+    assert encoder.decode(encoded).args == message.args
+
+
+def test_small_messages_are_not_compressed():
+    encoder = CompressingEncoder(threshold=1024)
+
+    encoded = encoder.encode(Message('echo', args=['a']))
+
+    assert encoded[0] == CompressingEncoder.RAW
+    assert encoder.decode(encoded).args == ['a']
+    assert encoder.stats.compressed_frames == 0
+
+
+def test_preset_dictionary():
+    zdict = Encoder().encode(Message('echo', args=['abcdefgh' * 10]))
+    encoder = CompressingEncoder(threshold=16, zdict=zdict)
+    message = Message('echo', args=['abcdefgh' * 10])
+
+    assert encoder.decode(encoder.encode(message)).args == message.args
+
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'lzma'])
+def test_decompression_bomb_is_rejected(algorithm):
+    bomb = CompressingEncoder(algorithm=algorithm).encode(Message('echo', args=['a' * 100000]))
+    encoder = CompressingEncoder(algorithm=algorithm, max_frame_size=10000)
+
+    with pytest.raises(FrameError):
+        encoder.decode(bomb)
+
+
+def test_encoder_is_picklable():
+    encoder = CompressingEncoder(threshold=16).for_connection()
+    encoder.encode(Message('echo', args=['a' * 100]))
+
+    copy = pickle.loads(pickle.dumps(encoder))
+
+    assert copy.stats.frames == 1
+    assert copy.stats.parent is None
+    assert copy.decode(copy.encode(Message('echo', args=['b' * 100]))).args == ['b' * 100]
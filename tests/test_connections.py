@@ -0,0 +1,75 @@
+import threading
+
+from mcssl.client import Client
+from mcssl.connection.client import SSLConnection as ClientSSLConnection
+from mcssl.connection.server import PlainConnection, SSLConnection as ServerSSLConnection
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+from tests.conftest import wait_for
+
+
+class CountingConnection(PlainConnection):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+
+    def connected(self, connection):
+        with self.lock:
+            self.opened += 1
+
+    def disconnected(self, connection):
+        with self.lock:
+            self.closed += 1
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def test_connection_limit(server_type, make_server, connect):
+    counting = CountingConnection()
+    server = make_server(server_type, setup_handlers, max_connections=1, connection_type=counting)
+    first = connect(server)
+    assert first.request(Message('add', args=[1, 2])).args == [3]
+
+    rejected = connect(server)
+    response = rejected.request(Message('add', args=[1, 2]))
+
+    assert response is None or response.args == ['Server busy']
+    # only the accepted connection is reported to the connection type
+    assert counting.opened == 1
+    first.close()
+    wait_for(lambda: counting.closed == 1)
+
+    # the slot of the closed connection is free again
+    client = Client(port=server.port, encoder=Encoder())
+    wait_for(lambda: not server.sessions)
+    client.connect()
+    try:
+        assert client.request(Message('add', args=[2, 2])).args == [4]
+    finally:
+        client.close()
+    wait_for(lambda: (counting.opened, counting.closed) == (2, 2))
+
+
+def test_tls_sessions_are_resumed(server_type, make_server, certificate):
+    cert, key = certificate
+    server_connection = ServerSSLConnection(cert, key)
+    server = make_server(server_type, setup_handlers, connection_type=server_connection)
+    client_connection = ClientSSLConnection(cert, 'localhost')
+
+    for i in range(3):
+        client = Client(port=server.port, encoder=Encoder(), connection_type=client_connection)
+        client.connect()
+        try:
+            assert client.request(Message('add', args=[i, 1])).args == [i + 1]
+        finally:
+            client.close()
+
+    assert client_connection.stats() == {'resumed': 2, 'full': 1}
+    wait_for(lambda: server_connection.stats()['resumed'] == 2)
+    assert server_connection.stats()['full'] == 1
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from mcssl.asyncserver import AsyncServer
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+from tests.conftest import wait_for
+
+
+def setup_handlers(server):
+    server.seen = []
+
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+    if isinstance(server, AsyncServer):
+        # plain handlers run on the event loop of AsyncServer
+        @server.register_method()
+        async def sleep(message):
+            await asyncio.sleep(message.args[0])
+            return Message('slept', args=message.args)
+
+        @server.register_method()
+        async def count(message):
+            for i in range(message.args[0]):
+                await asyncio.sleep(0.1)
+                yield Message('chunk', args=[i])
+
+        @server.register_method()
+        async def wait(message):
+            while not message.expired():
+                await asyncio.sleep(0.01)
+            server.seen.append(message.cancelled)
+            return Message('done')
+    else:
+        @server.register_method()
+        def sleep(message):
+            time.sleep(message.args[0])
+            return Message('slept', args=message.args)
+
+        @server.register_method()
+        def count(message):
+            for i in range(message.args[0]):
+                time.sleep(0.1)
+                yield Message('chunk', args=[i])
+
+        @server.register_method()
+        def wait(message):
+            while not message.expired():
+                time.sleep(0.01)
+            server.seen.append(message.cancelled)
+            return Message('done')
+
+
+def test_deadline_is_sent_as_time_left():
+    message = Message('add', deadline=time.monotonic_ns() + 2 * 10**9)
+
+    data = message.to_dict()
+
+    assert 'deadline' not in data
+    assert 1900 <= data['timeout_ms'] <= 2000
+    # the receiver counts the time left from its own clock
+    assert 1.8 <= Message.from_dict(data).remaining() <= 2.0
+
+
+def test_lazy_message_counts_from_receipt():
+    encoder = Encoder()
+    message = encoder.decode(encoder.encode(Message('add', deadline=time.monotonic_ns() + 10**9)), lazy=True)
+
+    time.sleep(0.2)
+
+    assert message.remaining() <= 0.8
+    time.sleep(0.8)
+    assert message.expired()
+
+
+def test_late_response_is_dropped(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers), timeout=0.2)
+
+    with pytest.raises(TimeoutError):
+        client.request(Message('sleep', args=[0.5]))
+    time.sleep(0.5)
+
+    assert client.request(Message('add', args=[1, 2])).args == [3]
+
+
+def test_timed_out_stream_is_drained(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers), timeout=0.25)
+
+    chunks = []
+    with pytest.raises(TimeoutError):
+        for chunk in client.stream(Message('count', args=[10])):
+            chunks.append(chunk.args[0])
+
+    assert chunks[:1] == [0] and len(chunks) < 10
+    # the rest of the stream arrives before the response to the next request
+    assert client.request(Message('add', args=[1, 2]), timeout=5).args == [3]
+    assert not client.skipped_responses
+
+
+def test_expired_request_is_not_run(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    response = client.submit(Message('wait', deadline=time.monotonic_ns())).result(5)
+
+    assert response.method == 'error'
+    assert not server.seen
+
+
+def test_cancel_reaches_the_handler(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    message = Message('wait')
+    future = client.submit(message)
+    time.sleep(0.1)
+
+    assert client.cancel(message.request_id)
+    with pytest.raises(CancelledError):
+        future.result(5)
+    wait_for(lambda: server.seen == [True])
+    assert client.submit(Message('add', args=[1, 2])).result(5).args == [3]
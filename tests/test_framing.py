@@ -0,0 +1,117 @@
+import socket
+
+import pytest
+
+from mcssl.client import Client
+from mcssl.common import MAX_PAYLOAD_SIZE, FrameError, FrameParser, FrameReader, attachment_views, encode_frame, \
+                         send_frame
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+from mcssl.server import Server
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def echo(message):
+        return Message('echo', args=message.args, attachments=[bytes(attachment) for attachment in message.attachments])
+
+
+class Sized(object):
+    """
+    Stands for a payload of a given size without allocating it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+def test_frames_survive_any_split():
+    frames = [(None, b'first', []), (7, b'second', [b'attached', b'']), (2**40, b'', [b'x' * 1000])]
+    data = b''
+    for request_id, payload, attachments in frames:
+        views = attachment_views(attachments)
+        data += encode_frame(payload, request_id=request_id, attachments=views) + payload + b''.join(attachments)
+
+    parser = FrameParser()
+    received = []
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+        frame = parser.next_frame()
+        if frame is not None:
+            received.append(frame)
+
+    assert received == frames
+
+
+def test_frame_reader_reads_frames_from_a_socket():
+    left, right = socket.socketpair()
+    try:
+        send_frame(left, b'payload', request_id=3, attachments=[b'one', b'two'])
+        send_frame(left, b'again')
+        reader = FrameReader(right)
+
+        assert reader.read_frame() == (3, b'payload', [b'one', b'two'])
+        assert reader.read_frame() == (None, b'again', [])
+        left.close()
+        assert reader.read_frame() is None
+    finally:
+        left.close()
+        right.close()
+
+
+def test_oversized_frames_are_rejected():
+    with pytest.raises(FrameError):
+        encode_frame(b'x' * 11, max_frame_size=10)
+    with pytest.raises(FrameError):
+        encode_frame(b'x' * 6, max_frame_size=10, attachments=attachment_views([b'y' * 5]))
+
+    parser = FrameParser(max_frame_size=10)
+    parser.feed(encode_frame(b'x' * 11, max_frame_size=100))
+    # rejected from the header, before the payload is received
+    with pytest.raises(FrameError):
+        parser.next_frame()
+
+
+def test_frame_size_limit_leaves_the_attachments_flag():
+    # the length of the payload must not set the flag of the frames with attachments
+    with pytest.raises(FrameError):
+        encode_frame(Sized(MAX_PAYLOAD_SIZE + 1), max_frame_size=MAX_PAYLOAD_SIZE)
+    for limit in (MAX_PAYLOAD_SIZE + 1, 2**32):
+        with pytest.raises(ValueError):
+            FrameParser(max_frame_size=limit)
+        with pytest.raises(ValueError):
+            FrameReader(None, max_frame_size=limit)
+        with pytest.raises(ValueError):
+            Server(max_frame_size=limit)
+        with pytest.raises(ValueError):
+            Client(max_frame_size=limit)
+
+
+def test_attachments_round_trip(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+    attachments = [b'a' * 100000, bytearray(b'b' * 10), memoryview(b'c' * 1000)]
+
+    response = client.request(Message('echo', args=[1], attachments=attachments))
+
+    assert response.args == [1]
+    assert [bytes(attachment) for attachment in response.attachments] == [bytes(a) for a in attachments]
+
+
+def test_server_closes_connection_on_oversized_frame(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, max_frame_size=1024)
+    client = connect(server, max_frame_size=1024 * 1024)
+
+    assert client.request(Message('echo', args=['x' * 100])).args == ['x' * 100]
+    # the server drops the connection instead of reading the frame
+    assert client.request(Message('echo', args=['x' * 2000])) is None
+
+
+def test_client_refuses_to_send_oversized_frame(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers), max_frame_size=1024)
+
+    with pytest.raises(FrameError):
+        client.request(Message('echo', args=['x' * 2000]))
+    assert client.request(Message('echo', args=[1])).args == [1]
@@ -0,0 +1,80 @@
+import pytest
+
+from mcssl.client import Client
+from mcssl.interceptor import Interceptor, ProfilingInterceptor
+from mcssl.message import Message
+from mcssl.pool import ClientPool
+from tests.conftest import wait_for
+
+
+class Recorder(Interceptor):
+
+    def __init__(self, name, calls, response=None):
+        self.name = name
+        self.calls = calls
+        self.response = response
+
+    def before(self, call):
+        self.calls.append(('before', self.name, call.message.method))
+        return self.response
+
+    def after(self, call):
+        self.calls.append(('after', self.name, call.message.method))
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def test_hooks_run_in_order(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    calls = []
+    server.add_interceptor(Recorder('first', calls))
+    server.add_interceptor(Recorder('second', calls))
+    client = connect(server)
+
+    assert client.request(Message('add', args=[1, 2])).args == [3]
+
+    # the after hooks run once the response is sent
+    wait_for(lambda: len(calls) == 4)
+    assert calls == [('before', 'first', 'add'), ('before', 'second', 'add'),
+                     ('after', 'second', 'add'), ('after', 'first', 'add')]
+
+
+def test_before_hook_answers_instead_of_handler(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    calls = []
+    server.add_interceptor(Recorder('deny', calls, Message('error', args=['Unauthorized'])))
+    server.add_interceptor(Recorder('never', calls))
+    client = connect(server)
+
+    response = client.request(Message('add', args=[1, 2]))
+
+    assert response.method == 'error'
+    assert response.args == ['Unauthorized']
+    wait_for(lambda: len(calls) == 2)
+    assert calls == [('before', 'deny', 'add'), ('after', 'deny', 'add')]
+
+
+def test_profiling_interceptor_keeps_slowest(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    profiler = server.add_interceptor(ProfilingInterceptor(slowest=2))
+    client = connect(server)
+
+    for i in range(5):
+        client.request(Message('add', args=[i, 1]))
+
+    wait_for(lambda: profiler.sampled == 5)
+    calls = profiler.slowest_calls()
+    assert len(calls) == 2
+    assert calls[0]['duration'] >= calls[1]['duration']
+    assert 'add' in profiler.report()
+
+
+def test_profiling_interceptor_is_server_only():
+    with pytest.raises(ValueError):
+        Client().add_interceptor(ProfilingInterceptor())
+    with pytest.raises(ValueError):
+        ClientPool().add_interceptor(ProfilingInterceptor())
@@ -0,0 +1,65 @@
+from mcssl.message import Message
+from tests.conftest import wait_for
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+    @server.register_method(cache=True)
+    def cached(message):
+        return Message('value', args=message.args)
+
+    @server.register_method()
+    def fail(message):
+        raise ValueError("fail")
+
+    @server.register_method()
+    def unencodable(message):
+        return Message('value', args=[object()])
+
+
+def test_requests_are_counted(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, metrics=True)
+    client = connect(server)
+
+    for i in range(3):
+        client.request(Message('add', args=[i, 1]))
+    client.request(Message('cached', args=[1]))
+    client.request(Message('cached', args=[1]))
+
+    # requests are recorded once their response is sent
+    wait_for(lambda: server.metrics_snapshot()['methods'].get('cached', {}).get('requests') == 2)
+    metrics = client.metrics()
+    assert metrics['methods']['add']['requests'] == 3
+    assert metrics['methods']['add']['errors'] == 0
+    assert metrics['methods']['add']['bytes_in'] > 0
+    assert metrics['methods']['cached']['cache_hits'] == 1
+    assert metrics['connections']['open'] == 1
+
+
+def test_failed_requests_are_errors(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, metrics=True)
+    client = connect(server, pipeline=True)
+
+    client.submit(Message('fail'))
+    client.submit(Message('unencodable'))
+
+    # neither response can be sent, the requests do not stay active
+    wait_for(lambda: server.metrics_snapshot()['methods'].get('unencodable', {}).get('errors') == 1)
+    wait_for(lambda: server.metrics_snapshot()['requests_active'] == 0)
+    assert server.metrics_snapshot()['methods']['fail']['errors'] == 1
+
+
+def test_metrics_disabled(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server)
+
+    assert server.metrics_snapshot() is None
+    try:
+        client.metrics()
+    except Exception as e:
+        assert 'disabled' in str(e)
+    else:
+        raise AssertionError("metrics of a server without metrics")
@@ -0,0 +1,102 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from mcssl.asyncclient import AsyncClient
+from mcssl.asyncserver import AsyncServer
+from mcssl.client import Client
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+    if isinstance(server, AsyncServer):
+        # plain handlers run on the event loop of AsyncServer
+        @server.register_method()
+        async def sleep(message):
+            await asyncio.sleep(message.args[0])
+            return Message('slept', args=message.args)
+    else:
+        @server.register_method()
+        def sleep(message):
+            time.sleep(message.args[0])
+            return Message('slept', args=message.args)
+
+
+def test_responses_are_matched_by_id(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    futures = [client.submit(Message('add', args=[i, 1])) for i in range(100)]
+
+    assert [future.result(5).args for future in futures] == [[i + 1] for i in range(100)]
+    assert not client.pending_requests
+
+
+def test_fast_requests_overtake_slow_ones(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    client = connect(server, pipeline=True)
+
+    slow = client.submit(Message('sleep', args=[0.5]))
+    fast = client.submit(Message('add', args=[1, 1]))
+
+    assert fast.result(5).args == [2]
+    assert not slow.done()
+    assert slow.result(5).args == [0.5]
+
+
+def test_submit_requires_pipeline_mode(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+
+    with pytest.raises(RuntimeError):
+        client.submit(Message('add', args=[1, 1]))
+
+
+def test_not_connected():
+    with pytest.raises(ConnectionError):
+        Client(encoder=Encoder()).request(Message('add', args=[1, 1]))
+
+
+def test_send_failure_fails_the_future(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers), pipeline=True)
+    client.client_socket.shutdown(socket.SHUT_WR)
+
+    future = client.submit(Message('add', args=[1, 1]))
+
+    with pytest.raises(OSError):
+        future.result(5)
+    assert not client.pending_requests
+
+
+def test_send_failure_raises(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+    client.client_socket.shutdown(socket.SHUT_WR)
+
+    with pytest.raises(OSError):
+        client.request(Message('add', args=[1, 1]))
+
+
+def test_async_client(server_type, make_server):
+    server = make_server(server_type, setup_handlers)
+
+    async def run():
+        client = AsyncClient(port=server.port, encoder=Encoder())
+        await client.connect()
+        try:
+            responses = await asyncio.gather(*[client.submit(Message('add', args=[i, 1])) for i in range(20)])
+            assert [response.args for response in responses] == [[i + 1] for i in range(20)]
+
+            client.writer.transport.abort()
+            with pytest.raises(OSError):
+                await client.submit(Message('add', args=[1, 1]))
+            assert not client.pending_requests
+        finally:
+            await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from mcssl.message import Message
+
+
+def pid(message):
+    return Message('pid', args=[os.getpid()])
+
+
+def size(message):
+    return Message('size', args=[len(message.args[0])])
+
+
+def setup_handlers(server):
+    server.register_method(executor='process')(pid)
+    server.register_method(executor='process')(size)
+
+
+def test_handler_runs_in_another_process(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers, process_workers=2))
+
+    response = client.request(Message('pid'), timeout=30)
+
+    assert response.method == 'pid'
+    assert response.args[0] != os.getpid()
+
+
+def test_large_request_goes_through_shared_memory(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers, process_workers=1, shared_memory_threshold=1024)
+    client = connect(server, pipeline=True)
+
+    futures = [client.submit(Message('size', args=['x' * length])) for length in (10, 100000, 1000000)]
+
+    assert [future.result(30).args for future in futures] == [[10], [100000], [1000000]]
+
+
+def test_generator_handlers_cannot_run_in_processes(server_type, make_server):
+    server = make_server(server_type)
+
+    def chunks(message):
+        yield message
+
+    with pytest.raises(ValueError):
+        server.register_method(executor='process')(chunks)
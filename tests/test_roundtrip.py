@@ -0,0 +1,55 @@
+import threading
+
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def echo(message):
+        return Message('echo', args=message.args, options=message.options)
+
+
+def test_round_trip(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+
+    for args, options in [([], {}), ([1, 2.5, None, True], {'key': 'value'}), (['héllo ☃'], {'nested': {'a': [1]}})]:
+        response = client.request(Message('echo', args=args, options=options))
+        assert response.method == 'echo'
+        assert response.args == args
+        assert response.options == options
+
+
+def test_large_message_round_trip(server_type, make_server, connect):
+    # many times the socket buffers, so the frame arrives in many reads
+    client = connect(make_server(server_type, setup_handlers))
+    text = 'x' * (8 * 1024 * 1024)
+
+    assert client.request(Message('echo', args=[text])).args == [text]
+    assert client.request(Message('echo', args=[1])).args == [1]
+
+
+def test_unknown_method(server_type, make_server, connect):
+    client = connect(make_server(server_type, setup_handlers))
+
+    assert client.request(Message('missing')).method == 'error'
+    assert client.request(Message('echo', args=[1])).args == [1]
+
+
+def test_concurrent_clients(server_type, make_server, connect):
+    server = make_server(server_type, setup_handlers)
+    clients = [connect(server) for _ in range(8)]
+    failures = []
+
+    def run(client, number):
+        for i in range(50):
+            response = client.request(Message('echo', args=[number, i]))
+            if response.args != [number, i]:
+                failures.append((number, i, response.args))
+
+    threads = [threading.Thread(target=run, args=(client, number)) for number, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert not failures
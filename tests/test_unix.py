@@ -0,0 +1,46 @@
+import socket
+
+from mcssl.client import Client
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+
+
+def setup_handlers(server):
+    @server.register_method()
+    def add(message):
+        return Message('sum', args=[sum(message.args)])
+
+
+def test_unix_socket_round_trip(server_type, make_server, connect, tmp_path):
+    path = tmp_path / 'server.sock'
+    server = make_server(server_type, setup_handlers, host=f'unix://{path}')
+    client = connect(server)
+
+    assert client.request(Message('add', args=[1, 2])).args == [3]
+
+    client.close()
+    server.stop_server()
+    server.main_thread.join(5)
+    # the path can be bound again
+    assert not path.exists()
+
+
+def test_stale_socket_file_is_replaced(server_type, make_server, connect, tmp_path):
+    path = tmp_path / 'server.sock'
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+
+    server = make_server(server_type, setup_handlers, host=f'unix://{path}')
+
+    assert connect(server).request(Message('add', args=[1, 2])).args == [3]
+
+
+def test_socketpair(server_type, make_server):
+    server = make_server(server_type, setup_handlers)
+    client = Client(encoder=Encoder())
+    client.connect(server.socketpair())
+    try:
+        assert client.request(Message('add', args=[1, 2])).args == [3]
+    finally:
+        client.close()
@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from mcssl.client import Client
+from mcssl.encoder import Encoder
+from mcssl.message import Message
+from tests.conftest import free_port
+
+
+def start_supervisor(target, *args):
+    """
+    Run a supervisor in a new interpreter, so its signal handlers and workers do
+    not affect the test process, and no lock held by a thread of the tests is
+    inherited by a fork.
+
+    :param target: Module level function run by the supervisor, its return value is the exit status
+    :param args: Arguments of the function
+    :return: The multiprocessing.Process of the supervisor
+    """
+    process = multiprocessing.get_context('spawn').Process(target=exit_with, args=(target,) + args)
+    process.start()
+    return process
+
+
+def exit_with(target, *args):
+    sys.exit(target(*args))
+
+
+def exit_status(process, timeout=20.0):
+    process.join(timeout)
+    assert process.exitcode is not None, "the supervisor did not exit"
+    return process.exitcode
+
+
+def connect_when_listening(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        client = Client(port=port, encoder=Encoder())
+        try:
+            client.connect()
+            return client
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def serve_slow_requests(server_type, port):
+    server = server_type(port=port, encoder=Encoder())
+
+    @server.register_method()
+    def slow(message):
+        time.sleep(0.5)
+        return Message('pid', args=[os.getpid()])
+
+    server.run(workers=2)
+    return 0
+
+
+def crash_workers(server_type):
+    server = server_type(port=free_port(), encoder=Encoder())
+
+    def crash(server_socket):
+        raise RuntimeError("crash")
+
+    server.serve_worker = crash
+    try:
+        server.run_workers(1, max_restarts=3)
+    except RuntimeError:
+        return 3
+    return 0
+
+
+def test_workers_drain_on_sigterm(server_type):
+    port = free_port()
+    supervisor = start_supervisor(serve_slow_requests, server_type, port)
+    client = connect_when_listening(port)
+    try:
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(client.request(Message('slow'))))
+        thread.start()
+        time.sleep(0.2)
+        os.kill(supervisor.pid, signal.SIGTERM)
+        thread.join(10)
+
+        # the request in progress is answered before the worker exits
+        assert responses[0].method == 'pid'
+        assert exit_status(supervisor) == 0
+    finally:
+        client.close()
+
+
+def test_crashing_workers_give_up(server_type):
+    assert exit_status(start_supervisor(crash_workers, server_type)) == 3